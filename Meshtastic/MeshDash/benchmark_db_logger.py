@@ -0,0 +1,78 @@
+"""
+Benchmark scrittura messages.db: una connessione per riga (vecchio db_logger)
+contro connessione persistente in WAL con una transazione per batch.
+
+Uso: python benchmark_db_logger.py [--rows 5000] [--batch 50] [--db messages_bench.db]
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from meshdash import db_logger
+
+
+def _prepare(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+    original = db_logger.DB_FILE
+    db_logger.DB_FILE = path
+    try:
+        db_logger.init_db()
+    finally:
+        db_logger.DB_FILE = original
+
+
+def bench_per_row(path: str, rows: int) -> float:
+    """Vecchio comportamento: connect/commit/close per ogni riga, journal rollback."""
+    _prepare(path)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=DELETE')
+    conn.close()
+    start = time.perf_counter()
+    for i in range(rows):
+        conn = sqlite3.connect(path)
+        conn.execute(db_logger.INSERT_MESSAGE, db_logger.message_row('received', '0x1', f'payload {i}'))
+        conn.commit()
+        conn.close()
+    return rows / (time.perf_counter() - start)
+
+
+def bench_batched(path: str, rows: int, batch: int) -> float:
+    """Connessione persistente WAL + synchronous=NORMAL, una transazione per batch."""
+    _prepare(path)
+    writer = db_logger.DBLogger(path)
+    writer.open()
+    start = time.perf_counter()
+    for offset in range(0, rows, batch):
+        writer.write_batch(
+            [db_logger.message_row('received', '0x1', f'payload {i}')
+             for i in range(offset, min(offset + batch, rows))]
+        )
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return rows / elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000)
+    parser.add_argument('--batch', type=int, default=50)
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'messages_bench.db'),
+                        help='file SQLite di prova (viene ricreato)')
+    args = parser.parse_args()
+
+    per_row = bench_per_row(args.db, args.rows)
+    batched = bench_batched(args.db, args.rows, args.batch)
+    print(f"righe: {args.rows}, batch: {args.batch}, db: {args.db}")
+    print(f"una connessione per riga : {per_row:10.0f} righe/s")
+    print(f"WAL + batch persistente  : {batched:10.0f} righe/s  (x{batched / per_row:.1f})")
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+
+
+if __name__ == '__main__':
+    main()
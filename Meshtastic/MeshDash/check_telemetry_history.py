@@ -0,0 +1,97 @@
+"""
+Verifica dei contatori di pacchetti di TelemetryHistory su un database temporaneo:
+una serie monotona deve sommarsi esattamente tra i bucket (righe grezze, rollup e
+bucket a cavallo del watermark) e un riavvio del nodo non deve perdere né gonfiare
+gli incrementi.
+
+Uso: python check_telemetry_history.py
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+from meshdash import db_logger
+from meshdash.retention import RetentionManager
+from meshdash.telemetry_history import TelemetryHistory
+
+START = datetime(2025, 5, 18, 10, 0)
+END = START + timedelta(hours=3)
+
+
+def _populate(path: str) -> dict:
+    """Scrive le serie di prova e restituisce i pacchetti tx attesi per peer in [START, END)."""
+    conn = db_logger.connect(path)
+    rows = []
+    # Monotona: +1 al minuto, con un campione prima di START che fa da base
+    for minute in range(-1, 180):
+        ts = (START + timedelta(minutes=minute)).isoformat()
+        rows.append(db_logger.telemetry_row('!monotona', {'numPacketsTx': 1000 + minute,
+                                                          'numPacketsRx': 2 * minute}, ts))
+    # Riavvio alle 10:30: +3 al minuto fino a 10:29, poi riparte da 0 e prosegue +3
+    for minute in range(-1, 180):
+        value = 500 + 3 * minute if minute < 30 else 3 * (minute - 30)
+        ts = (START + timedelta(minutes=minute, seconds=20)).isoformat()
+        rows.append(db_logger.telemetry_row('!riavvio', {'numPacketsTx': value}, ts))
+    # Un campione ogni 90 minuti: bucket orari con un solo campione
+    for step in range(-1, 2):
+        ts = (START + timedelta(minutes=90 * step + 45)).isoformat()
+        rows.append(db_logger.telemetry_row('!rado', {'numPacketsTx': 10 * (step + 1)}, ts))
+    with conn:
+        conn.executemany(db_logger.INSERT_TELEMETRY, rows)
+    conn.close()
+    # Il campione di riavvio (valore 0) conta come incremento 0, i successivi +3
+    return {'!monotona': 180, '!riavvio': 3 * 30 + 3 * 149, '!rado': 20}
+
+
+def _totals(rows) -> dict:
+    totals = {}
+    for row in rows:
+        totals[row['peer']] = totals.get(row['peer'], 0) + (row['packets_tx'] or 0)
+    return totals
+
+
+def main() -> int:
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'messages_check.db')
+        original = db_logger.DB_FILE
+        db_logger.DB_FILE = path
+        try:
+            db_logger.init_db()
+        finally:
+            db_logger.DB_FILE = original
+        expected = _populate(path)
+        history = TelemetryHistory(path)
+
+        def check(label: str, bucket_seconds: int) -> None:
+            nonlocal failures
+            history.clear_cache()
+            got = _totals(history.query(START, END, bucket_seconds))
+            status = 'OK' if got == expected else 'ERRORE'
+            if got != expected:
+                failures += 1
+            print(f"{status:6} {label:32} bucket={bucket_seconds:>5}s {got}")
+
+        for bucket_seconds in (60, 600, 1800, 3600):
+            check('solo righe grezze', bucket_seconds)
+
+        # Rollup fino a 12:31: minuti aggregati fino a 12:29, ore fino alle 12
+        manager = RetentionManager(path)
+        conn = db_logger.connect(path)
+        try:
+            manager.rollup_telemetry(conn, now=START + timedelta(hours=2, minutes=31))
+        finally:
+            conn.close()
+        for bucket_seconds in (60, 1800, 3600, 7200):
+            check('rollup + righe grezze', bucket_seconds)
+
+        monotone = [row['packets_tx'] for row in history.query(START, END, 3600, peer='!monotona')]
+        if monotone != [60, 60, 60]:
+            failures += 1
+            print(f"ERRORE serie monotona per ora: {monotone}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
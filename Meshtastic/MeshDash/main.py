@@ -2,7 +2,9 @@ import sys
 import configparser
 import logging
 from PyQt6.QtWidgets import QApplication
+from meshdash import db_logger
 from meshdash.gui import MeshDashWindow
+from meshdash.retention import RetentionManager, RetentionScheduler, parse_hours_window
 
 def main():
     # 1. Leggi config.ini
@@ -30,13 +32,51 @@ def main():
         filemode='a'  # 'w' per sovrascrivere ogni volta, 'a' per appendere
     )
 
+    # 7. Coda di scrittura su messages.db, tabella dei link e richieste di telemetria
+    interface_options = {
+        'max_queue_size': config.getint('db', 'max_queue_size', fallback=5000),
+        'max_batch': config.getint('db', 'max_batch', fallback=200),
+        'link_max_age': config.getfloat('links', 'max_age', fallback=900),
+        'link_alpha': config.getfloat('links', 'alpha', fallback=0.3),
+        'telemetry_options': {
+            'stale_after': config.getfloat('telemetry', 'stale_after', fallback=900),
+            'max_channel_utilization': config.getfloat('telemetry', 'max_channel_utilization', fallback=25),
+            'max_air_util_tx': config.getfloat('telemetry', 'max_air_util_tx', fallback=7),
+            'min_request_gap': config.getfloat('telemetry', 'min_request_gap', fallback=60),
+            'max_per_cycle': config.getint('telemetry', 'max_per_cycle', fallback=1),
+        },
+    }
+
     logging.info(f"Avvio MeshDash con porta={port!r}, refresh={refresh_interval}ms, log={log_level}")
 
-    # 7. Avvia Qt e passa i parametri
+    # 8. Crea/aggiorna lo schema di messages.db (db_logger non lo fa più all'import)
+    db_logger.init_db()
+
+    # 9. Manutenzione di messages.db (rollup, pulizia, vacuum)
+    scheduler = None
+    if config.getboolean('retention', 'enabled', fallback=True):
+        manager = RetentionManager(
+            raw_telemetry_days=config.getfloat('retention', 'raw_telemetry_days', fallback=7),
+            messages_days=config.getfloat('retention', 'messages_days', fallback=30),
+            minute_rollup_days=config.getfloat('retention', 'minute_rollup_days', fallback=30),
+            batch_size=config.getint('retention', 'batch_size', fallback=500),
+        )
+        scheduler = RetentionScheduler(
+            manager,
+            interval=config.getint('retention', 'interval_minutes', fallback=60) * 60,
+            off_peak_hours=parse_hours_window(config.get('retention', 'off_peak_hours', fallback='1-5')),
+        )
+        scheduler.start()
+
+    # 10. Avvia Qt e passa i parametri
     app = QApplication(sys.argv)
-    window = MeshDashWindow(port=port, refresh_interval=refresh_interval)
+    window = MeshDashWindow(port=port, refresh_interval=refresh_interval,
+                            interface_options=interface_options)
     window.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    if scheduler:
+        scheduler.stop()
+    sys.exit(exit_code)
 
 if __name__ == "__main__":
     main()
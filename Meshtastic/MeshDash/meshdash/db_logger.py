@@ -1,19 +1,84 @@
+import logging
 import sqlite3
 import threading
+import time
 from datetime import datetime
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 # Path to the SQLite database file
 DB_FILE = 'messages.db'
 
+# Attesa massima di un lock (es. VACUUM della retention) prima di SQLITE_BUSY
+BUSY_TIMEOUT_MS = 10000
+
 # Lock to serialize database access across threads
 _lock = threading.Lock()
 
+INSERT_MESSAGE = '''
+    INSERT INTO messages (
+        timestamp, direction, peer, payload,
+        from_id, to_id, portnum, rssi, snr, hops
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Typed packet columns added to messages (the payload column keeps text or raw bytes)
+MESSAGE_PACKET_COLUMNS = {
+    'from_id': 'INTEGER',
+    'to_id': 'INTEGER',
+    'portnum': 'TEXT',
+    'rssi': 'INTEGER',
+    'snr': 'REAL',
+    'hops': 'INTEGER',
+}
+
+# Incrementi dei contatori di pacchetti per bucket (somma degli incrementi tra campioni
+# consecutivi dello stesso peer) e contatori al primo/ultimo campione del bucket
+ROLLUP_COUNTER_COLUMNS = {
+    'packets_tx': 'INTEGER',
+    'packets_rx': 'INTEGER',
+    'first_num_packets_tx': 'INTEGER',
+    'last_num_packets_tx': 'INTEGER',
+    'first_num_packets_rx': 'INTEGER',
+    'last_num_packets_rx': 'INTEGER',
+}
+
+INSERT_TELEMETRY = '''
+    INSERT INTO telemetry (
+        timestamp, peer,
+        uptime_seconds, channel_utilization, air_util_tx,
+        num_packets_tx, num_packets_rx,
+        num_online_nodes, num_total_nodes,
+        num_rx_dupe, num_tx_relay
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+
+def connect(db_file: str = DB_FILE) -> sqlite3.Connection:
+    """
+    Open a connection in WAL mode with synchronous=NORMAL: readers don't block
+    the writer and each commit costs a WAL append instead of a full journal sync.
+    A locked database is waited for up to BUSY_TIMEOUT_MS.
+    """
+    conn = sqlite3.connect(db_file)
+    conn.execute(f'PRAGMA busy_timeout={BUSY_TIMEOUT_MS}')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
 def init_db():
     """
     Initialize the SQLite database and create the messages table if it doesn't exist.
     """
     with _lock:
         conn = sqlite3.connect(DB_FILE)
+        # Su un database nuovo abilita il vacuum incrementale (vedi retention.py): va
+        # impostato prima del passaggio a WAL. Sui database esistenti non ha effetto
+        # fino al prossimo VACUUM completo.
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
         c = conn.cursor()
         # Tabella esistente per messaggi
         c.execute('''
@@ -42,10 +107,131 @@ def init_db():
                 num_tx_relay INTEGER
             )
         ''')
+        # Aggregati per nodo e per minuto/ora della telemetria (vedi retention.py)
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS telemetry_rollup (
+                resolution TEXT NOT NULL,
+                peer TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                samples INTEGER NOT NULL,
+                avg_channel_utilization REAL,
+                max_channel_utilization REAL,
+                avg_air_util_tx REAL,
+                min_num_packets_tx INTEGER,
+                max_num_packets_tx INTEGER,
+                min_num_packets_rx INTEGER,
+                max_num_packets_rx INTEGER,
+                packets_tx INTEGER,
+                packets_rx INTEGER,
+                first_num_packets_tx INTEGER,
+                last_num_packets_tx INTEGER,
+                first_num_packets_rx INTEGER,
+                last_num_packets_rx INTEGER,
+                avg_num_online_nodes REAL,
+                max_num_online_nodes INTEGER,
+                max_uptime_seconds INTEGER,
+                PRIMARY KEY (resolution, peer, bucket)
+            )
+        ''')
+        c.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                resolution TEXT PRIMARY KEY,
+                watermark TEXT NOT NULL
+            )
+        ''')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_timestamp ON telemetry (timestamp)')
+        # Storico per nodo (vedi telemetry_history.py)
+        c.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_peer_timestamp ON telemetry (peer, timestamp)')
+        c.execute('CREATE INDEX IF NOT EXISTS idx_telemetry_rollup_bucket ON telemetry_rollup (resolution, bucket)')
+        # Aggiunge le colonne tipizzate ai database creati prima della loro introduzione
+        existing = {row[1] for row in c.execute('PRAGMA table_info(messages)')}
+        for column, column_type in MESSAGE_PACKET_COLUMNS.items():
+            if column not in existing:
+                c.execute(f'ALTER TABLE messages ADD COLUMN {column} {column_type}')
+        existing = {row[1] for row in c.execute('PRAGMA table_info(telemetry_rollup)')}
+        for column, column_type in ROLLUP_COUNTER_COLUMNS.items():
+            if column not in existing:
+                c.execute(f'ALTER TABLE telemetry_rollup ADD COLUMN {column} {column_type}')
         conn.commit()
         conn.close()
 
 
+def message_row(direction: str, peer: str, payload: Any, timestamp: Optional[str] = None,
+                fields: Optional[Dict[str, Any]] = None) -> Tuple:
+    """
+    Build the parameters of a messages row.
+    `fields` is the compact packet dict (see meshtastic_interface.compact_packet).
+    """
+    fields = fields or {}
+    return (
+        timestamp or datetime.utcnow().isoformat(), direction, peer, payload,
+        fields.get('from'), fields.get('to'), fields.get('portnum'),
+        fields.get('rssi'), fields.get('snr'), fields.get('hops'),
+    )
+
+
+def telemetry_row(peer: str, metrics: Dict[str, Any], timestamp: Optional[str] = None) -> Tuple:
+    """Build the parameters of a telemetry row from a deviceMetrics dict."""
+    return (
+        timestamp or datetime.utcnow().isoformat(), peer,
+        metrics.get('uptimeSeconds'),
+        metrics.get('channelUtilization'),
+        metrics.get('airUtilTx'),
+        metrics.get('numPacketsTx'),
+        metrics.get('numPacketsRx'),
+        metrics.get('numOnlineNodes'),
+        metrics.get('numTotalNodes'),
+        metrics.get('numRxDupe'),
+        metrics.get('numTxRelay'),
+    )
+
+
+class DBLogger:
+    """
+    Long-lived SQLite writer.
+
+    Meant to be owned by a single thread (the MeshInterfaceWorker): the
+    connection is opened in that thread and every drain cycle is written
+    in one transaction with write_batch().
+    """
+    def __init__(self, db_file: str = DB_FILE, lock_retries: int = 5, lock_retry_delay: float = 2.0) -> None:
+        self.db_file = db_file
+        self.lock_retries = lock_retries
+        self.lock_retry_delay = lock_retry_delay
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def open(self) -> None:
+        if self._conn is None:
+            self._conn = connect(self.db_file)
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def write_batch(self, messages: Iterable[Tuple] = (), telemetry: Iterable[Tuple] = ()) -> None:
+        """
+        Write pre-built message/telemetry rows in a single transaction.
+        A batch that still finds the database locked after busy_timeout
+        (e.g. a long VACUUM) is retried up to lock_retries times.
+        """
+        messages, telemetry = list(messages), list(telemetry)
+        for attempt in range(self.lock_retries + 1):
+            self.open()
+            try:
+                with self._conn:
+                    self._conn.executemany(INSERT_MESSAGE, messages)
+                    self._conn.executemany(INSERT_TELEMETRY, telemetry)
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == self.lock_retries:
+                    raise
+                logger.warning("Database bloccato (%s), nuovo tentativo %d/%d tra %.1fs",
+                               e, attempt + 1, self.lock_retries, self.lock_retry_delay)
+                time.sleep(self.lock_retry_delay)
+
+
 def log_message(direction: str, peer: str, payload: str):
     """
     Log a message to the SQLite database.
@@ -54,14 +240,9 @@ def log_message(direction: str, peer: str, payload: str):
     :param peer: identifier of the peer (e.g., node address or channel)
     :param payload: the message content
     """
-    timestamp = datetime.utcnow().isoformat()
     with _lock:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO messages (timestamp, direction, peer, payload)
-            VALUES (?, ?, ?, ?)
-        ''', (timestamp, direction, peer, payload))
+        conn = connect(DB_FILE)
+        conn.execute(INSERT_MESSAGE, message_row(direction, peer, payload))
         conn.commit()
         conn.close()
 
@@ -71,32 +252,8 @@ def log_telemetry(peer: str, metrics: dict):
     Log structured telemetry metrics for a given peer.
     metrics è il dict deviceMetrics estratto dal packet.
     """
-    timestamp = datetime.utcnow().isoformat()
     with _lock:
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''
-            INSERT INTO telemetry (
-                timestamp, peer,
-                uptime_seconds, channel_utilization, air_util_tx,
-                num_packets_tx, num_packets_rx,
-                num_online_nodes, num_total_nodes,
-                num_rx_dupe, num_tx_relay
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            timestamp, peer,
-            metrics.get('uptimeSeconds'),
-            metrics.get('channelUtilization'),
-            metrics.get('airUtilTx'),
-            metrics.get('numPacketsTx'),
-            metrics.get('numPacketsRx'),
-            metrics.get('numOnlineNodes'),
-            metrics.get('numTotalNodes'),
-            metrics.get('numRxDupe'),
-            metrics.get('numTxRelay'),
-        ))
+        conn = connect(DB_FILE)
+        conn.execute(INSERT_TELEMETRY, telemetry_row(peer, metrics))
         conn.commit()
         conn.close()
-
-# Initialize the database when this module is imported
-init_db()
@@ -0,0 +1,86 @@
+import random
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+import networkx as nx
+
+Position = Tuple[float, float]
+
+
+class GraphModel:
+    """
+    Incremental model of the mesh graph.
+
+    Node positions survive between refreshes: a new layout is seeded with
+    the previous positions and only runs a few spring iterations, so the
+    graph doesn't jump around. When the node/link set hasn't changed,
+    update() returns False and there is nothing to redraw.
+    """
+    # Iterazioni per il primo layout e per gli aggiornamenti incrementali
+    INITIAL_ITERATIONS = 50
+    INCREMENTAL_ITERATIONS = 10
+
+    def __init__(self, seed: int = 42) -> None:
+        self.graph = nx.Graph()
+        self.pos: Dict[str, Position] = {}
+        self._signature: Optional[Tuple[FrozenSet[str], FrozenSet[Tuple[str, str]]]] = None
+        self._random = random.Random(seed)
+        self._seed = seed
+
+    @staticmethod
+    def _strength(quality: float) -> float:
+        """Positive spring strength for the layout: link quality is usually an RSSI in dBm (negative)."""
+        if quality < 0:
+            return max(0.05, (quality + 130.0) / 100.0)
+        return quality or 0.05
+
+    @staticmethod
+    def _signature_of(nodes: Iterable[str], links: List[Tuple[str, str, float]]):
+        edges = frozenset((a, b) if a <= b else (b, a) for a, b, _ in links)
+        all_nodes = frozenset(nodes) | {n for edge in edges for n in edge}
+        return all_nodes, edges
+
+    def update(self, links: List[Tuple[str, str, float]], nodes: Optional[List[str]] = None) -> bool:
+        """Apply the current links/nodes. Returns True if the layout changed."""
+        signature = self._signature_of(nodes or [], links)
+        if signature == self._signature:
+            # Stessa topologia: aggiorna solo i pesi, senza ricalcolare il layout
+            for a, b, quality in links:
+                if self.graph.has_edge(a, b):
+                    self.graph[a][b]['weight'] = quality
+                    self.graph[a][b]['strength'] = self._strength(quality)
+            return False
+        self._signature = signature
+
+        graph = nx.Graph()
+        graph.add_nodes_from(signature[0])
+        for a, b, quality in links:
+            graph.add_edge(a, b, weight=quality, strength=self._strength(quality))
+        self.graph = graph
+        self.pos = self._layout(graph)
+        return True
+
+    def _seed_position(self, graph: nx.Graph, node: str) -> Position:
+        """Start a new node next to an already placed neighbour, or at a random point."""
+        placed = [self.pos[n] for n in graph.neighbors(node) if n in self.pos]
+        if placed:
+            x = sum(p[0] for p in placed) / len(placed)
+            y = sum(p[1] for p in placed) / len(placed)
+        else:
+            x, y = self._random.uniform(-1, 1), self._random.uniform(-1, 1)
+        return x + self._random.uniform(-0.1, 0.1), y + self._random.uniform(-0.1, 0.1)
+
+    def _layout(self, graph: nx.Graph) -> Dict[str, Position]:
+        if not graph.number_of_nodes():
+            return {}
+        previous = {n: self.pos[n] for n in graph.nodes if n in self.pos}
+        if not previous:
+            layout = nx.spring_layout(graph, weight='strength', iterations=self.INITIAL_ITERATIONS, seed=self._seed)
+        else:
+            seed_pos = dict(previous)
+            for node in graph.nodes:
+                if node not in seed_pos:
+                    seed_pos[node] = self._seed_position(graph, node)
+            # scale=None: niente ri-normalizzazione, le coordinate restano stabili tra un refresh e l'altro
+            layout = nx.spring_layout(graph, pos=seed_pos, weight='strength',
+                                      iterations=self.INCREMENTAL_ITERATIONS, scale=None, seed=self._seed)
+        return {n: (float(p[0]), float(p[1])) for n, p in layout.items()}
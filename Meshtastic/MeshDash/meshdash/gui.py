@@ -13,7 +13,7 @@ from PyQt6.QtWidgets import (
     QLabel, QPushButton, QListWidget, QMessageBox, QMenu, QListWidgetItem
 )
 from PyQt6.QtGui import QAction
-from PyQt6.QtCore import QTimer
+from PyQt6.QtCore import QThreadPool, QTimer, pyqtSignal
 
 import matplotlib
 matplotlib.use("QtAgg")
@@ -21,8 +21,10 @@ import matplotlib.pyplot as plt
 import networkx as nx
 from matplotlib.backends.backend_qtagg import FigureCanvasQTAgg as FigureCanvas
 
+from .graph_model import GraphModel
 from .meshtastic_interface import MeshInterface
 from .models import MeshNode
+from .refresh import RefreshResult, RefreshSignals, RefreshTask
 
 # Helper to make any packet JSON-friendly
 def get_clean_packet(packet: Any) -> Dict[str, Any]:
@@ -78,19 +80,24 @@ class GraphCanvas(FigureCanvas):
         self.setParent(parent)
         plt.tight_layout()
 
-    def draw_graph(self, links: List[Tuple[str, str, float]], nodes: Optional[List[str]] = None) -> None:
+    @staticmethod
+    def edge_widths(qualities: List[float]) -> List[float]:
+        """
+        Spessori degli archi dalla qualità dei link (EWMA dell'RSSI, di solito
+        dBm negativi): proporzionali allo scarto dal link peggiore, da 0.5 a 2.
+        """
+        low = min(qualities)
+        span = max(qualities) - low
+        if span <= 0:
+            return [2.0] * len(qualities)
+        return [0.5 + 1.5 * (q - low) / span for q in qualities]
+
+    def render_graph(self, G: nx.Graph, pos: Dict[str, Tuple[float, float]]) -> None:
         self.ax.clear()
-        G = nx.Graph()
-        if nodes:
-            G.add_nodes_from(nodes)
-        for a, b, quality in links:
-            G.add_edge(a, b, weight=quality)
         if G.number_of_nodes():
-            pos = nx.spring_layout(G, weight='weight')
             nx.draw_networkx_nodes(G, pos, ax=self.ax, node_size=300)
             if G.number_of_edges():
-                max_q = max(d['weight'] for _, _, d in G.edges(data=True))
-                widths = [2 * (d['weight'] / max_q) for _, _, d in G.edges(data=True)]
+                widths = self.edge_widths([d['weight'] for _, _, d in G.edges(data=True)])
                 nx.draw_networkx_edges(G, pos, ax=self.ax, width=widths)
             nx.draw_networkx_labels(G, pos, ax=self.ax)
         self.ax.set_axis_off()
@@ -103,16 +110,32 @@ class MeshDashWindow(QMainWindow):
     """
     LOG_LIMIT = 100
 
-    def __init__(self, port: Optional[str] = None, refresh_interval: int = 10000) -> None:
+    # Emesso dal thread di meshtastic quando arrivano nuovi link: Qt lo consegna nel thread GUI
+    links_changed = pyqtSignal()
+
+    def __init__(self, port: Optional[str] = None, refresh_interval: int = 10000,
+                 interface_options: Optional[Dict[str, Any]] = None) -> None:
         super().__init__()
         self.setWindowTitle(self.tr("MeshDash"))
         self.resize(600, 700)
 
         self.port: Optional[str] = port
+        self.interface_options: Dict[str, Any] = interface_options or {}
         self.interface: Optional[MeshInterface] = None
         self.name_map: Dict[str, str] = {}
         self.current_links: List[Tuple[str, str, float]] = []
 
+        # Refresh in background: un solo task alla volta, le richieste nel frattempo vengono accorpate
+        self.graph_model = GraphModel()
+        self.refresh_pool = QThreadPool(self)
+        self.refresh_pool.setMaxThreadCount(1)
+        self.refresh_signals = RefreshSignals(self)
+        self.refresh_signals.finished.connect(self._apply_refresh)
+        self.refresh_signals.failed.connect(self._on_refresh_failed)
+        self._refresh_running = False
+        self._pending_refresh: Optional[Dict[str, bool]] = None
+        self._device_items: Dict[str, QListWidgetItem] = {}
+
         central = QWidget()
         self.setCentralWidget(central)
         self.layout = QVBoxLayout(central)
@@ -148,7 +171,7 @@ class MeshDashWindow(QMainWindow):
          # Se la porta è stata passata da config.ini, connettiti subito
         if self.port:
             try:
-                self.interface = MeshInterface(port=self.port)
+                self.interface = MeshInterface(port=self.port, **self.interface_options)
                 logging.info(f"Connessione automatica a {self.port}")
                 # Aggiorna subito UI
                 self.refresh_all()
@@ -172,7 +195,8 @@ class MeshDashWindow(QMainWindow):
 
         # Sottoscrizioni
         pub.subscribe(self._on_new_payload, "meshtastic.receive")
-        pub.subscribe(self.refresh_graph, "meshdash.new_links")
+        self.links_changed.connect(self.refresh_graph)
+        pub.subscribe(self._on_new_links, "meshdash.new_links")
 
     def show_error(self, title: str, message: str) -> None:
         """Mostra un dialogo di errore critico."""
@@ -197,7 +221,7 @@ class MeshDashWindow(QMainWindow):
         for act in self.port_actions:
             act.setChecked(act.text() == port)
         try:
-            self.interface = MeshInterface(port=self.port)
+            self.interface = MeshInterface(port=self.port, **self.interface_options)
             logging.info(f"Connesso a porta seriale: {self.port}")
             self.refresh_all()
         except Exception as e:
@@ -209,58 +233,74 @@ class MeshDashWindow(QMainWindow):
             self.interface = None
 
     def refresh_all(self) -> None:
-        """Esegue refresh di dispositivi e grafo."""
-        if not self.interface:
-            return
-        # Chiedi ai nodi di inviare telemetria (popola interface.nodes)
-        self.interface.request_telemetry()
-        self.refresh_devices()
-        self.refresh_graph()
+        """Esegue refresh di dispositivi e grafo (in background)."""
+        self._schedule_refresh(request_telemetry=True, devices=True)
 
     def refresh_devices(self) -> None:
-        """Aggiorna la lista dispositivi con formato migliorato."""
-        try:
-            self.device_list.clear()
-            nodes = self.interface.get_nodes()
-            for node in nodes:
-                # Otteniamo un'etichetta più leggibile
-                node_id = node.id
-                
-                # Estrai le informazioni dal formato complesso (se disponibile)
-                radio_name = "Sconosciuto"
-                short_name = ""
-                
-                # Mappa dei nomi migliori dai dati grezzi
-                if hasattr(node, 'raw_data') and node.raw_data:
-                    raw_data = node.raw_data
-                    if 'longName' in raw_data:
-                        radio_name = raw_data.get('longName', 'Radio')
-                    if 'shortName' in raw_data:
-                        short_name = f" ({raw_data.get('shortName', '')})"
-
-                # Formato semplificato e leggibile
-                battery_info = f" - Batteria: {node.battery_level}%" if node.battery_level > 0 else ""
-                text = f"{radio_name}{short_name} - ID: {node_id[-6:]}{battery_info}"
-                
-                # Aggiungi l'elemento alla lista
-                item = QListWidgetItem(text)
-                item.setToolTip(f"ID completo: {node_id}")
-                self.device_list.addItem(item)
-                
-            logging.debug(f"Aggiornati {len(nodes)} dispositivi")
-        except Exception as e:
-            logging.error(f"Errore in refresh_devices: {e}")
-            self.show_error("Errore connessione", str(e))
+        """Aggiorna la lista dispositivi (in background)."""
+        self._schedule_refresh(request_telemetry=False, devices=True)
 
     def refresh_graph(self) -> None:
-        """Aggiorna il grafo della mesh."""
+        """Aggiorna il grafo della mesh (in background)."""
+        self._schedule_refresh(request_telemetry=False, devices=False)
+
+    def _on_new_links(self) -> None:
+        """Callback pubsub (thread di meshtastic): rimanda il refresh al thread GUI."""
+        self.links_changed.emit()
+
+    def _schedule_refresh(self, request_telemetry: bool, devices: bool) -> None:
+        """Avvia un RefreshTask, o accorpa la richiesta se uno è già in corso."""
+        if not self.interface:
+            return
+        if self._refresh_running:
+            pending = self._pending_refresh or {'request_telemetry': False, 'devices': False}
+            pending['request_telemetry'] |= request_telemetry
+            pending['devices'] |= devices
+            self._pending_refresh = pending
+            return
+        self._refresh_running = True
+        self.refresh_pool.start(RefreshTask(self.interface, self.graph_model, self.refresh_signals,
+                                            request_telemetry=request_telemetry, devices=devices))
+
+    def _refresh_done(self) -> None:
+        self._refresh_running = False
+        if self._pending_refresh:
+            pending, self._pending_refresh = self._pending_refresh, None
+            self._schedule_refresh(**pending)
+
+    def _apply_refresh(self, result: RefreshResult) -> None:
+        """Applica nel thread GUI i dati preparati dal RefreshTask."""
         try:
-            links = self.interface.get_links()
-            nodes = [n.id for n in self.interface.get_nodes()]
-            self.graph_canvas.draw_graph(links, nodes)
+            if result.devices is not None:
+                self._update_device_list(result.devices)
+            if result.graph is not None:
+                self.graph_canvas.render_graph(result.graph, result.pos)
         except Exception as e:
-            logging.error(f"Errore in refresh_graph: {e}")
-            self.show_error("Errore grafo", str(e))
+            logging.error(f"Errore nell'aggiornamento della UI: {e}")
+        finally:
+            self._refresh_done()
+
+    def _on_refresh_failed(self, message: str) -> None:
+        self._refresh_done()
+        self.show_error("Errore connessione", message)
+
+    def _update_device_list(self, devices: Dict[str, Tuple[str, str]]) -> None:
+        """Aggiorna la lista per differenza: modifica solo le voci cambiate."""
+        for node_id in list(self._device_items):
+            if node_id not in devices:
+                item = self._device_items.pop(node_id)
+                self.device_list.takeItem(self.device_list.row(item))
+        for node_id, (text, tooltip) in devices.items():
+            item = self._device_items.get(node_id)
+            if item is None:
+                item = QListWidgetItem(text)
+                item.setToolTip(tooltip)
+                self.device_list.addItem(item)
+                self._device_items[node_id] = item
+            elif item.text() != text:
+                item.setText(text)
+                item.setToolTip(tooltip)
+        logging.debug(f"Aggiornati {len(devices)} dispositivi")
 
     def _on_new_payload(self, packet: Any) -> None:
         """Callback per nuovi pacchetti ricevuti: pulisce e logga."""
@@ -0,0 +1,101 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+LinkKey = Tuple[str, str]
+
+
+@dataclass(frozen=True)
+class LinkState:
+    """Stato di un link orientato (from -> to) riportato da un neigh_info."""
+    source: str
+    target: str
+    last_rssi: float
+    quality: float      # EWMA dell'RSSI
+    last_seen: float    # time.monotonic() dell'ultimo report
+    reports: int = 1
+
+
+class LinkStateTable:
+    """
+    Link-state table keyed by (from, to).
+
+    Every neighbour report updates its entry in O(1). Entries older than
+    `max_age` seconds are expired when a snapshot is taken. Snapshots are
+    immutable tuples rebuilt only when the table changed since the last
+    one, so readers (GUI thread) share them without copying the table.
+    """
+    DEFAULT_MAX_AGE = 900.0
+    DEFAULT_ALPHA = 0.3
+
+    def __init__(self, max_age: float = DEFAULT_MAX_AGE, alpha: float = DEFAULT_ALPHA) -> None:
+        self.max_age = max_age
+        self.alpha = alpha
+        self._links: Dict[LinkKey, LinkState] = {}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._snapshot: Tuple[LinkState, ...] = ()
+        self._snapshot_version = -1
+        # Scadenza più vicina: evita di scorrere la tabella se nessun link può essere scaduto
+        self._next_expiry = float('inf')
+
+    def update(self, source: str, target: str, rssi: Optional[float], now: Optional[float] = None) -> LinkState:
+        """Record a neighbour report and return the updated entry."""
+        now = time.monotonic() if now is None else now
+        key = (source, target)
+        with self._lock:
+            previous = self._links.get(key)
+            if rssi is None:
+                # Report senza RSSI: aggiorna solo last_seen
+                if previous is None:
+                    rssi_value = quality = 0.0
+                else:
+                    rssi_value, quality = previous.last_rssi, previous.quality
+            else:
+                rssi_value = float(rssi)
+                if previous is None:
+                    quality = rssi_value
+                else:
+                    quality = self.alpha * rssi_value + (1 - self.alpha) * previous.quality
+            state = LinkState(source, target, rssi_value, quality, now,
+                              previous.reports + 1 if previous else 1)
+            self._links[key] = state
+            self._next_expiry = min(self._next_expiry, now + self.max_age)
+            self._version += 1
+        return state
+
+    def _expire(self, now: float) -> None:
+        """Drop entries not seen for max_age seconds. Caller holds the lock."""
+        if now < self._next_expiry:
+            return
+        cutoff = now - self.max_age
+        expired = [key for key, state in self._links.items() if state.last_seen <= cutoff]
+        for key in expired:
+            del self._links[key]
+        if expired:
+            self._version += 1
+        self._next_expiry = min((s.last_seen for s in self._links.values()), default=float('inf')) + self.max_age
+
+    def snapshot(self, now: Optional[float] = None) -> Tuple[LinkState, ...]:
+        """Return a consistent, immutable view of the live links."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._expire(now)
+            if self._snapshot_version != self._version:
+                self._snapshot = tuple(self._links.values())
+                self._snapshot_version = self._version
+            return self._snapshot
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._links)
+
+    def get_stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "links": len(self._links),
+                "version": self._version,
+                "max_age": self.max_age,
+                "alpha": self.alpha,
+            }
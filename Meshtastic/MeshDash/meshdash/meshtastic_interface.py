@@ -1,54 +1,209 @@
 import json
 import threading
-import queue
 import logging
+import time
+from collections import deque
+from datetime import datetime
 from typing import Any, Dict, List, Optional, Tuple
 from meshtastic.serial_interface import SerialInterface
 from meshtastic import mesh_interface
 from .models import MeshNode
 from pubsub import pub
-from .db_logger import log_message, log_telemetry
+from .db_logger import DBLogger, message_row, telemetry_row
+from .link_state import LinkStateTable
+from .telemetry_scheduler import TelemetryScheduler
 
 logger = logging.getLogger(__name__)
 
+def compact_packet(packet: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Extract in a single pass only the packet fields MeshDash uses.
+    The result is what gets logged instead of the full raw packet.
+    """
+    decoded = packet.get("decoded") or {}
+    if not isinstance(decoded, dict):
+        decoded = {}
+    sender = packet.get("from")
+    if isinstance(sender, dict):
+        sender = sender.get("userId")
+    hop_start = packet.get("hopStart")
+    hop_limit = packet.get("hopLimit")
+    hops = hop_start - hop_limit if isinstance(hop_start, int) and isinstance(hop_limit, int) else None
+
+    text = decoded.get("text")
+    payload = None
+    if text is None:
+        raw = decoded.get("payload")
+        if isinstance(raw, (bytes, bytearray)):
+            payload = bytes(raw)
+        elif raw is not None:
+            payload = str(raw)
+
+    telemetry = decoded.get("telemetry")
+    metrics = decoded.get("deviceMetrics")
+    if not metrics and isinstance(telemetry, dict):
+        metrics = telemetry.get("deviceMetrics")
+
+    return {
+        "from": sender if isinstance(sender, int) else None,
+        "to": packet.get("to"),
+        "portnum": decoded.get("portnum"),
+        "rssi": packet.get("rxRssi"),
+        "snr": packet.get("rxSnr"),
+        "hops": hops,
+        "text": text,
+        "payload": payload,
+        "deviceMetrics": metrics if isinstance(metrics, dict) else None,
+    }
+
+
 class MeshInterfaceWorker(threading.Thread):
     """
     Thread to asynchronously process logging tasks to avoid blocking callbacks.
+    It owns the long-lived SQLite connection and writes up to `max_batch` queued
+    tasks per wakeup in a single transaction. The queue holds at most
+    `max_queue_size` tasks: during a packet storm the oldest ones are dropped.
     """
-    def __init__(self) -> None:
+    DEFAULT_MAX_QUEUE_SIZE = 5000
+    DEFAULT_MAX_BATCH = 200
+    STATS_LOG_INTERVAL = 60.0
+
+    def __init__(self, max_queue_size: int = DEFAULT_MAX_QUEUE_SIZE, max_batch: int = DEFAULT_MAX_BATCH) -> None:
         super().__init__(daemon=True)
-        self._tasks: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+        self.max_queue_size = max_queue_size
+        self.max_batch = max_batch
+        self._tasks: "deque[Dict[str, Any]]" = deque()
+        self._cond = threading.Condition()
         self._stop_event = threading.Event()
+        self._db = DBLogger()
+        self._stats: Dict[str, Any] = {
+            "enqueued": 0,
+            "dropped": 0,
+            "written": 0,
+            "batches": 0,
+            "write_errors": 0,
+            "max_queue_depth": 0,
+            "last_batch_size": 0,
+            "last_write_ms": 0.0,
+            "avg_write_ms": 0.0,
+            "max_write_ms": 0.0,
+        }
 
     def run(self) -> None:
-        while not self._stop_event.is_set():
-            try:
-                task = self._tasks.get(timeout=1)
-                if task["type"] == "message":
-                    log_message(task["direction"], task["peer"], task["payload"])
-                elif task["type"] == "telemetry":
-                    log_telemetry(task["peer"], task["metrics"])
-            except queue.Empty:
-                continue
-            except Exception:
-                logger.exception("Error processing log task")
+        self._db.open()
+        last_stats_log = time.monotonic()
+        try:
+            while not self._stop_event.is_set():
+                batch = self._next_batch(timeout=1.0)
+                if batch:
+                    self._process(batch)
+                if time.monotonic() - last_stats_log >= self.STATS_LOG_INTERVAL:
+                    logger.info("DB worker stats: %s", self.get_stats())
+                    last_stats_log = time.monotonic()
+            # Scrive quanto rimasto in coda prima di chiudere
+            while True:
+                batch = self._next_batch(timeout=0)
+                if not batch:
+                    break
+                self._process(batch)
+        finally:
+            self._db.close()
+
+    def _next_batch(self, timeout: float) -> List[Dict[str, Any]]:
+        """Wait for tasks and pop up to max_batch of them."""
+        with self._cond:
+            if not self._tasks and timeout:
+                self._cond.wait(timeout)
+            count = min(len(self._tasks), self.max_batch)
+            return [self._tasks.popleft() for _ in range(count)]
+
+    def _process(self, batch: List[Dict[str, Any]]) -> None:
+        started = time.perf_counter()
+        try:
+            self._write_batch(batch)
+        except Exception:
+            with self._cond:
+                self._stats["write_errors"] += 1
+            logger.exception("Error processing log tasks (%d dropped)", len(batch))
+            return
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._cond:
+            stats = self._stats
+            stats["written"] += len(batch)
+            stats["batches"] += 1
+            stats["last_batch_size"] = len(batch)
+            stats["last_write_ms"] = round(elapsed_ms, 3)
+            stats["avg_write_ms"] = round(0.9 * stats["avg_write_ms"] + 0.1 * elapsed_ms, 3) if stats["batches"] > 1 else round(elapsed_ms, 3)
+            stats["max_write_ms"] = max(stats["max_write_ms"], round(elapsed_ms, 3))
+
+    def _write_batch(self, batch: List[Dict[str, Any]]) -> None:
+        messages = []
+        telemetry = []
+        for task in batch:
+            if task["type"] == "message":
+                payload = task["payload"]
+                if payload is not None and not isinstance(payload, (str, bytes)):
+                    payload = str(payload)
+                messages.append(message_row(task["direction"], task["peer"], payload,
+                                            task["timestamp"], task.get("fields")))
+            elif task["type"] == "telemetry":
+                telemetry.append(telemetry_row(task["peer"], task["metrics"], task["timestamp"]))
+        self._db.write_batch(messages, telemetry)
 
     def stop(self) -> None:
         self._stop_event.set()
+        with self._cond:
+            self._cond.notify()
+
+    def _put(self, task: Dict[str, Any]) -> None:
+        with self._cond:
+            if len(self._tasks) >= self.max_queue_size:
+                # Drop-oldest: i dati più recenti sono i più utili
+                self._tasks.popleft()
+                self._stats["dropped"] += 1
+                if self._stats["dropped"] % 100 == 1:
+                    logger.warning("DB queue full (%d), dropping oldest tasks (%d dropped so far)",
+                                   self.max_queue_size, self._stats["dropped"])
+            self._tasks.append(task)
+            self._stats["enqueued"] += 1
+            if len(self._tasks) > self._stats["max_queue_depth"]:
+                self._stats["max_queue_depth"] = len(self._tasks)
+            self._cond.notify()
 
-    def enqueue_message(self, direction: str, peer: str, payload: Any) -> None:
-        self._tasks.put({"type": "message", "direction": direction, "peer": peer, "payload": payload})
+    def enqueue_message(self, direction: str, peer: str, payload: Any,
+                        fields: Optional[Dict[str, Any]] = None) -> None:
+        self._put({"type": "message", "direction": direction, "peer": peer, "payload": payload,
+                   "fields": fields, "timestamp": datetime.utcnow().isoformat()})
 
     def enqueue_telemetry(self, peer: str, metrics: Dict[str, Any]) -> None:
-        self._tasks.put({"type": "telemetry", "peer": peer, "metrics": metrics})
+        self._put({"type": "telemetry", "peer": peer, "metrics": metrics,
+                   "timestamp": datetime.utcnow().isoformat()})
+
+    def queue_depth(self) -> int:
+        with self._cond:
+            return len(self._tasks)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Return queue depth, drop counters and write latency."""
+        with self._cond:
+            stats = dict(self._stats)
+            stats["queue_depth"] = len(self._tasks)
+        stats["max_queue_size"] = self.max_queue_size
+        stats["max_batch"] = self.max_batch
+        return stats
 
 class MeshInterface:
     """
     High-level interface for Meshtastic, handling serialization, callbacks,
     and asynchronous DB logging.
     """
-    def __init__(self, port: str, baudrate: int = 921600) -> None:
-        self.worker = MeshInterfaceWorker()
+    def __init__(self, port: str, baudrate: int = 921600,
+                 max_queue_size: int = MeshInterfaceWorker.DEFAULT_MAX_QUEUE_SIZE,
+                 max_batch: int = MeshInterfaceWorker.DEFAULT_MAX_BATCH,
+                 link_max_age: float = LinkStateTable.DEFAULT_MAX_AGE,
+                 link_alpha: float = LinkStateTable.DEFAULT_ALPHA,
+                 telemetry_options: Optional[Dict[str, Any]] = None) -> None:
+        self.worker = MeshInterfaceWorker(max_queue_size=max_queue_size, max_batch=max_batch)
         self.worker.start()
 
         try:
@@ -58,8 +213,10 @@ class MeshInterface:
             logger.exception("Failed to open serial interface")
             raise
 
-        self._links_buffer: List[Dict[str, Any]] = []
-        self._links_lock = threading.Lock()
+        # Stato persistente dei link (from, to): sopravvive tra un refresh e l'altro
+        self.links = LinkStateTable(max_age=link_max_age, alpha=link_alpha)
+        # Richieste di telemetria mirate ai nodi senza dati recenti (vedi poll_telemetry)
+        self.telemetry_scheduler = TelemetryScheduler(**(telemetry_options or {}))
 
         # Subscribe with a single handler and dispatch by packet type
         pub.subscribe(self._on_receive, "meshtastic.receive")
@@ -67,59 +224,49 @@ class MeshInterface:
     def close(self) -> None:
         """Stop worker and close interface."""
         self.worker.stop()
+        self.worker.join(timeout=5)
         try:
             self.interface.close()
         except Exception:
             logger.exception("Error closing interface")
 
-    def _make_jsonable(self, obj: Any) -> Any:
-        try:
-            json.dumps(obj)
-            return obj
-        except (TypeError, OverflowError):
-            if isinstance(obj, dict):
-                return {self._make_jsonable(k): self._make_jsonable(v) for k, v in obj.items()}
-            if isinstance(obj, (list, tuple)):
-                return [self._make_jsonable(o) for o in obj]
-            return repr(obj)
+    def get_worker_stats(self) -> Dict[str, Any]:
+        """Return the DB logging worker metrics (queue depth, drops, write latency)."""
+        return self.worker.get_stats()
 
     def _format_peer(self, peer_id: int) -> str:
         return hex(peer_id)
 
+    def _format_node_id(self, node_num: int) -> str:
+        """Node id as used by interface.nodes and the meshtastic API (e.g. '!a1b2c3d4')."""
+        return f"!{node_num:08x}"
+
     def _on_receive(self, packet: Any) -> None:
         """Unified callback for all packet types."""
         try:
-            peer = self._format_peer(packet.get("from", {}).get("userId", 0))
-            direction = packet.get("when", "unknown")
-            # Log grezzo (sent/received) in background
-            self.worker.enqueue_message(direction, peer, packet)
+            fields = compact_packet(packet)
+            peer = self._format_peer(fields["from"] or 0)
+            # Log compatto in background: solo i campi usati, niente pacchetto grezzo
+            self.worker.enqueue_message("received", peer, fields["text"] or fields["payload"], fields)
 
 
             # Handle neighbor info
 #            if packet.get("decoded") and packet["decoded"].get("neigh_info"):  # neigh_info packet
 #                neighbors = packet["decoded"]["neigh_info"].get("neighbors", [])
-#                with self._links_lock:
-#                    self._links_buffer.extend(
-#                        [{"from": peer, "to": self._format_peer(n.get("id")), "rssi": n.get("rssi")} for n in neighbors]
-#                    )
+#                for n in neighbors:
+#                    self.links.update(peer, self._format_peer(n.get("id")), n.get("rssi"))
 
             # Handle TEXT_MESSAGE_APP JSON payloads for neigh_info
-            decoded = packet.get("decoded", {}) or {}
-            text = decoded.get("text") if isinstance(decoded, dict) else None
-            if text:
+            text = fields["text"]
+            # Solo i testi che sembrano JSON: evita un parse fallito per ogni messaggio normale
+            if text and text.lstrip().startswith("{"):
                 try:
                     obj = json.loads(text)
                     if obj.get("type") == "neigh_info":
-                        data_list = obj.get("data", [])
-                        with self._links_lock:
-                            self._links_buffer.extend([
-                                {
-                                    "from": peer,
-                                    "to": self._format_peer(entry.get("id")),
-                                    "rssi": entry.get("rssi"),
-                                }
-                                for entry in data_list
-                            ])
+                        for entry in obj.get("data", []):
+                            if entry.get("id") is None:
+                                continue
+                            self.links.update(peer, self._format_peer(entry.get("id")), entry.get("rssi"))
                         # Notifica subito la GUI di nuovi link
                         pub.sendMessage("meshdash.new_links")
                 except Exception:
@@ -131,9 +278,11 @@ class MeshInterface:
 #                self.worker.enqueue_telemetry(peer, metrics)
 
             # Handle structured deviceMetrics (telemetria)
-            if decoded.get("deviceMetrics"):
-                metrics = decoded["deviceMetrics"]
-                self.worker.enqueue_telemetry(peer, metrics)
+            if fields["deviceMetrics"]:
+                self.worker.enqueue_telemetry(peer, fields["deviceMetrics"])
+                if fields["from"] is not None:
+                    self.telemetry_scheduler.record_telemetry(self._format_node_id(fields["from"]),
+                                                              fields["deviceMetrics"])
 
         except (AttributeError, KeyError) as e:
             logger.warning("Malformed packet received: %s", e)
@@ -164,19 +313,41 @@ class MeshInterface:
         return nodes
 
     def get_links(self) -> List[Tuple[str, str, float]]:
-        """Return and clear the current buffered links as tuples."""
-        with self._links_lock:
-            # Converto il formato del buffer in tuple (da, a, qualità)
-            links = [(link["from"], link["to"], float(link.get("rssi", 0))) 
-                     for link in self._links_buffer]
-            self._links_buffer.clear()
-        return links
+        """Return the live links as (from, to, quality) tuples, quality being the EWMA of the RSSI."""
+        return [(link.source, link.target, link.quality) for link in self.links.snapshot()]
+
+    def _local_node_id(self) -> Optional[str]:
+        try:
+            return self._format_node_id(self.interface.myInfo.my_node_num)
+        except Exception:
+            return None
+
+    def poll_telemetry(self) -> List[str]:
+        """
+        Ask telemetry only from the nodes the scheduler reports as stale,
+        within the channel utilization budget. Returns the nodes asked.
+        """
+        local_id = self._local_node_id()
+        node_ids = [node_id for node_id in getattr(self.interface, 'nodes', None) or {}
+                    if node_id != local_id]
+        due = self.telemetry_scheduler.due(node_ids)
+        for node_id in due:
+            self.request_telemetry(node_id)
+        if due:
+            logger.debug("Telemetria richiesta a %s (%s)", due, self.telemetry_scheduler.get_stats())
+        return due
 
     def request_telemetry(self, node_id: Optional[str] = None) -> None:
-        """Request telemetry data for a specific node or broadcast if None."""
+        """
+        Request telemetry data for a specific node, or broadcast "!stats" to
+        the whole mesh if None (costly on the channel: prefer poll_telemetry).
+        """
         try:
             if node_id:
-                self.interface.requestTelemetry(node_id)
+                if hasattr(self.interface, 'requestTelemetry'):
+                    self.interface.requestTelemetry(node_id)
+                else:
+                    self.interface.sendTelemetry(destinationId=node_id, wantResponse=True)
             else:
                 self.interface.sendText("!stats")  # Comando per richiedere statistiche da tutti
         except Exception as e:
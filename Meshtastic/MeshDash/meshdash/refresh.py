@@ -0,0 +1,79 @@
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+import networkx as nx
+from PyQt6.QtCore import QObject, QRunnable, pyqtSignal
+
+from .graph_model import GraphModel
+from .models import MeshNode
+
+logger = logging.getLogger(__name__)
+
+
+def describe_node(node: MeshNode) -> Tuple[str, str]:
+    """Return the (text, tooltip) shown in the device list for a node."""
+    node_id = node.id
+    radio_name = "Sconosciuto"
+    short_name = ""
+
+    # Mappa dei nomi migliori dai dati grezzi
+    raw_data = node.raw_data or {}
+    if 'longName' in raw_data:
+        radio_name = raw_data.get('longName', 'Radio')
+    if 'shortName' in raw_data:
+        short_name = f" ({raw_data.get('shortName', '')})"
+
+    battery_info = f" - Batteria: {node.battery_level}%" if node.battery_level > 0 else ""
+    return f"{radio_name}{short_name} - ID: {node_id[-6:]}{battery_info}", f"ID completo: {node_id}"
+
+
+@dataclass
+class RefreshResult:
+    """Ready-to-render data produced off the GUI thread."""
+    # node_id -> (testo, tooltip), nell'ordine della lista; None se la lista non è stata letta
+    devices: Optional[Dict[str, Tuple[str, str]]] = None
+    # Grafo e posizioni da disegnare; None se la topologia non è cambiata
+    graph: Optional[nx.Graph] = None
+    pos: Dict[str, Tuple[float, float]] = field(default_factory=dict)
+
+
+class RefreshSignals(QObject):
+    """Signals emitted by RefreshTask; the object lives in the GUI thread."""
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+
+class RefreshTask(QRunnable):
+    """
+    One refresh cycle run in a QThreadPool: optional telemetry poll
+    (blocking serial sends to the stale nodes only), node list, link
+    snapshot and graph layout.
+    The GraphModel must only be touched by one task at a time.
+    """
+    def __init__(self, interface, model: GraphModel, signals: RefreshSignals,
+                 request_telemetry: bool = True, devices: bool = True) -> None:
+        super().__init__()
+        self.interface = interface
+        self.model = model
+        self.signals = signals
+        self.request_telemetry = request_telemetry
+        self.devices = devices
+
+    def run(self) -> None:
+        try:
+            result = RefreshResult()
+            if self.request_telemetry:
+                # Chiedi la telemetria solo ai nodi senza dati recenti (popola interface.nodes)
+                self.interface.poll_telemetry()
+            nodes: List[MeshNode] = self.interface.get_nodes()
+            if self.devices:
+                result.devices = {node.id: describe_node(node) for node in nodes}
+            if self.model.update(self.interface.get_links(), [n.id for n in nodes]):
+                # Copie: il task successivo aggiorna i pesi del modello mentre la GUI disegna
+                result.graph = self.model.graph.copy()
+                result.pos = dict(self.model.pos)
+            self.signals.finished.emit(result)
+        except Exception as e:
+            logger.exception("Errore nel refresh in background")
+            self.signals.failed.emit(str(e))
@@ -0,0 +1,248 @@
+import logging
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from . import db_logger
+
+logger = logging.getLogger(__name__)
+
+# Risoluzioni dei rollup: lunghezza del prefisso del timestamp ISO che identifica il bucket
+# ('2025-05-18T10:42' per il minuto, '2025-05-18T10' per l'ora)
+ROLLUP_RESOLUTIONS: Dict[str, int] = {
+    'minute': 16,
+    'hour': 13,
+}
+
+# Campioni di telemetria in [:start, :end) con l'incremento dei contatori di pacchetti
+# rispetto al campione precedente dello stesso peer, anche quando questo cade prima di
+# :start (nel bucket precedente). Un contatore che scende indica un riavvio del nodo:
+# l'incremento è il nuovo valore. {bucket} è l'espressione del bucket di ogni campione;
+# first_tx/last_tx (e _rx) sono i contatori al primo e all'ultimo campione del bucket.
+COUNTER_SAMPLES_CTE = '''
+    WITH window_rows AS (
+        SELECT peer, timestamp, channel_utilization, air_util_tx, num_packets_tx, num_packets_rx,
+               num_online_nodes, uptime_seconds, 0 AS lookback
+        FROM telemetry
+        WHERE timestamp >= :start AND timestamp < :end AND peer IS NOT NULL {peer_filter}
+        UNION ALL
+        SELECT peer, MAX(timestamp), NULL, NULL, num_packets_tx, num_packets_rx, NULL, NULL, 1
+        FROM telemetry
+        WHERE timestamp < :start AND peer IS NOT NULL {peer_filter}
+        GROUP BY peer
+    ),
+    lagged AS (
+        SELECT *, LAG(num_packets_tx) OVER by_peer AS prev_tx, LAG(num_packets_rx) OVER by_peer AS prev_rx
+        FROM window_rows
+        WINDOW by_peer AS (PARTITION BY peer ORDER BY timestamp)
+    ),
+    samples AS (
+        SELECT *, {bucket} AS bucket,
+               CASE WHEN num_packets_tx < prev_tx THEN num_packets_tx
+                    ELSE num_packets_tx - prev_tx END AS inc_tx,
+               CASE WHEN num_packets_rx < prev_rx THEN num_packets_rx
+                    ELSE num_packets_rx - prev_rx END AS inc_rx
+        FROM lagged
+        WHERE lookback = 0
+    ),
+    counters AS (
+        SELECT *,
+               FIRST_VALUE(num_packets_tx) OVER in_bucket AS first_tx,
+               LAST_VALUE(num_packets_tx) OVER in_bucket AS last_tx,
+               FIRST_VALUE(num_packets_rx) OVER in_bucket AS first_rx,
+               LAST_VALUE(num_packets_rx) OVER in_bucket AS last_rx
+        FROM samples
+        WINDOW in_bucket AS (PARTITION BY peer, bucket ORDER BY timestamp
+                             ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+    )
+'''
+
+ROLLUP_SQL = COUNTER_SAMPLES_CTE.format(peer_filter='', bucket='substr(timestamp, 1, :length)') + '''
+    INSERT OR REPLACE INTO telemetry_rollup (
+        resolution, peer, bucket, samples,
+        avg_channel_utilization, max_channel_utilization, avg_air_util_tx,
+        min_num_packets_tx, max_num_packets_tx,
+        min_num_packets_rx, max_num_packets_rx,
+        packets_tx, packets_rx,
+        first_num_packets_tx, last_num_packets_tx,
+        first_num_packets_rx, last_num_packets_rx,
+        avg_num_online_nodes, max_num_online_nodes, max_uptime_seconds
+    )
+    SELECT
+        :resolution, peer, bucket, COUNT(*),
+        AVG(channel_utilization), MAX(channel_utilization), AVG(air_util_tx),
+        MIN(num_packets_tx), MAX(num_packets_tx),
+        MIN(num_packets_rx), MAX(num_packets_rx),
+        SUM(inc_tx), SUM(inc_rx),
+        MAX(first_tx), MAX(last_tx),
+        MAX(first_rx), MAX(last_rx),
+        AVG(num_online_nodes), MAX(num_online_nodes), MAX(uptime_seconds)
+    FROM counters
+    GROUP BY peer, bucket
+'''
+
+
+class RetentionManager:
+    """
+    Retention for messages.db.
+
+    - rolls raw telemetry up into per-node per-minute/per-hour aggregates
+      (telemetry_rollup), once per completed bucket;
+    - deletes raw rows past the configured age in small batches, never
+      touching telemetry that hasn't been rolled up yet;
+    - reclaims free pages with an incremental vacuum.
+    """
+    # Attesa dopo la chiusura di un bucket prima di aggregarlo: le righe vengono
+    # scritte in batch dal worker, quindi possono arrivare con qualche secondo di ritardo
+    ROLLUP_GRACE = timedelta(minutes=2)
+
+    def __init__(self, db_file: str = db_logger.DB_FILE, raw_telemetry_days: float = 7,
+                 messages_days: float = 30, minute_rollup_days: float = 30,
+                 batch_size: int = 500, vacuum_pages: int = 500) -> None:
+        self.db_file = db_file
+        self.raw_telemetry_days = raw_telemetry_days
+        self.messages_days = messages_days
+        self.minute_rollup_days = minute_rollup_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+
+    def _connect(self) -> sqlite3.Connection:
+        # connect() imposta già busy_timeout: il worker scrive in parallelo
+        return db_logger.connect(self.db_file)
+
+    @staticmethod
+    def _iso(dt: datetime) -> str:
+        return dt.isoformat()
+
+    def rollup_telemetry(self, conn: sqlite3.Connection, now: Optional[datetime] = None) -> Dict[str, int]:
+        """Aggregate every completed bucket since the last watermark. Returns rows written per resolution."""
+        closed_before = self._iso((now or datetime.utcnow()) - self.ROLLUP_GRACE)
+        written: Dict[str, int] = {}
+        for resolution, length in ROLLUP_RESOLUTIONS.items():
+            row = conn.execute('SELECT watermark FROM rollup_state WHERE resolution = ?', (resolution,)).fetchone()
+            start = row[0] if row else ''
+            # Primo bucket non ancora chiuso: tutto ciò che lo precede è completo
+            end = closed_before[:length]
+            if end <= start:
+                written[resolution] = 0
+                continue
+            # rowcount non è affidabile per un INSERT che inizia con WITH: si usa total_changes
+            changes = conn.total_changes
+            with conn:
+                conn.execute(ROLLUP_SQL, {'resolution': resolution, 'length': length, 'start': start, 'end': end})
+                written[resolution] = conn.total_changes - changes
+                conn.execute('INSERT OR REPLACE INTO rollup_state (resolution, watermark) VALUES (?, ?)',
+                             (resolution, end))
+        return written
+
+    def _delete_in_batches(self, conn: sqlite3.Connection, table: str, where: str, params: Tuple) -> int:
+        """Delete matching rows batch_size at a time, each batch in its own short transaction."""
+        deleted = 0
+        query = (f'DELETE FROM {table} WHERE rowid IN '
+                 f'(SELECT rowid FROM {table} WHERE {where} LIMIT ?)')
+        while True:
+            with conn:
+                cursor = conn.execute(query, params + (self.batch_size,))
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.batch_size:
+                return deleted
+            # Lascia spazio al worker tra un batch e l'altro
+            time.sleep(0.05)
+
+    def prune(self, conn: sqlite3.Connection, now: Optional[datetime] = None) -> Dict[str, int]:
+        """Delete rows past their retention age. Returns deleted rows per table."""
+        now = now or datetime.utcnow()
+        deleted: Dict[str, int] = {}
+
+        # La telemetria grezza si cancella solo se già aggregata in tutte le risoluzioni
+        telemetry_cutoff = self._iso(now - timedelta(days=self.raw_telemetry_days))
+        watermarks = [row[0] for row in conn.execute('SELECT watermark FROM rollup_state')]
+        if len(watermarks) < len(ROLLUP_RESOLUTIONS):
+            telemetry_cutoff = ''
+        else:
+            telemetry_cutoff = min([telemetry_cutoff] + watermarks)
+        deleted['telemetry'] = self._delete_in_batches(conn, 'telemetry', 'timestamp < ?', (telemetry_cutoff,))
+
+        messages_cutoff = self._iso(now - timedelta(days=self.messages_days))
+        deleted['messages'] = self._delete_in_batches(conn, 'messages', 'timestamp < ?', (messages_cutoff,))
+
+        minute_cutoff = self._iso(now - timedelta(days=self.minute_rollup_days))[:ROLLUP_RESOLUTIONS['minute']]
+        deleted['telemetry_rollup'] = self._delete_in_batches(
+            conn, 'telemetry_rollup', "resolution = 'minute' AND bucket < ?", (minute_cutoff,)
+        )
+        return deleted
+
+    def vacuum(self, conn: sqlite3.Connection, allow_full: bool = False) -> int:
+        """
+        Release up to vacuum_pages free pages. A database created before
+        auto_vacuum=INCREMENTAL needs one full VACUUM (only if allow_full).
+        Returns the number of free pages before the vacuum.
+        """
+        freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+        mode = conn.execute('PRAGMA auto_vacuum').fetchone()[0]
+        if mode == 2:  # INCREMENTAL
+            if freelist:
+                conn.execute(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})').fetchall()
+        elif allow_full:
+            logger.info("Conversione di %s ad auto_vacuum=INCREMENTAL (VACUUM completo)", self.db_file)
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+            conn.execute('VACUUM')
+        return freelist
+
+    def run_once(self, vacuum: bool = False, allow_full_vacuum: bool = False) -> Dict[str, Any]:
+        """Run a full maintenance pass and return what it did."""
+        started = time.perf_counter()
+        conn = self._connect()
+        try:
+            result: Dict[str, Any] = {
+                'rolled_up': self.rollup_telemetry(conn),
+                'deleted': self.prune(conn),
+            }
+            if vacuum:
+                result['free_pages'] = self.vacuum(conn, allow_full=allow_full_vacuum)
+        finally:
+            conn.close()
+        result['seconds'] = round(time.perf_counter() - started, 3)
+        return result
+
+
+class RetentionScheduler(threading.Thread):
+    """
+    Runs RetentionManager every `interval` seconds. Rollup and pruning run
+    at every pass (they are incremental and batched); the vacuum only runs
+    during the off-peak hours window (local time, start included, end excluded).
+    """
+    def __init__(self, manager: RetentionManager, interval: float = 3600,
+                 off_peak_hours: Tuple[int, int] = (1, 5)) -> None:
+        super().__init__(daemon=True, name="RetentionScheduler")
+        self.manager = manager
+        self.interval = interval
+        self.off_peak_hours = off_peak_hours
+        self._stop_event = threading.Event()
+
+    def is_off_peak(self, now: Optional[datetime] = None) -> bool:
+        hour = (now or datetime.now()).hour
+        start, end = self.off_peak_hours
+        if start <= end:
+            return start <= hour < end
+        return hour >= start or hour < end
+
+    def run(self) -> None:
+        while not self._stop_event.wait(self.interval):
+            try:
+                off_peak = self.is_off_peak()
+                result = self.manager.run_once(vacuum=off_peak, allow_full_vacuum=off_peak)
+                logger.info("Manutenzione messages.db: %s", result)
+            except Exception:
+                logger.exception("Errore nella manutenzione di messages.db")
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+def parse_hours_window(value: str) -> Tuple[int, int]:
+    """Parse an 'H-H' hours window such as '1-5'."""
+    start, end = value.split('-', 1)
+    return int(start), int(end)
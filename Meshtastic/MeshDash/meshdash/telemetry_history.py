@@ -0,0 +1,211 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+from . import db_logger
+from .retention import COUNTER_SAMPLES_CTE, ROLLUP_RESOLUTIONS
+
+TimeLike = Union[datetime, str]
+
+# Aggregati parziali per (peer, bucket): le righe grezze e i rollup producono le stesse colonne,
+# così un bucket a cavallo del watermark si ottiene fondendo le due parti. I pacchetti sono la
+# somma degli incrementi tra campioni consecutivi del peer (vedi retention.COUNTER_SAMPLES_CTE),
+# quindi si sommano tra bucket e tra rollup e righe grezze senza perdere nulla.
+PARTIAL_COLUMNS = (
+    'peer', 'bucket', 'samples',
+    'sum_channel_utilization', 'max_channel_utilization', 'sum_air_util_tx',
+    'packets_tx', 'packets_rx',
+    'first_num_packets_tx', 'last_num_packets_tx', 'first_num_packets_rx', 'last_num_packets_rx',
+    'sum_num_online_nodes', 'max_num_online_nodes',
+)
+
+RAW_BUCKET = "(CAST(strftime('%s', timestamp) AS INTEGER) / :bucket_seconds) * :bucket_seconds"
+
+RAW_PARTIAL_SQL = COUNTER_SAMPLES_CTE + '''
+    SELECT peer, bucket, COUNT(*),
+           AVG(channel_utilization) * COUNT(*), MAX(channel_utilization), AVG(air_util_tx) * COUNT(*),
+           SUM(inc_tx), SUM(inc_rx),
+           MAX(first_tx), MAX(last_tx), MAX(first_rx), MAX(last_rx),
+           AVG(num_online_nodes) * COUNT(*), MAX(num_online_nodes)
+    FROM counters
+    GROUP BY peer, bucket
+'''
+
+# I rollup scritti prima di packets_tx/packets_rx hanno solo min/max: per quelli resta la differenza
+ROLLUP_PARTIAL_SQL = '''
+    WITH rollup_rows AS (
+        SELECT *, (CAST(strftime('%s', bucket || :suffix) AS INTEGER) / :bucket_seconds) * :bucket_seconds
+                  AS user_bucket
+        FROM telemetry_rollup
+        WHERE resolution = :resolution AND bucket >= :start AND bucket < :end {peer_filter}
+    ),
+    ordered AS (
+        SELECT *,
+               FIRST_VALUE(first_num_packets_tx) OVER in_bucket AS first_tx,
+               LAST_VALUE(last_num_packets_tx) OVER in_bucket AS last_tx,
+               FIRST_VALUE(first_num_packets_rx) OVER in_bucket AS first_rx,
+               LAST_VALUE(last_num_packets_rx) OVER in_bucket AS last_rx
+        FROM rollup_rows
+        WINDOW in_bucket AS (PARTITION BY peer, user_bucket ORDER BY bucket
+                             ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+    )
+    SELECT peer, user_bucket, SUM(samples),
+           SUM(avg_channel_utilization * samples), MAX(max_channel_utilization), SUM(avg_air_util_tx * samples),
+           SUM(COALESCE(packets_tx, max_num_packets_tx - min_num_packets_tx)),
+           SUM(COALESCE(packets_rx, max_num_packets_rx - min_num_packets_rx)),
+           MAX(first_tx), MAX(last_tx), MAX(first_rx), MAX(last_rx),
+           SUM(avg_num_online_nodes * samples), MAX(max_num_online_nodes)
+    FROM ordered
+    GROUP BY peer, user_bucket
+'''
+
+# Suffisso che rende il bucket del rollup un orario completo per strftime
+ROLLUP_TIME_SUFFIX = {'minute': ':00', 'hour': ':00:00'}
+
+
+def _iso(value: TimeLike) -> str:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _merge(target: Dict[str, Any], partial: Dict[str, Any]) -> None:
+    """Merge two partial aggregates of the same (peer, bucket); partial follows target in time."""
+    for column in ('samples', 'sum_channel_utilization', 'sum_air_util_tx', 'sum_num_online_nodes',
+                   'packets_tx', 'packets_rx'):
+        if partial[column] is not None:
+            target[column] = (target[column] or 0) + partial[column]
+    for column in ('max_channel_utilization', 'max_num_online_nodes'):
+        if partial[column] is not None:
+            target[column] = partial[column] if target[column] is None else max(target[column], partial[column])
+    for column in ('first_num_packets_tx', 'first_num_packets_rx'):
+        if target[column] is None:
+            target[column] = partial[column]
+    for column in ('last_num_packets_tx', 'last_num_packets_rx'):
+        if partial[column] is not None:
+            target[column] = partial[column]
+
+
+def _finalize(partial: Dict[str, Any], bucket_seconds: int) -> Dict[str, Any]:
+    samples = partial['samples'] or 0
+
+    def average(column: str) -> Optional[float]:
+        return partial[column] / samples if samples and partial[column] is not None else None
+
+    return {
+        'peer': partial['peer'],
+        'bucket': datetime.utcfromtimestamp(partial['bucket']).isoformat(),
+        'bucket_seconds': bucket_seconds,
+        'samples': samples,
+        'avg_channel_utilization': average('sum_channel_utilization'),
+        'max_channel_utilization': partial['max_channel_utilization'],
+        'avg_air_util_tx': average('sum_air_util_tx'),
+        'packets_tx': partial['packets_tx'],
+        'packets_rx': partial['packets_rx'],
+        'avg_online_nodes': average('sum_num_online_nodes'),
+        'max_online_nodes': partial['max_num_online_nodes'],
+    }
+
+
+class TelemetryHistory:
+    """
+    Time-bucketed telemetry history per peer.
+
+    A query for buckets that are a multiple of an hour (or a minute) reads
+    the telemetry_rollup rows up to the rollup watermark and only the raw
+    rows after it; other bucket sizes read the raw telemetry through the
+    (peer, timestamp) index. The rollup part of a query never changes once
+    written, so it is cached (LRU) keyed by the watermark.
+
+    Raw telemetry older than [retention] raw_telemetry_days is only
+    available through the rollups.
+    """
+    def __init__(self, db_file: str = db_logger.DB_FILE, cache_size: int = 64) -> None:
+        self.db_file = db_file
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "cache_hits": 0}
+
+    @staticmethod
+    def _resolution_for(bucket_seconds: int) -> Optional[str]:
+        if bucket_seconds % 3600 == 0:
+            return 'hour'
+        if bucket_seconds % 60 == 0:
+            return 'minute'
+        return None
+
+    def query(self, start: TimeLike, end: TimeLike, bucket_seconds: int = 3600,
+              peer: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Aggregates per (peer, bucket) in [start, end), ordered by bucket then peer.
+        Times are UTC, as written by db_logger; bucket is the ISO start of the bucket.
+        """
+        if bucket_seconds <= 0:
+            raise ValueError("bucket_seconds deve essere positivo")
+        start, end = _iso(start), _iso(end)
+        conn = db_logger.connect(self.db_file)
+        try:
+            partials: Dict[Tuple[str, int], Dict[str, Any]] = {}
+            raw_start = start
+            resolution = self._resolution_for(bucket_seconds)
+            if resolution:
+                row = conn.execute('SELECT watermark FROM rollup_state WHERE resolution = ?',
+                                   (resolution,)).fetchone()
+                watermark = row[0] if row else ''
+                rollup_end = min(end, watermark)
+                if start[:ROLLUP_RESOLUTIONS[resolution]] < rollup_end:
+                    for partial in self._rollup_partials(conn, resolution, start, rollup_end,
+                                                         bucket_seconds, peer):
+                        partials[(partial['peer'], partial['bucket'])] = dict(partial)
+                    raw_start = max(start, watermark)
+            if raw_start < end:
+                for partial in self._raw_partials(conn, raw_start, end, bucket_seconds, peer):
+                    key = (partial['peer'], partial['bucket'])
+                    if key in partials:
+                        _merge(partials[key], partial)
+                    else:
+                        partials[key] = partial
+        finally:
+            conn.close()
+        with self._lock:
+            self._stats["queries"] += 1
+        rows = [_finalize(partials[key], bucket_seconds)
+                for key in sorted(partials, key=lambda k: (k[1], k[0]))]
+        return rows
+
+    def _raw_partials(self, conn, start: str, end: str, bucket_seconds: int,
+                      peer: Optional[str]) -> List[Dict[str, Any]]:
+        params: Dict[str, Any] = {'bucket_seconds': bucket_seconds, 'start': start, 'end': end, 'peer': peer}
+        peer_filter = 'AND peer = :peer' if peer is not None else ''
+        cursor = conn.execute(RAW_PARTIAL_SQL.format(peer_filter=peer_filter, bucket=RAW_BUCKET), params)
+        return [dict(zip(PARTIAL_COLUMNS, row)) for row in cursor]
+
+    def _rollup_partials(self, conn, resolution: str, start: str, end: str, bucket_seconds: int,
+                         peer: Optional[str]) -> List[Dict[str, Any]]:
+        key = (resolution, start, end, bucket_seconds, peer)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self._stats["cache_hits"] += 1
+                return self._cache[key]
+        length = ROLLUP_RESOLUTIONS[resolution]
+        params: Dict[str, Any] = {'suffix': ROLLUP_TIME_SUFFIX[resolution], 'bucket_seconds': bucket_seconds,
+                                  'resolution': resolution, 'start': start[:length], 'end': end, 'peer': peer}
+        peer_filter = 'AND peer = :peer' if peer is not None else ''
+        cursor = conn.execute(ROLLUP_PARTIAL_SQL.format(peer_filter=peer_filter), params)
+        partials = [dict(zip(PARTIAL_COLUMNS, row)) for row in cursor]
+        with self._lock:
+            self._cache[key] = partials
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return partials
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["cached"] = len(self._cache)
+        return stats
@@ -0,0 +1,127 @@
+import random
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+
+class TelemetryScheduler:
+    """
+    Decides which nodes to ask for telemetry, instead of broadcasting
+    "!stats" to the whole mesh at every refresh.
+
+    - freshness: a node is stale when no deviceMetrics arrived from it for
+      `stale_after` seconds (plus a random jitter, so nodes seen together
+      don't all become stale at the same tick);
+    - budget: no request is sent while the latest channel_utilization or
+      air_util_tx of a fresh node is above the configured limits;
+    - spreading: at most `max_per_cycle` requests per poll, at least
+      `min_request_gap` seconds apart, and a node is not asked again
+      before `stale_after` seconds even if it doesn't answer.
+    """
+    DEFAULT_STALE_AFTER = 900.0
+    DEFAULT_MAX_CHANNEL_UTILIZATION = 25.0
+    DEFAULT_MAX_AIR_UTIL_TX = 7.0
+    DEFAULT_MIN_REQUEST_GAP = 60.0
+
+    def __init__(self, stale_after: float = DEFAULT_STALE_AFTER,
+                 max_channel_utilization: float = DEFAULT_MAX_CHANNEL_UTILIZATION,
+                 max_air_util_tx: float = DEFAULT_MAX_AIR_UTIL_TX,
+                 min_request_gap: float = DEFAULT_MIN_REQUEST_GAP,
+                 max_per_cycle: int = 1, jitter: float = 0.2, seed: Optional[int] = None) -> None:
+        self.stale_after = stale_after
+        self.max_channel_utilization = max_channel_utilization
+        self.max_air_util_tx = max_air_util_tx
+        self.min_request_gap = min_request_gap
+        self.max_per_cycle = max_per_cycle
+        self.jitter = jitter
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_telemetry: Dict[str, float] = {}
+        self._last_request: Dict[str, float] = {}
+        self._stale_after: Dict[str, float] = {}
+        # Ultime letture di utilizzo del canale per nodo: (istante, channel_utilization, air_util_tx)
+        self._utilization: Dict[str, tuple] = {}
+        self._last_any_request = float('-inf')
+        self._stats = {"requests": 0, "skipped_budget": 0, "telemetry_received": 0}
+
+    def _node_stale_after(self, node_id: str) -> float:
+        if node_id not in self._stale_after:
+            spread = self.stale_after * self.jitter
+            self._stale_after[node_id] = self.stale_after + self._random.uniform(-spread, spread)
+        return self._stale_after[node_id]
+
+    def record_telemetry(self, node_id: str, metrics: Dict[str, Any], now: Optional[float] = None) -> None:
+        """Mark a node as fresh and remember its channel utilization readings."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._last_telemetry[node_id] = now
+            self._stats["telemetry_received"] += 1
+            channel = metrics.get('channelUtilization')
+            air = metrics.get('airUtilTx')
+            if channel is not None or air is not None:
+                self._utilization[node_id] = (now, channel, air)
+
+    def channel_load(self, now: Optional[float] = None) -> Dict[str, float]:
+        """Highest channel_utilization / air_util_tx among the readings still fresh."""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            return self._channel_load(now)
+
+    def _channel_load(self, now: float) -> Dict[str, float]:
+        channel = air = 0.0
+        for seen, node_channel, node_air in self._utilization.values():
+            if now - seen > self.stale_after:
+                continue
+            channel = max(channel, node_channel or 0.0)
+            air = max(air, node_air or 0.0)
+        return {"channel_utilization": channel, "air_util_tx": air}
+
+    def over_budget(self, now: Optional[float] = None) -> bool:
+        load = self.channel_load(now)
+        return (load["channel_utilization"] > self.max_channel_utilization
+                or load["air_util_tx"] > self.max_air_util_tx)
+
+    def due(self, node_ids: Iterable[str], now: Optional[float] = None) -> List[str]:
+        """
+        Return the nodes to ask for telemetry now (the stalest first) and
+        record the requests as sent.
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if now - self._last_any_request < self.min_request_gap:
+                return []
+            load = self._channel_load(now)
+            if (load["channel_utilization"] > self.max_channel_utilization
+                    or load["air_util_tx"] > self.max_air_util_tx):
+                self._stats["skipped_budget"] += 1
+                return []
+            candidates = []
+            for node_id in node_ids:
+                limit = self._node_stale_after(node_id)
+                age = now - self._last_telemetry.get(node_id, float('-inf'))
+                if age < limit:
+                    continue
+                if now - self._last_request.get(node_id, float('-inf')) < limit:
+                    # Già richiesto di recente: non insistere con i nodi che non rispondono
+                    continue
+                candidates.append((age, node_id))
+            candidates.sort(reverse=True)
+            selected = [node_id for _, node_id in candidates[:self.max_per_cycle]]
+            for node_id in selected:
+                self._last_request[node_id] = now
+            if selected:
+                self._last_any_request = now
+                self._stats["requests"] += len(selected)
+            return selected
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(self._channel_load(now))
+            stats["known_nodes"] = len(self._last_telemetry)
+            stats["stale_nodes"] = sum(
+                1 for node_id, seen in self._last_telemetry.items()
+                if now - seen >= self._stale_after.get(node_id, self.stale_after)
+            )
+        return stats
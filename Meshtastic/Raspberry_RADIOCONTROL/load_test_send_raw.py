@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Load test di /send_raw: più processi (come più read_serial sullo stesso Pi)
+inviano punzonature in parallelo al meshtastic_service locale.
+
+Ogni processo apre --concurrency thread, ognuno invia --requests richieste
+'1;timestamp;nome;pkey;id;control;card;punch_time'. Alla fine stampa
+throughput, latenze (p50/p95/max), errori per codice HTTP e /stats del servizio.
+
+Uso: python load_test_send_raw.py [--url http://localhost:8000] [--processes 3]
+                                  [--concurrency 4] [--requests 50]
+
+Attenzione: ogni richiesta riuscita viene davvero trasmessa sulla mesh.
+"""
+import argparse
+import json
+import multiprocessing
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from datetime import datetime
+
+
+def _post(url: str, payload: str, timeout: float):
+    request = urllib.request.Request(url, data=payload.encode('utf-8'), method='POST',
+                                     headers={'Content-Type': 'text/plain'})
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            resp.read()
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except Exception as e:
+        status = type(e).__name__
+    return status, time.perf_counter() - started
+
+
+def _reader(index: int, args, results) -> None:
+    """Un processo 'lettore': concurrency thread che inviano in parallelo"""
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+
+    def worker(thread_index: int):
+        for i in range(args.requests):
+            record_id = (index * args.concurrency + thread_index) * args.requests + i
+            payload = ";".join([
+                '1', str(time.time()), f'loadtest{index}', 'pkey', str(record_id),
+                str(31 + thread_index), str(1000000 + record_id), datetime.now().isoformat()
+            ])
+            status, elapsed = _post(f"{args.url}/send_raw", payload, args.timeout)
+            with lock:
+                statuses[status] += 1
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put((latencies, dict(statuses)))
+
+
+def _percentile(values, fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://localhost:8000')
+    parser.add_argument('--processes', type=int, default=3, help='processi lettore')
+    parser.add_argument('--concurrency', type=int, default=4, help='richieste parallele per processo')
+    parser.add_argument('--requests', type=int, default=50, help='richieste per thread')
+    parser.add_argument('--timeout', type=float, default=30)
+    args = parser.parse_args()
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=_reader, args=(i, args, results))
+                 for i in range(args.processes)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    latencies = []
+    statuses = Counter()
+    for _ in processes:
+        process_latencies, process_statuses = results.get()
+        latencies.extend(process_latencies)
+        statuses.update(process_statuses)
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+
+    total = len(latencies)
+    print(f"richieste: {total} ({args.processes} processi x {args.concurrency} thread x {args.requests})")
+    print(f"durata   : {elapsed:.1f} s, {total / elapsed:.1f} richieste/s")
+    print(f"latenza  : p50 {_percentile(latencies, 0.5) * 1000:.0f} ms, "
+          f"p95 {_percentile(latencies, 0.95) * 1000:.0f} ms, max {max(latencies, default=0) * 1000:.0f} ms")
+    print(f"esiti    : {dict(statuses)}")
+    try:
+        with urllib.request.urlopen(f"{args.url}/stats", timeout=5) as resp:
+            print(f"stats    : {json.dumps(json.loads(resp.read()), indent=2)}")
+    except Exception as e:
+        print(f"stats    : non disponibili ({e})")
+
+
+if __name__ == '__main__':
+    main()
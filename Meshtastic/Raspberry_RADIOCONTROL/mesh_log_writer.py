@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# mesh_log_writer.py
+"""
+Writer in background per la tabella meshtastic_log.
+
+Il thread radio e gli endpoint HTTP accodano le righe senza mai attendere
+MySQL: se la coda è piena la riga viene scartata e contata. Un thread
+dedicato, con una propria connessione, svuota la coda a blocchi e li
+scrive con executemany in un'unica transazione (group commit).
+
+Se MySQL non risponde (errore di connessione) il blocco viene trattenuto e
+riprovato con backoff esponenziale; la diagnostica (SHOW TABLES / DESCRIBE)
+gira al massimo una volta per finestra di backoff, invece che a ogni riga
+fallita. Gli altri errori (dati troppo lunghi, warning trasformati in errori
+da raise_on_warnings, vincoli, SQL) non passano riprovando: il blocco viene
+scritto riga per riga e solo la riga che fallisce viene scartata e contata.
+"""
+
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from mysql.connector import errors as mysql_errors
+
+INSERT_LOG = (
+    "INSERT INTO meshtastic_log"
+    " (direction, msg_type, event_time, node_name, peer_id, payload)"
+    " VALUES (%s, %s, %s, %s, %s, %s)"
+)
+
+# Errori che dipendono dalla connessione e non dalle righe: ha senso riprovare
+CONNECTION_ERRORS = (ConnectionError, mysql_errors.InterfaceError,
+                     mysql_errors.OperationalError, mysql_errors.PoolError)
+
+
+class MeshLogWriter:
+    """Coda limitata + group commit per meshtastic_log"""
+
+    def __init__(self, connect: Callable[[], Any], max_queue_size: int = 5000, batch_size: int = 200,
+                 flush_interval: float = 0.5, min_backoff: float = 1.0, max_backoff: float = 60.0,
+                 stats_interval: float = 300):
+        self.connect = connect
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.stats_interval = stats_interval
+        self._queue: "queue.Queue[Tuple]" = queue.Queue(maxsize=max_queue_size)
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cnx = None
+        self._pending: List[Tuple] = []
+        self._backoff = 0.0
+        self._last_diagnostic = float('-inf')
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'written': 0,
+            'batches': 0,
+            'write_errors': 0,
+            'row_by_row': 0,
+            'rows_rejected': 0,
+            'diagnostics': 0,
+            'max_queue_depth': 0,
+            'last_batch_size': 0,
+            'last_batch_ms': 0.0,
+        }
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="MeshLogWriter", daemon=True)
+        self._thread.start()
+        logging.info(f"[mesh][DB] MeshLogWriter avviato (coda max {self._queue.maxsize}, batch {self.batch_size})")
+
+    def stop(self, timeout: float = 5.0):
+        """Ferma il thread dopo un ultimo tentativo di scrivere le righe in coda"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        self._close()
+        logging.info(f"[mesh][DB] MeshLogWriter fermato. Statistiche: {self.get_stats()}")
+
+    def enqueue(self, direction: str, msg_type: int, node_name: str, peer_id: str, payload: str) -> bool:
+        """Accoda una riga senza bloccare. Ritorna False se la coda è piena."""
+        row = (direction, msg_type, datetime.now(), node_name, peer_id, payload)
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['dropped'] += 1
+                dropped = self._stats['dropped']
+            if dropped % 100 == 1:
+                logging.warning(f"[mesh][DB] Coda log piena ({self._queue.maxsize}), {dropped} righe scartate")
+            return False
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats['enqueued'] += 1
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+        return True
+
+    def _drain(self, timeout: float) -> List[Tuple]:
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout))
+        except queue.Empty:
+            return batch
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        last_stats_log = time.monotonic()
+        while True:
+            stopping = self._stop_event.is_set()
+            if not self._pending:
+                self._pending = self._drain(0 if stopping else self.flush_interval)
+            if self._pending:
+                if self._flush():
+                    self._pending = []
+                elif stopping:
+                    logging.error(f"[mesh][DB] Chiusura con {len(self._pending) + self._queue.qsize()} righe non scritte")
+                    return
+                else:
+                    # Attende il backoff (interrompibile dallo stop) prima di riprovare
+                    self._stop_event.wait(self._backoff)
+            elif stopping:
+                return
+            if self.stats_interval and time.monotonic() - last_stats_log >= self.stats_interval:
+                logging.info(f"[mesh][DB] MeshLogWriter statistiche: {self.get_stats()}")
+                last_stats_log = time.monotonic()
+
+    def _close(self):
+        if self._cnx is not None:
+            try:
+                self._cnx.close()
+            except Exception:
+                pass
+            self._cnx = None
+
+    def _flush(self) -> bool:
+        """Scrive il blocco in attesa. False se va riprovato (errore di connessione)."""
+        error = self._write(self._pending)
+        if error is not None and not isinstance(error, CONNECTION_ERRORS):
+            # Errore sulle righe: riprovare il blocco non servirebbe
+            logging.warning(f"[mesh][DB] Blocco di {len(self._pending)} righe rifiutato ({error}), scrittura riga per riga")
+            with self._stats_lock:
+                self._stats['row_by_row'] += 1
+            error = self._write_rows()
+        if error is None:
+            return True
+        self._on_error(error, len(self._pending))
+        return False
+
+    def _write_rows(self) -> Optional[Exception]:
+        """
+        Scrive self._pending una riga alla volta scartando quelle rifiutate.
+        Con un errore di connessione si ferma e lascia in _pending le righe restanti.
+        """
+        rows = self._pending
+        for index, row in enumerate(rows):
+            error = self._write([row])
+            if error is None:
+                continue
+            if isinstance(error, CONNECTION_ERRORS):
+                self._pending = rows[index:]
+                return error
+            with self._stats_lock:
+                self._stats['rows_rejected'] += 1
+            logging.error(f"[mesh][DB] Riga di log scartata ({error}): {row[:2] + row[3:5]}")
+        return None
+
+    def _write(self, batch: List[Tuple]) -> Optional[Exception]:
+        """Scrive il blocco in un'unica transazione; ritorna l'eccezione o None"""
+        started = time.monotonic()
+        if self._cnx is None or not self._cnx.is_connected():
+            self._close()
+            try:
+                self._cnx = self.connect()
+            except Exception as e:
+                # Anche un accesso negato (ProgrammingError) va riprovato, non imputato alle righe
+                return ConnectionError(f"connessione MySQL non disponibile: {e}")
+        try:
+            cursor = self._cnx.cursor()
+            try:
+                cursor.executemany(INSERT_LOG, batch)
+                self._cnx.commit()
+            finally:
+                cursor.close()
+        except Exception as e:
+            if not isinstance(e, CONNECTION_ERRORS):
+                try:
+                    self._cnx.rollback()
+                except Exception:
+                    self._close()
+            return e
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if self._backoff:
+            logging.info("[mesh][DB] Scrittura log ripristinata")
+        self._backoff = 0.0
+        with self._stats_lock:
+            self._stats['written'] += len(batch)
+            self._stats['batches'] += 1
+            self._stats['last_batch_size'] = len(batch)
+            self._stats['last_batch_ms'] = round(elapsed_ms, 2)
+        logging.debug(f"[mesh][DB] Scritte {len(batch)} righe di log in {elapsed_ms:.1f} ms")
+        return None
+
+    def _on_error(self, error: Exception, rows: int):
+        with self._stats_lock:
+            self._stats['write_errors'] += 1
+        self._close()
+        self._backoff = min(self.max_backoff, self._backoff * 2) if self._backoff else self.min_backoff
+        logging.error(f"[mesh][DB] Errore scrittura log ({rows} righe, nuovo tentativo tra {self._backoff:.1f}s): {error}")
+        now = time.monotonic()
+        if now - self._last_diagnostic >= self._backoff:
+            self._last_diagnostic = now
+            self._diagnose()
+
+    def _diagnose(self):
+        """Verifica connessione e tabella (al massimo una volta per finestra di backoff)"""
+        with self._stats_lock:
+            self._stats['diagnostics'] += 1
+        cnx = None
+        try:
+            cnx = self.connect()
+            cursor = cnx.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            logging.info("[mesh][DB] Test connessione DB: OK")
+            cursor.execute("SHOW TABLES LIKE 'meshtastic_log'")
+            table_exists = len(cursor.fetchall()) > 0
+            logging.info(f"[mesh][DB] Tabella meshtastic_log esiste: {table_exists}")
+            if table_exists:
+                cursor.execute("DESCRIBE meshtastic_log")
+                columns = [row[0] for row in cursor.fetchall()]
+                logging.info(f"[mesh][DB] Colonne tabella: {columns}")
+            cursor.close()
+        except Exception as e:
+            logging.error(f"[mesh][DB] Test DB fallito: {e}")
+        finally:
+            if cnx is not None:
+                try:
+                    cnx.close()
+                except Exception:
+                    pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        stats['pending_retry'] = len(self._pending)
+        stats['backoff'] = self._backoff
+        return stats
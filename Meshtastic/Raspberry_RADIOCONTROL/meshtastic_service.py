@@ -2,7 +2,7 @@
 # meshtastic_service.py
 
 import time
-import threading
+import asyncio
 import logging
 import json
 import glob
@@ -10,12 +10,21 @@ import configparser
 import os
 import fcntl
 import signal
+import struct
+import sys
 import mysql.connector
 from mysql.connector import pooling
 from fastapi import FastAPI, HTTPException, Body
 from pydantic import BaseModel
 from enum import IntEnum
 from meshtastic.serial_interface import SerialInterface
+from neighbor_table import NeighborTable, build_telemetry_payloads, DEFAULT_MAX_PAYLOAD_BYTES
+from mesh_log_writer import MeshLogWriter
+
+# TimeSyncManager e ClockModel stanno in src/core, nella radice del progetto
+REPO_ROOT = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+sys.path.insert(0, os.path.join(REPO_ROOT, 'src', 'core'))
+from time_sync_manager import TimeSyncManager
 
 # Configura il logger di root prima di qualsiasi operazione
 logging.basicConfig(
@@ -47,64 +56,25 @@ class MessageType(IntEnum):
     TELEMETRY = 0
     PUNCHES   = 1
 
+# --- Log su DB in background ---
+# Il thread radio e gli endpoint accodano soltanto: un thread dedicato scrive a blocchi
+log_writer = MeshLogWriter(
+    db_pool.get_connection,
+    max_queue_size=cfg.getint('DB_LOG', 'MAX_QUEUE_SIZE', fallback=5000),
+    batch_size=cfg.getint('DB_LOG', 'BATCH_SIZE', fallback=200),
+    flush_interval=cfg.getfloat('DB_LOG', 'FLUSH_INTERVAL', fallback=0.5),
+    max_backoff=cfg.getfloat('DB_LOG', 'MAX_BACKOFF', fallback=60),
+    stats_interval=cfg.getfloat('DB_LOG', 'STATS_INTERVAL', fallback=300)
+)
+
 def log_to_db(direction: str, msg_type: int, payload: str, peer_id: str = ''):
     """
-    Inserisce una riga nella tabella meshtastic_log.
+    Accoda una riga per la tabella meshtastic_log senza attendere MySQL.
+    event_time è l'istante della chiamata, non quello della scrittura.
     """
-    global node_name  # Dichiarazione esplicita che stiamo usando la variabile globale
-    try:
-        conn = db_pool.get_connection()
-        cursor = conn.cursor()
-        # Stampo un log dettagliato per debug
-        current_node_name = node_name or 'unknown_node'
-        logging.info(f"[mesh][DB] Scrivo log: {direction}, tipo {msg_type}, node {current_node_name}, peer {peer_id}")
-        
-        sql = """
-            INSERT INTO meshtastic_log
-              (direction, msg_type, event_time, node_name, peer_id, payload)
-            VALUES
-              (%s,         %s,       NOW(),      %s,        %s,      %s)
-        """
-        cursor.execute(sql, (
-            direction,
-            msg_type,
-            current_node_name,
-            peer_id,
-            payload
-        ))
-        conn.commit()
-        # Log di successo per debugging
-        logging.info(f"[mesh][DB] Log scritto con successo, ID={cursor.lastrowid}")
-    except Exception as e:
-        logging.error(f"[mesh][DB] Errore log_to_db: {e}")
-        # Log più dettagliato per debugging
-        logging.error(f"[mesh][DB] Dettagli: direction={direction}, type={msg_type}, node={node_name}, peer={peer_id}")
-        try:
-            # Tentativo di eseguire una query semplice per verificare la connessione DB
-            test_conn = db_pool.get_connection()
-            test_cursor = test_conn.cursor()
-            test_cursor.execute("SELECT 1")
-            test_cursor.fetchone()
-            logging.info("[mesh][DB] Test connessione DB: OK")
-            test_cursor.execute("SHOW TABLES LIKE 'meshtastic_log'")
-            table_exists = len(test_cursor.fetchall()) > 0
-            logging.info(f"[mesh][DB] Tabella meshtastic_log esiste: {table_exists}")
-            if table_exists:
-                test_cursor.execute("DESCRIBE meshtastic_log")
-                columns = [row[0] for row in test_cursor.fetchall()]
-                logging.info(f"[mesh][DB] Colonne tabella: {columns}")
-            test_cursor.close()
-            test_conn.close()
-        except Exception as db_test_err:
-            logging.error(f"[mesh][DB] Test DB fallito: {db_test_err}")
-    finally:
-        try:
-            if 'cursor' in locals() and cursor:
-                cursor.close()
-            if 'conn' in locals() and conn:
-                conn.close()
-        except Exception as close_err:
-            logging.error(f"[mesh][DB] Errore chiusura connessione: {close_err}")
+    current_node_name = node_name or 'unknown_node'
+    logging.debug(f"[mesh][DB] Accodo log: {direction}, tipo {msg_type}, node {current_node_name}, peer {peer_id}")
+    log_writer.enqueue(direction, msg_type, current_node_name, peer_id, payload)
 
 # --- Ricerca della porta Meshtastic via symlink by-id ---
 meshtastic_port = None
@@ -134,16 +104,43 @@ logging.info(f"[mesh] Uso MESH_PORT = {meshtastic_port}")
 NEIGH_INTERVAL = cfg.getint('MESHTASTIC', 'NEIGH_INFO_INTERVAL')
 HTTP_PORT     = cfg.getint('MESHTASTIC', 'HTTP_PORT', fallback=8000)
 MESH_PORT     = cfg['MESHTASTIC']['PORT']
+TELEMETRY_MAX_BYTES  = cfg.getint('MESHTASTIC', 'TELEMETRY_MAX_BYTES', fallback=DEFAULT_MAX_PAYLOAD_BYTES)
+TELEMETRY_MAX_CHUNKS = cfg.getint('MESHTASTIC', 'TELEMETRY_MAX_CHUNKS', fallback=3)
+TX_QUEUE_SIZE = cfg.getint('MESHTASTIC', 'TX_QUEUE_SIZE', fallback=100)
+TX_TIMEOUT    = cfg.getfloat('MESHTASTIC', 'TX_TIMEOUT', fallback=10)
+# Socket Unix per read_serial (vuoto = disabilitato); l'endpoint HTTP resta attivo
+IPC_SOCKET    = cfg.get('MESHTASTIC', 'IPC_SOCKET', fallback='')
+IPC_MAX_FRAME = 4096
+# Stato dell'orologio letto da read_serial per correggere le punzonature (stesso default)
+CLOCK_STATE_FILE = cfg.get('TIME_SYNC', 'CLOCK_STATE_FILE', fallback=os.path.join(REPO_ROOT, 'clock_state.json'))
 logging.info(f"[mesh] NEIGH_INFO_INTERVAL = {NEIGH_INTERVAL}s, HTTP_PORT = {HTTP_PORT}")
 
 # Stato globale
 mesh: SerialInterface = None
-neighbors = {}
+# Vicini con scadenza, numero massimo e RSSI/SNR mediati (EWMA)
+neighbors = NeighborTable(
+    max_entries=cfg.getint('MESHTASTIC', 'NEIGH_MAX_ENTRIES', fallback=64),
+    ttl=cfg.getfloat('MESHTASTIC', 'NEIGH_TTL', fallback=1800),
+    alpha=cfg.getfloat('MESHTASTIC', 'NEIGH_EWMA_ALPHA', fallback=0.3)
+)
 node_name = None
 node_pkey = None
+# Impostato da edge_runtime: identità del nodo condivisa con gli altri servizi
+identity_provider = None
+# Coda di trasmissione: un solo task scrive sulla seriale, in ordine di arrivo
+tx_queue: asyncio.Queue = None
+tx_stats = {'queued': 0, 'sent': 0, 'errors': 0, 'rejected': 0}
+ipc_stats = {'connections': 0, 'frames': 0, 'errors': 0}
+ipc_server = None
+# Sincronizzazione oraria con i receiver (sezione [TIME_SYNC], ENABLED)
+time_sync: TimeSyncManager = None
+main_loop: asyncio.AbstractEventLoop = None
+TIME_SYNC_PREFIXES = ('2;', '3;', '4;')  # TIME_SYNC, TIME_SYNC_REQUEST, TIME_SYNC_RESPONSE
 
 # Funzione per leggere nome e pkey del nodo dal DB
 def get_node_credentials():
+    if identity_provider:
+        return identity_provider()
     db_conf = {
         'host': cfg['DATABASE']['host'],
         'user': cfg['DATABASE']['user'],
@@ -181,11 +178,12 @@ def on_receive(pkt, interface):
     peer = pkt.get('from')
     if peer is None:
         return
-    neighbors[peer] = {
-        'rssi': pkt.get('rssi'),
-        'snr': pkt.get('snr'),
-        'seen': time.time()
-    }
+    # I pacchetti Meshtastic riportano rxRssi/rxSnr
+    neighbors.update(
+        peer,
+        pkt.get('rxRssi', pkt.get('rssi')),
+        pkt.get('rxSnr', pkt.get('snr'))
+    )
     raw = pkt.get('decoded', pkt)
     text = raw.get('payload') or raw.get('text') or str(pkt)
     logging.info(f"[mesh] pacchetto ricevuto da {peer}: {text}")
@@ -202,50 +200,159 @@ def on_receive(pkt, interface):
         peer_id=str(peer)
     )
 
+    sync_text = text.decode('utf-8', 'replace') if isinstance(text, bytes) else text
+    if time_sync and isinstance(sync_text, str) and sync_text[:2] in TIME_SYNC_PREFIXES:
+        hop_start, hop_limit = pkt.get('hopStart'), pkt.get('hopLimit')
+        hops = hop_start - hop_limit if isinstance(hop_start, int) and isinstance(hop_limit, int) else None
+        time_sync.process_time_sync_message(sync_text, hops=hops)
+
+# Task di trasmissione: sendText è bloccante (seriale) e gira in un thread,
+# così il loop asyncio resta libero di accettare richieste
+async def transmitter():
+    while True:
+        payload, msg_type, done = await tx_queue.get()
+        try:
+            await asyncio.to_thread(mesh.sendText, payload)
+            tx_stats['sent'] += 1
+            log_to_db(direction="send", msg_type=msg_type, payload=payload, peer_id='')
+            if not done.done():
+                done.set_result(True)
+        except Exception as ex:
+            tx_stats['errors'] += 1
+            logging.error(f"[mesh] errore invio: {ex}")
+            log_to_db(direction="send", msg_type=msg_type, payload=f"ERROR:{ex}|{payload}", peer_id='')
+            if not done.done():
+                done.set_exception(ex)
+        finally:
+            tx_queue.task_done()
+
+def submit(payload: str, msg_type: int) -> asyncio.Future:
+    """
+    Accoda un payload per la trasmissione e restituisce un future che si
+    completa quando il messaggio è stato passato alla radio.
+    Solleva asyncio.QueueFull se la coda è piena.
+    """
+    if mesh is None or tx_queue is None:
+        raise RuntimeError("Interfaccia Meshtastic non disponibile")
+    done = asyncio.get_running_loop().create_future()
+    try:
+        tx_queue.put_nowait((payload, msg_type, done))
+    except asyncio.QueueFull:
+        tx_stats['rejected'] += 1
+        raise
+    tx_stats['queued'] += 1
+    return done
+
+async def send_and_wait(payload: str, msg_type: int):
+    """Accoda e attende l'invio; errori come HTTPException per gli endpoint"""
+    try:
+        done = submit(payload, msg_type)
+    except asyncio.QueueFull:
+        raise HTTPException(status_code=503, detail="Coda di trasmissione piena")
+    except RuntimeError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    try:
+        await asyncio.wait_for(asyncio.shield(done), timeout=TX_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Il messaggio resta in coda e verrà comunque inviato
+        raise HTTPException(status_code=504, detail="Timeout invio sulla mesh")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+def payload_msg_type(payload: str) -> int:
+    """Tipo di messaggio dal primo campo 'tipo;…', -1 se non numerico"""
+    try:
+        return int(payload.split(";", 1)[0])
+    except ValueError:
+        return -1
+
+# --- Trasporto locale su socket Unix ---
+# Frame: lunghezza (4 byte big-endian) + payload UTF-8 'tipo;campo1;…'.
+# Risposta con lo stesso formato: 'OK' dopo il passaggio alla radio,
+# oppure 'ERR <codice> <dettaglio>' con i codici dell'endpoint HTTP.
+def ipc_frame(text: str) -> bytes:
+    data = text.encode('utf-8')
+    return struct.pack('>I', len(data)) + data
+
+async def handle_ipc(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    ipc_stats['connections'] += 1
+    try:
+        while True:
+            try:
+                header = await reader.readexactly(4)
+            except asyncio.IncompleteReadError:
+                break
+            length, = struct.unpack('>I', header)
+            if length > IPC_MAX_FRAME:
+                ipc_stats['errors'] += 1
+                writer.write(ipc_frame(f"ERR 413 frame di {length} byte"))
+                await writer.drain()
+                break
+            payload = (await reader.readexactly(length)).decode('utf-8')
+            ipc_stats['frames'] += 1
+            try:
+                await send_and_wait(payload, payload_msg_type(payload))
+                reply = "OK"
+            except HTTPException as e:
+                ipc_stats['errors'] += 1
+                reply = f"ERR {e.status_code} {e.detail}"
+            writer.write(ipc_frame(reply))
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, UnicodeDecodeError) as e:
+        ipc_stats['errors'] += 1
+        logging.warning(f"[mesh] connessione IPC interrotta: {e}")
+    finally:
+        writer.close()
+
+async def start_ipc_server():
+    global ipc_server
+    if not IPC_SOCKET:
+        return
+    if os.path.exists(IPC_SOCKET):
+        # Socket lasciato da un'esecuzione precedente
+        os.unlink(IPC_SOCKET)
+    ipc_server = await asyncio.start_unix_server(handle_ipc, path=IPC_SOCKET)
+    os.chmod(IPC_SOCKET, 0o660)
+    logging.info(f"[mesh] Socket IPC in ascolto su {IPC_SOCKET}")
+
 # Invia telemetria periodicamente
-def send_telemetry():
+async def send_telemetry():
     if mesh is None:
         return
-    parts = [
+    header = [
         str(MessageType.TELEMETRY.value),
         str(time.time()),
         node_name or '',
         node_pkey or ''
     ]
-    for nid, vals in neighbors.items():
-        parts.append(f"{nid},{vals['rssi']},{vals['snr']},{vals['seen']}")
-    payload = ";".join(parts)
+    ranked = neighbors.ranked()
+    # Un messaggio per pacchetto LoRa, vicini con SNR migliore per primi
+    payloads = build_telemetry_payloads(header, ranked, TELEMETRY_MAX_BYTES, TELEMETRY_MAX_CHUNKS)
 
-    try:
-        mesh.sendText(payload)
-        logging.info(f"[mesh] telemetria inviata: {len(neighbors)} vicini")
-        log_to_db(
-            direction="send",
-            msg_type=MessageType.TELEMETRY.value,
-            payload=payload,
-            peer_id=''
-        )
-    except Exception as ex:
-        logging.error(f"[mesh] errore invio telemetria: {ex}")
-        log_to_db(
-            direction="send",
-            msg_type=MessageType.TELEMETRY.value,
-            payload=f"ERROR:{ex}|{payload}",
-            peer_id=''
-        )
+    pending = []
+    for payload in payloads:
+        try:
+            pending.append(submit(payload, MessageType.TELEMETRY.value))
+        except asyncio.QueueFull:
+            logging.warning("[mesh] coda di trasmissione piena, telemetria rimandata")
+            break
+    # Gli errori di invio sono già registrati dal transmitter
+    await asyncio.gather(*pending, return_exceptions=True)
+    sent = sum(payload.count(';') - 3 for payload in payloads[:len(pending)])
+    logging.info(f"[mesh] telemetria inviata: {sent}/{len(ranked)} vicini in {len(pending)} messaggi")
 
-# Thread di telemetria
-def telemetry_loop():
+# Task di telemetria
+async def telemetry_loop():
     while True:
-        send_telemetry()
-        time.sleep(NEIGH_INTERVAL)
+        try:
+            await send_telemetry()
+        except Exception as ex:
+            logging.error(f"[mesh] errore ciclo telemetria: {ex}")
+        await asyncio.sleep(NEIGH_INTERVAL)
 
-# Evento di avvio del servizio
-@app.on_event("startup")
-def startup():
-    global mesh, node_name, node_pkey
-    node_name, node_pkey = get_node_credentials()
-    logging.info(f"[mesh] Nodo: {node_name}, pkey: {node_pkey}")
+def open_mesh():
+    """Apre la SerialInterface con pre-check del lock e tentativi ripetuti (bloccante)"""
+    global mesh
     try:
         fd = os.open(MESH_PORT, os.O_RDONLY | os.O_NONBLOCK)
         try:
@@ -274,57 +381,112 @@ def startup():
                 logging.critical(f"[mesh] Impossibile aprire la porta dopo {max_retries} tentativi, esco.")
                 raise
             time.sleep(retry_delay)
+
+def queue_time_sync(payload: str) -> bool:
+    """send_message_callback di TimeSyncManager: chiamato dai suoi thread, accoda senza attendere"""
+    if main_loop is None:
+        return False
+
+    def enqueue():
+        try:
+            done = submit(payload, payload_msg_type(payload))
+        except (asyncio.QueueFull, RuntimeError) as e:
+            logging.warning(f"[mesh] messaggio di time sync non accodato: {e}")
+            return
+        # Nessuno attende l'esito: l'errore è già nel log del transmitter
+        done.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    main_loop.call_soon_threadsafe(enqueue)
+    return True
+
+def start_time_sync():
+    """
+    Avvia TimeSyncManager in modalità reader: stima l'offset dai messaggi dei
+    receiver, corregge l'orologio e pubblica il ClockModel in CLOCK_STATE_FILE
+    per la correzione delle punzonature in read_serial.
+    """
+    global time_sync
+    if not cfg.getboolean('TIME_SYNC', 'ENABLED', fallback=False):
+        return
+    time_sync = TimeSyncManager(
+        node_name or 'radiocontrol', 'reader',
+        max_drift=cfg.getfloat('TIME_SYNC', 'MAX_DRIFT', fallback=15.0),
+        clock_mode=cfg.get('TIME_SYNC', 'CLOCK_MODE', fallback='slew'),
+        max_slew=cfg.getfloat('TIME_SYNC', 'MAX_SLEW', fallback=10.0),
+        clock_state_file=CLOCK_STATE_FILE
+    )
+    time_sync.send_message_callback = queue_time_sync
+    time_sync.start()
+    logging.info(f"[mesh] Time sync attivo ({time_sync.clock_mode}), stato orologio in {CLOCK_STATE_FILE}")
+
+# Evento di avvio del servizio
+@app.on_event("startup")
+async def startup():
+    global node_name, node_pkey, tx_queue, main_loop
+    node_name, node_pkey = await asyncio.to_thread(get_node_credentials)
+    logging.info(f"[mesh] Nodo: {node_name}, pkey: {node_pkey}")
+    log_writer.start()
+    await asyncio.to_thread(open_mesh)
+    tx_queue = asyncio.Queue(maxsize=TX_QUEUE_SIZE)
+    main_loop = asyncio.get_running_loop()
+    start_time_sync()
+    app.state.tasks = [
+        asyncio.create_task(transmitter()),
+        asyncio.create_task(telemetry_loop()),
+    ]
+    await start_ipc_server()
     logging.info(f"[mesh] Service avviato; telemetria ogni {NEIGH_INTERVAL}s")
-    threading.Thread(target=telemetry_loop, daemon=True).start()
 
 # Evento di arresto del servizio
 @app.on_event("shutdown")
-def shutdown_event():
+async def shutdown_event():
+    if ipc_server:
+        ipc_server.close()
+        if os.path.exists(IPC_SOCKET):
+            os.unlink(IPC_SOCKET)
+    if time_sync:
+        time_sync.stop()
+    for task in getattr(app.state, 'tasks', []):
+        task.cancel()
     logging.info("[mesh] Chiusura serial interface in shutdown event")
     if mesh:
         mesh.close()
+    # Scrive le righe ancora in coda
+    log_writer.stop()
 
 
 @app.post("/send_raw")
-def send_raw(payload: str = Body(..., media_type="text/plain")):
+async def send_raw(payload: str = Body(..., media_type="text/plain")):
     """
     Riceve un payload testuale 'tipo;campo1;campo2;…' e lo manda in mesh + DB.
     """
-    # Invia sulla mesh
-    mesh.sendText(payload)
-    # Estrai msg_type dal primo campo
-    try:
-        mt = int(payload.split(";", 1)[0])
-    except:
-        mt = -1
-    # Log su DB
-    log_to_db(
-        direction="send",
-        msg_type=mt,
-        payload=payload,
-        peer_id=""
-    )
+    await send_and_wait(payload, payload_msg_type(payload))
     return {"status": "sent"}
 
 # Endpoint HTTP per invio payload generici
 @app.post("/send_payload")
-def send_payload(payload: Payload):
+async def send_payload(payload: Payload):
     """Endpoint per inviare un payload JSON generico sulla mesh."""
+    body = json.dumps(payload.dict())
+    logging.info(f"[mesh] invio payload HTTP: {body}")
     try:
-        body = json.dumps(payload.dict())
-        logging.info(f"[mesh] invio payload HTTP: {body}")
-        mesh.sendText(body)
-        # Log su DB
-        log_to_db(
-            direction="send",
-            msg_type=-1,
-            payload=body,
-            peer_id=''
-        )
-        return {"status": "sent"}
-    except Exception as e:
-        logging.error(f"[mesh] Errore invio payload: {e}, payload: {payload.json()}")
-        raise HTTPException(status_code=500, detail=str(e))
+        await send_and_wait(body, -1)
+    except HTTPException as e:
+        logging.error(f"[mesh] Errore invio payload: {e.detail}, payload: {payload.json()}")
+        raise
+    return {"status": "sent"}
+
+@app.get("/stats")
+async def stats():
+    """Stato della coda di trasmissione, del log su DB e dei vicini"""
+    return {
+        'tx_queue_depth': tx_queue.qsize() if tx_queue else 0,
+        'tx': dict(tx_stats),
+        'ipc': dict(ipc_stats),
+        'db_log': log_writer.get_stats(),
+        'neighbors': neighbors.get_stats(),
+        'time_sync': time_sync.get_time_status() if time_sync else None,
+    }
 
 # Avvio dell'applicazione
 if __name__ == "__main__":
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# neighbor_table.py
+"""
+Tabella dei vicini Meshtastic con memoria limitata e scadenza.
+
+- ogni peer ha RSSI/SNR mediati con EWMA e l'istante dell'ultimo pacchetto;
+- i peer non sentiti da `ttl` secondi vengono rimossi;
+- oltre `max_entries` viene rimosso il peer sentito meno di recente;
+- la telemetria viene divisa in messaggi che stanno in un pacchetto LoRa,
+  con i vicini migliori (SNR più alto) per primi.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# Byte utili di un messaggio di testo Meshtastic, con margine per l'header protobuf
+DEFAULT_MAX_PAYLOAD_BYTES = 200
+
+
+class NeighborTable:
+    """Vicini in ordine di ultimo ascolto: scadenza e rimozione partono dal più vecchio"""
+
+    def __init__(self, max_entries: int = 64, ttl: float = 1800, alpha: float = 0.3):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.alpha = alpha
+        self._entries: "OrderedDict[Any, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'updates': 0, 'expired': 0, 'evicted': 0}
+
+    def _ewma(self, previous: Optional[float], value: Optional[float]) -> Optional[float]:
+        if value is None:
+            return previous
+        if previous is None:
+            return float(value)
+        return self.alpha * value + (1 - self.alpha) * previous
+
+    def update(self, peer, rssi: Optional[float], snr: Optional[float], now: Optional[float] = None):
+        """Registra un pacchetto ricevuto da peer (O(1))"""
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.pop(peer, None)
+            if entry is None:
+                entry = {'rssi': None, 'snr': None, 'count': 0}
+            entry['rssi'] = self._ewma(entry['rssi'], rssi)
+            entry['snr'] = self._ewma(entry['snr'], snr)
+            entry['seen'] = now
+            entry['count'] += 1
+            self._entries[peer] = entry
+            self._stats['updates'] += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def expire(self, now: Optional[float] = None) -> int:
+        """Rimuove i vicini non sentiti da ttl secondi"""
+        now = time.time() if now is None else now
+        removed = 0
+        with self._lock:
+            while self._entries:
+                peer, entry = next(iter(self._entries.items()))
+                if now - entry['seen'] <= self.ttl:
+                    break
+                self._entries.popitem(last=False)
+                removed += 1
+            self._stats['expired'] += removed
+        return removed
+
+    def ranked(self, now: Optional[float] = None) -> List[tuple]:
+        """Vicini validi come (peer, entry), SNR migliore per primo"""
+        self.expire(now)
+        with self._lock:
+            items = [(peer, dict(entry)) for peer, entry in self._entries.items()]
+        items.sort(key=lambda item: item[1]['snr'] if item[1]['snr'] is not None else float('-inf'),
+                   reverse=True)
+        return items
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        stats['max_entries'] = self.max_entries
+        stats['ttl'] = self.ttl
+        return stats
+
+
+def format_neighbor(peer, entry: Dict[str, Any]) -> str:
+    """Campo 'id,rssi,snr,seen' della telemetria, con valori arrotondati per risparmiare byte"""
+    rssi = '' if entry['rssi'] is None else f"{entry['rssi']:.0f}"
+    snr = '' if entry['snr'] is None else f"{entry['snr']:.1f}"
+    return f"{peer},{rssi},{snr},{int(entry['seen'])}"
+
+
+def build_telemetry_payloads(header: List[str], neighbors: List[tuple],
+                             max_bytes: int = DEFAULT_MAX_PAYLOAD_BYTES, max_chunks: int = 3) -> List[str]:
+    """
+    Divide i vicini (già ordinati per priorità) in messaggi 'header;vicino;vicino…'
+    di al più max_bytes byte. Oltre max_chunks messaggi i vicini meno prioritari
+    vengono tralasciati. Restituisce sempre almeno un messaggio (solo header).
+    """
+    prefix = ";".join(header)
+    payloads: List[str] = []
+    current = prefix
+    for peer, entry in neighbors:
+        field = format_neighbor(peer, entry)
+        if len(f"{prefix};{field}".encode('utf-8')) > max_bytes:
+            # Campo troppo lungo per qualunque messaggio
+            continue
+        candidate = f"{current};{field}"
+        if len(candidate.encode('utf-8')) <= max_bytes:
+            current = candidate
+            continue
+        payloads.append(current)
+        if len(payloads) >= max_chunks:
+            return payloads
+        current = f"{prefix};{field}"
+    if current != prefix or not payloads:
+        payloads.append(current)
+    return payloads[:max_chunks]
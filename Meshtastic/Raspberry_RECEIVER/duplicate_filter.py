@@ -0,0 +1,105 @@
+import logging
+import threading
+from collections import OrderedDict
+
+# Numero di chiavi ricordate di default: copre ampiamente una gara intera
+DEFAULT_MAX_ENTRIES = 50000
+
+
+class DuplicateFilter:
+    """
+    Filtro duplicati in memoria con politica LRU e dimensione limitata.
+
+    Serve a scartare le punzonature ritrasmesse dalla mesh o dai retry dei
+    lettori prima di toccare il database. Le chiavi sono tuple di stringhe,
+    es. (pkey, record_id) oppure (control, card_number, punch_time).
+    Il filtro è esatto (nessun falso positivo): una chiave viene dimenticata
+    solo quando esce dalla finestra LRU, e in quel caso decide il DB.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, name="punches"):
+        self.max_entries = max_entries
+        self.name = name
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'checks': 0,
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'loaded_from_db': 0,
+        }
+
+    @staticmethod
+    def make_key(*fields):
+        """Normalizza i campi in una tupla di stringhe confrontabile"""
+        return tuple('' if f is None else str(f).strip() for f in fields)
+
+    def check_and_add(self, key):
+        """Ritorna True se la chiave era già presente (duplicato), altrimenti la registra"""
+        with self._lock:
+            self._stats['checks'] += 1
+            if key in self._keys:
+                self._keys.move_to_end(key)
+                self._stats['hits'] += 1
+                return True
+            self._stats['misses'] += 1
+            self._add_locked(key)
+            return False
+
+    def add(self, key):
+        """Registra una chiave senza contarla come controllo"""
+        with self._lock:
+            self._add_locked(key)
+
+    def discard(self, key):
+        """Dimentica una chiave, es. se il salvataggio nel DB non è andato a buon fine"""
+        with self._lock:
+            self._keys.pop(key, None)
+
+    def _add_locked(self, key):
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_entries:
+            self._keys.popitem(last=False)
+            self._stats['evictions'] += 1
+
+    def load_from_db(self, mysql_pool, columns):
+        """
+        Ricostruisce il filtro dalle ultime righe di punches.
+        `columns` sono le colonne che formano la chiave, nello stesso ordine usato da make_key.
+        """
+        cnx = None
+        loaded = 0
+        try:
+            cnx = mysql_pool.get_connection()
+            cursor = cnx.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(columns)} FROM punches ORDER BY id DESC LIMIT %s",
+                (self.max_entries,)
+            )
+            rows = cursor.fetchall()
+            cursor.close()
+            with self._lock:
+                # Le righe arrivano dalla più recente: inserendole al contrario
+                # le più recenti restano in fondo alla LRU
+                for row in reversed(rows):
+                    self._add_locked(self.make_key(*row))
+                loaded = len(rows)
+                self._stats['loaded_from_db'] += loaded
+            logging.info(f"Filtro duplicati '{self.name}' ricostruito dal DB: {loaded} chiavi")
+        except Exception as e:
+            logging.error(f"Errore durante la ricostruzione del filtro duplicati '{self.name}': {e}")
+        finally:
+            if cnx and cnx.is_connected():
+                cnx.close()
+        return loaded
+
+    def get_stats(self):
+        """Restituisce le statistiche del filtro"""
+        with self._lock:
+            stats = self._stats.copy()
+            stats['size'] = len(self._keys)
+        stats['max_entries'] = self.max_entries
+        stats['hit_rate'] = round(stats['hits'] / stats['checks'] * 100, 2) if stats['checks'] else 0.0
+        return stats
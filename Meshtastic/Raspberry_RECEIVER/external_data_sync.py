@@ -2,25 +2,43 @@ import logging
 import time
 import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import mysql.connector
 from datetime import datetime
 
+from punches_schema import ensure_punches_unique_key
+
 # Nome del file per salvare lo stato della sincronizzazione (ultimo ID processato per ogni race_group)
 STATUS_FILE_DEFAULT = 'external_sync_status.json'
+DEFAULT_BATCH_SIZE = 1000
 
-class ExternalDBSync:
-    def __init__(self, external_db_config, local_mysql_pool, status_file_path=None):
-        self.external_db_config = external_db_config
-        self.local_mysql_pool = local_mysql_pool
-        self.status_file = status_file_path or os.path.join(os.path.dirname(__file__), STATUS_FILE_DEFAULT)
-        self.last_ids_processed = self._load_status()
-        self.table_name = external_db_config.get('table_name', 'radiocontrol')
-        logging.info(f"ExternalDBSync inizializzato. Tabella esterna: {self.table_name}, File di stato: {self.status_file}")
+# Per probe e blocchi efficienti il DB esterno deve avere un indice su (race_group, id):
+# CREATE INDEX idx_race_group_id ON radiocontrol (race_group, id);
 
-    def _load_status(self):
+class SyncCheckpointStore:
+    """
+    Checkpoint della sincronizzazione (ultimo ID processato per ogni race_group).
+
+    Gli aggiornamenti restano in memoria e vengono scritti insieme quando sono
+    passati `flush_interval` secondi o si sono accumulati `max_pending` aggiornamenti.
+    La scrittura è atomica (file temporaneo + fsync + rename): un'interruzione di
+    corrente lascia il file precedente o quello nuovo, mai uno troncato.
+    """
+
+    def __init__(self, path, flush_interval=5.0, max_pending=20):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._ids = self._load()
+        self._pending = 0
+        self._last_flush = time.monotonic()
+
+    def _load(self):
         try:
-            if os.path.exists(self.status_file):
-                with open(self.status_file, 'r') as f:
+            if os.path.exists(self.path):
+                with open(self.path, 'r') as f:
                     status = json.load(f)
                     logging.info(f"Stato di sincronizzazione caricato: {status}")
                     return {int(k): v for k, v in status.items()} # Assicura che race_group sia int
@@ -29,15 +47,101 @@ class ExternalDBSync:
             logging.error(f"Errore durante il caricamento dello stato di sincronizzazione: {e}")
             return {}
 
-    def _save_status(self):
+    def get(self, race_group_id, default=0):
+        with self._lock:
+            return self._ids.get(race_group_id, default)
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._ids)
+
+    def update(self, race_group_id, last_id):
+        """Registra il nuovo ultimo ID; scrive su disco solo se è il momento"""
+        with self._lock:
+            self._ids[race_group_id] = last_id
+            self._pending += 1
+            due = (self._pending >= self.max_pending or
+                   time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Scrive atomicamente i checkpoint se ci sono aggiornamenti pendenti"""
+        with self._lock:
+            if not self._pending:
+                return
+            data = json.dumps(self._ids)
+            pending = self._pending
+            tmp_path = f"{self.path}.tmp"
+            try:
+                with open(tmp_path, 'w') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self._fsync_dir()
+                self._pending = 0
+                self._last_flush = time.monotonic()
+                logging.info(f"Stato di sincronizzazione salvato ({pending} aggiornamenti): {data}")
+            except Exception as e:
+                logging.error(f"Errore durante il salvataggio dello stato di sincronizzazione: {e}")
+
+    def _fsync_dir(self):
+        # Rende persistente anche il rename (non supportato su Windows)
         try:
-            with open(self.status_file, 'w') as f:
-                json.dump(self.last_ids_processed, f)
-            logging.info(f"Stato di sincronizzazione salvato: {self.last_ids_processed}")
-        except Exception as e:
-            logging.error(f"Errore durante il salvataggio dello stato di sincronizzazione: {e}")
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+
+class ExternalDBSync:
+    def __init__(self, external_db_config, local_mysql_pool, status_file_path=None):
+        self.external_db_config = external_db_config
+        self.local_mysql_pool = local_mysql_pool
+        self.status_file = status_file_path or os.path.join(os.path.dirname(__file__), STATUS_FILE_DEFAULT)
+        self.checkpoints = SyncCheckpointStore(
+            self.status_file,
+            flush_interval=float(external_db_config.get('checkpoint_flush_interval', 5)),
+            max_pending=int(external_db_config.get('checkpoint_max_pending', 20))
+        )
+        self.table_name = external_db_config.get('table_name', 'radiocontrol')
+        # Righe lette e scritte per blocco: limita la memoria durante i recuperi lunghi
+        self.batch_size = int(external_db_config.get('batch_size', DEFAULT_BATCH_SIZE))
+        # Elenco opzionale di race_group (separati da virgola); se assente vengono scoperti dal DB esterno
+        self.configured_race_groups = [
+            int(rg) for rg in str(external_db_config.get('race_groups', '')).split(',') if rg.strip()
+        ]
+        # Worker concorrenti per race_group (1 = sincronizzazione sequenziale)
+        self.max_workers = max(1, int(external_db_config.get('max_workers', 1)))
+        self._executor = None
+        # Connessioni persistenti al DB esterno, una per thread
+        self._thread_local = threading.local()
+        self._ext_connections = []
+        # Protegge le statistiche e le connessioni esterne
+        self._lock = threading.Lock()
+        # Throughput dell'ultima sincronizzazione di ogni race_group
+        self.group_stats = {}
+        logging.info(f"ExternalDBSync inizializzato. Tabella esterna: {self.table_name}, File di stato: {self.status_file}")
 
     def _get_external_db_connection(self):
+        """
+        Restituisce la connessione persistente al DB esterno del thread corrente,
+        riaprendola se caduta. Ogni worker della modalità parallela ha la sua.
+        """
+        cnx = getattr(self._thread_local, 'ext_cnx', None)
+        if cnx is not None:
+            try:
+                cnx.ping(reconnect=True, attempts=2, delay=1)
+                return cnx
+            except mysql.connector.Error as err:
+                logging.warning(f"Connessione al DB esterno persa, riapertura: {err}")
+                self._close_external_connection()
         try:
             cnx = mysql.connector.connect(
                 host=self.external_db_config['host'],
@@ -45,112 +149,219 @@ class ExternalDBSync:
                 user=self.external_db_config['user'],
                 password=self.external_db_config['password'],
                 database=self.external_db_config['database'],
-                charset='utf8mb4'
+                charset='utf8mb4',
+                autocommit=True # Letture sempre aggiornate senza transazioni lunghe aperte
             )
             logging.info(f"Connesso al DB esterno {self.external_db_config['host']}/{self.external_db_config['database']}")
+            self._thread_local.ext_cnx = cnx
+            with self._lock:
+                self._ext_connections.append(cnx)
             return cnx
         except mysql.connector.Error as err:
             logging.error(f"Errore di connessione al DB esterno: {err}")
             return None
 
+    def _close_external_connection(self):
+        """Chiude la connessione esterna del thread corrente"""
+        cnx = getattr(self._thread_local, 'ext_cnx', None)
+        if cnx is not None:
+            self._thread_local.ext_cnx = None
+            with self._lock:
+                if cnx in self._ext_connections:
+                    self._ext_connections.remove(cnx)
+            try:
+                cnx.close()
+                logging.info("Connessione al DB esterno chiusa.")
+            except Exception:
+                pass
+
+    def close(self):
+        """Ferma i worker, salva i checkpoint e chiude tutte le connessioni persistenti al DB esterno"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self.checkpoints.flush()
+        with self._lock:
+            connections, self._ext_connections = self._ext_connections, []
+        for cnx in connections:
+            try:
+                cnx.close()
+            except Exception:
+                pass
+        self._thread_local = threading.local()
+        logging.info("Connessioni al DB esterno chiuse.")
+
+    def _discover_race_groups(self, ext_cursor):
+        """
+        Elenca i race_group da sincronizzare.
+        Se configurati esplicitamente usa quelli, altrimenti li scopre con una
+        scansione "a salti" sull'indice di race_group (una probe per gruppo)
+        invece di un SELECT DISTINCT sull'intera tabella.
+        """
+        if self.configured_race_groups:
+            return list(self.configured_race_groups)
+
+        race_groups = []
+        current = None
+        while True:
+            if current is None:
+                ext_cursor.execute(
+                    f"SELECT MIN(race_group) AS race_group FROM {self.table_name} WHERE race_group IS NOT NULL"
+                )
+            else:
+                ext_cursor.execute(
+                    f"SELECT MIN(race_group) AS race_group FROM {self.table_name} WHERE race_group > %s",
+                    (current,)
+                )
+            row = ext_cursor.fetchone()
+            if not row or row['race_group'] is None:
+                break
+            current = row['race_group']
+            race_groups.append(current)
+        return race_groups
+
+    def _sync_race_group(self, ext_cursor, local_cnx, race_group_id):
+        """Sincronizza un race_group a blocchi di batch_size righe. Ritorna le righe inserite."""
+        started = time.monotonic()
+        last_id = self.checkpoints.get(race_group_id)
+
+        # Probe sull'indice (race_group, id): se non c'è nulla di nuovo non leggiamo righe
+        ext_cursor.execute(
+            f"SELECT MAX(id) AS max_id FROM {self.table_name} WHERE race_group = %s",
+            (race_group_id,)
+        )
+        row = ext_cursor.fetchone()
+        max_id = row['max_id'] if row else None
+        if max_id is None or max_id <= last_id:
+            logging.debug(f"race_group {race_group_id}: nessuna novità (ultimo ID {last_id})")
+            return 0
+
+        logging.info(f"Sincronizzazione per race_group {race_group_id}, ultimo ID processato: {last_id}, ID massimo remoto: {max_id}")
+        query = (
+            f"SELECT id, control, card_number, punch_time, timestamp as external_timestamp "
+            f"FROM {self.table_name} "
+            f"WHERE race_group = %s AND id > %s AND id <= %s "
+            f"ORDER BY id ASC LIMIT %s"
+        )
+        # INSERT IGNORE: se il processo cade dopo il commit locale ma prima di salvare
+        # lo stato, il blocco riletto viene scartato dalla chiave univoca di punches
+        insert_query = (
+            "INSERT IGNORE INTO punches (timestamp, name, pkey, record_id, control, card_number, punch_time, raw, source_event_id) "
+            "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
+        )
+        inserted = 0
+        rows_read = 0
+        local_cursor = local_cnx.cursor()
+        try:
+            while last_id < max_id:
+                ext_cursor.execute(query, (race_group_id, last_id, max_id, self.batch_size))
+                rows = ext_cursor.fetchall()
+                if not rows:
+                    break
+
+                rows_to_insert = [(
+                    row['external_timestamp'], # timestamp (data/ora evento nel DB esterno)
+                    None, # name (da definire, forse race_group_id o un nome evento)
+                    None, # pkey (da definire)
+                    row['id'],       # record_id (ID originale dal DB esterno)
+                    row['control'],
+                    row['card_number'],
+                    row['punch_time'],
+                    f"EXT_DB_SYNC;RG={race_group_id};ID={row['id']}", # raw
+                    race_group_id # source_event_id
+                ) for row in rows]
+
+                local_cursor.executemany(insert_query, rows_to_insert)
+                local_cnx.commit()
+                inserted += local_cursor.rowcount
+                rows_read += len(rows)
+
+                # Progresso registrato per blocco: dopo un crash si riparte dall'ultimo
+                # checkpoint scritto, i blocchi riletti sono scartati da INSERT IGNORE
+                last_id = rows[-1]['id']
+                self.checkpoints.update(race_group_id, last_id)
+                logging.debug(f"race_group {race_group_id}: blocco di {len(rows)} righe fino a ID {last_id}")
+
+                if len(rows) < self.batch_size:
+                    break
+        finally:
+            local_cursor.close()
+
+        elapsed = time.monotonic() - started
+        rows_per_sec = rows_read / elapsed if elapsed > 0 else 0.0
+        with self._lock:
+            self.group_stats[race_group_id] = {
+                'rows_read': rows_read,
+                'rows_inserted': inserted,
+                'seconds': round(elapsed, 3),
+                'rows_per_sec': round(rows_per_sec, 1),
+            }
+        logging.info(f"Inseriti {inserted} nuovi punches per race_group {race_group_id} nel DB locale "
+                     f"({rows_read} righe lette in {elapsed:.2f}s, {rows_per_sec:.1f} righe/s).")
+        return inserted
+
+    def _sync_race_group_worker(self, race_group_id):
+        """Task di un worker parallelo: usa la propria connessione esterna e locale"""
+        ext_cnx = self._get_external_db_connection()
+        if not ext_cnx:
+            return 0
+        local_cnx = None
+        ext_cursor = None
+        try:
+            ext_cursor = ext_cnx.cursor(dictionary=True, buffered=True)
+            local_cnx = self.local_mysql_pool.get_connection()
+            return self._sync_race_group(ext_cursor, local_cnx, race_group_id)
+        except mysql.connector.Error:
+            self._close_external_connection()
+            raise
+        finally:
+            if ext_cursor is not None:
+                try:
+                    ext_cursor.close()
+                except mysql.connector.Error:
+                    pass
+            if local_cnx and local_cnx.is_connected():
+                local_cnx.close()
+
+    def _sync_parallel(self, race_groups):
+        """Sincronizza i race_group con al massimo max_workers worker concorrenti"""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ExtSync")
+        futures = {self._executor.submit(self._sync_race_group_worker, rg): rg for rg in race_groups}
+        total = 0
+        for future in as_completed(futures):
+            race_group_id = futures[future]
+            try:
+                total += future.result()
+            except mysql.connector.Error as err:
+                logging.error(f"Errore MySQL durante la sincronizzazione del race_group {race_group_id}: {err}")
+            except Exception as e:
+                logging.error(f"Errore generico durante la sincronizzazione del race_group {race_group_id}: {e}")
+        return total
+
     def sync_punches(self):
         logging.info("Avvio sincronizzazione punches da DB esterno...")
         ext_cnx = self._get_external_db_connection()
         if not ext_cnx:
-            return
+            return 0
 
         local_cnx = None
+        ext_cursor = None
         new_punches_count = 0
 
         try:
-            ext_cursor = ext_cnx.cursor(dictionary=True)
-            
-            # Ottieni tutti i race_group unici dalla tabella esterna
-            # O potremmo decidere di sincronizzare solo quelli per cui abbiamo già uno stato
-            # Per ora, prendiamo tutti i race_group presenti.
-            # Se la tabella è molto grande, questo potrebbe essere inefficiente.
-            # Sarebbe meglio avere una lista predefinita di race_group da sincronizzare o un modo per scoprirli.
-            # Per semplicità, per ora non interroghiamo i race_group distinti.
-            # Assumiamo che se un race_group ha dati, lo troveremo.
-
-            # Per ogni race_group di cui teniamo traccia (o per quelli nuovi che troviamo)
-            # Questo approccio non scopre nuovi race_group automaticamente.
-            # Per scoprire nuovi race_group, dovremmo fare una query tipo SELECT DISTINCT race_group FROM self.table_name
-            # e poi iterare. Per ora, semplifichiamo e assumiamo che i race_group da tracciare siano quelli
-            # già presenti in self.last_ids_processed o un default se è vuoto (es. event_id da config).
-            
-            # Se non ci sono race_group tracciati, potremmo usare un default da config.ini
-            # Per ora, se last_ids_processed è vuoto, non farà nulla.
-            # Modifichiamo per prendere un race_group di default se non ci sono stati.
-            
-            race_groups_to_sync = list(self.last_ids_processed.keys())
-            if not race_groups_to_sync and 'default_race_group_to_sync' in self.external_db_config:
-                 try:
-                     race_groups_to_sync.append(int(self.external_db_config['default_race_group_to_sync']))
-                 except ValueError:
-                     logging.warning("default_race_group_to_sync non è un intero valido.")
-            
-            # Per sincronizzare TUTTI i race_group, dovremmo prima fare:
-            # ext_cursor.execute(f"SELECT DISTINCT race_group FROM {self.table_name} WHERE race_group IS NOT NULL")
-            # race_groups_to_sync = [row['race_group'] for row in ext_cursor.fetchall()]
-            # Per ora, manteniamo la logica più semplice basata sugli ID già tracciati o un default.
-            # Se vuoi sincronizzare tutti gli eventi, la logica qui andrebbe espansa.
-            # Dato il tuo feedback "puoi anche scaricare i dati di tutti gli eventi", modifichiamo:
-
-            ext_cursor.execute(f"SELECT DISTINCT race_group FROM {self.table_name} WHERE race_group IS NOT NULL")
-            all_race_groups_in_external_db = [row['race_group'] for row in ext_cursor.fetchall()]
-            logging.info(f"Trovati race_group nel DB esterno: {all_race_groups_in_external_db}")
-
-            for race_group_id in all_race_groups_in_external_db:
-                last_id = self.last_ids_processed.get(race_group_id, 0)
-                logging.info(f"Sincronizzazione per race_group {race_group_id}, ultimo ID processato: {last_id}")
-
-                query = (
-                    f"SELECT id, control, card_number, punch_time, timestamp as external_timestamp "
-                    f"FROM {self.table_name} "
-                    f"WHERE race_group = %s AND id > %s "
-                    f"ORDER BY id ASC"
-                )
-                ext_cursor.execute(query, (race_group_id, last_id))
-                
-                rows_to_insert = []
-                max_id_in_batch = last_id
-
-                for row in ext_cursor:
-                    rows_to_insert.append((
-                        row['external_timestamp'], # timestamp (data/ora evento nel DB esterno)
-                        None, # name (da definire, forse race_group_id o un nome evento)
-                        None, # pkey (da definire)
-                        row['id'],       # record_id (ID originale dal DB esterno)
-                        row['control'],
-                        row['card_number'],
-                        row['punch_time'],
-                        f"EXT_DB_SYNC;RG={race_group_id};ID={row['id']}", # raw
-                        race_group_id # source_event_id
-                    ))
-                    if row['id'] > max_id_in_batch:
-                        max_id_in_batch = row['id']
-                
-                if rows_to_insert:
-                    local_cnx = self.local_mysql_pool.get_connection()
-                    local_cursor = local_cnx.cursor()
-                    
-                    # Assicurati che la tabella punches abbia la colonna source_event_id
-                    insert_query = (
-                        "INSERT INTO punches (timestamp, name, pkey, record_id, control, card_number, punch_time, raw, source_event_id) "
-                        "VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)"
-                    )
-                    local_cursor.executemany(insert_query, rows_to_insert)
-                    local_cnx.commit()
-                    new_punches_count += local_cursor.rowcount
-                    logging.info(f"Inseriti {local_cursor.rowcount} nuovi punches per race_group {race_group_id} nel DB locale.")
-                    local_cursor.close()
-                    if local_cnx and local_cnx.is_connected():
-                        local_cnx.close()
-                    
-                    self.last_ids_processed[race_group_id] = max_id_in_batch
-                    self._save_status()
-            
+            ext_cursor = ext_cnx.cursor(dictionary=True, buffered=True)
+            race_groups_to_sync = self._discover_race_groups(ext_cursor)
+            logging.debug(f"race_group da sincronizzare: {race_groups_to_sync}")
+
+            if self.max_workers > 1 and len(race_groups_to_sync) > 1:
+                new_punches_count = self._sync_parallel(race_groups_to_sync)
+            else:
+                for race_group_id in race_groups_to_sync:
+                    if local_cnx is None:
+                        local_cnx = self.local_mysql_pool.get_connection()
+                    new_punches_count += self._sync_race_group(ext_cursor, local_cnx, race_group_id)
+
             if new_punches_count > 0:
                  logging.info(f"Sincronizzazione completata. Totale nuovi punches inseriti: {new_punches_count}")
             else:
@@ -158,23 +369,79 @@ class ExternalDBSync:
 
         except mysql.connector.Error as err:
             logging.error(f"Errore MySQL durante la sincronizzazione: {err}")
+            # Connessione esterna in stato incerto: la riapriamo al prossimo ciclo
+            self._close_external_connection()
         except Exception as e:
             logging.error(f"Errore generico durante la sincronizzazione: {e}")
         finally:
-            if ext_cnx and ext_cnx.is_connected():
-                ext_cnx.close()
-                logging.info("Connessione al DB esterno chiusa.")
-            # local_cnx viene chiuso nel blocco try se aperto
+            if ext_cursor is not None:
+                try:
+                    ext_cursor.close()
+                except mysql.connector.Error:
+                    pass
+            if local_cnx and local_cnx.is_connected():
+                local_cnx.close()
+            # Un'unica scrittura del file di stato per ciclo
+            self.checkpoints.flush()
+        return new_punches_count
+
+class AdaptiveSyncInterval:
+    """
+    Intervallo di sincronizzazione adattivo.
+
+    Stima con una media mobile esponenziale il ritmo di arrivo delle nuove righe
+    e sceglie l'attesa in modo che ogni ciclo trovi circa `target_rows` righe:
+    si sincronizza spesso durante la gara e raramente quando il DB è fermo.
+    """
+
+    def __init__(self, base_interval, min_interval, max_interval, target_rows=200, alpha=0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_rows = target_rows
+        self.alpha = alpha
+        self.rate = 0.0 # righe/s stimate
+        self.interval = min(max(base_interval, min_interval), max_interval)
+
+    def update(self, new_rows, elapsed_seconds):
+        """Aggiorna la stima con il risultato dell'ultimo ciclo e restituisce la prossima attesa"""
+        if elapsed_seconds > 0:
+            observed = new_rows / elapsed_seconds
+            self.rate = self.alpha * observed + (1 - self.alpha) * self.rate
+        if self.rate > 0.01:
+            interval = self.target_rows / self.rate
+        else:
+            # Nessun dato in arrivo: allunga gradualmente l'attesa
+            interval = self.interval * 1.5
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        return self.interval
+
 
 def run_sync_periodically(external_db_config, local_mysql_pool, sync_interval_seconds, status_file_path=None):
     syncer = ExternalDBSync(external_db_config, local_mysql_pool, status_file_path)
+    # INSERT IGNORE scarta le punzonature già presenti solo se la chiave univoca esiste
+    ensure_punches_unique_key(local_mysql_pool)
+    adaptive = None
+    if str(external_db_config.get('adaptive_interval', 'false')).lower() in ('1', 'true', 'yes', 'on'):
+        adaptive = AdaptiveSyncInterval(
+            sync_interval_seconds,
+            min_interval=float(external_db_config.get('min_sync_interval', 5)),
+            max_interval=float(external_db_config.get('max_sync_interval', max(sync_interval_seconds, 300))),
+            target_rows=int(external_db_config.get('target_rows_per_sync', 200))
+        )
+    interval = sync_interval_seconds
+    last_cycle = time.monotonic()
     while True:
+        new_rows = 0
         try:
-            syncer.sync_punches()
+            new_rows = syncer.sync_punches() or 0
         except Exception as e:
             logging.error(f"Errore nel ciclo di sincronizzazione periodica: {e}")
-        logging.debug(f"Attesa di {sync_interval_seconds} secondi per la prossima sincronizzazione...")
-        time.sleep(sync_interval_seconds)
+        if adaptive:
+            now = time.monotonic()
+            interval = adaptive.update(new_rows, now - last_cycle)
+            last_cycle = now
+        logging.debug(f"Attesa di {interval:.0f} secondi per la prossima sincronizzazione...")
+        time.sleep(interval)
 
 if __name__ == '__main__':
     # Questo blocco è solo per testare lo script standalone
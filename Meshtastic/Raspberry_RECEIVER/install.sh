@@ -158,7 +158,8 @@ CREATE TABLE IF NOT EXISTS punches (
   raw TEXT,
   INDEX idx_timestamp (timestamp),
   INDEX idx_record_id (record_id),
-  INDEX idx_control (control)
+  INDEX idx_control (control),
+  UNIQUE KEY uq_punches_control_card_time (control, card_number, punch_time)
 );
 EOF
     
@@ -1,7 +1,10 @@
 import glob
 import logging
 import os
+import queue
 import sys
+import threading
+import time
 import traceback
 from datetime import datetime
 try:
@@ -9,6 +12,8 @@ try:
     from mysql.connector import pooling
     from meshtastic import serial_interface
     from pubsub import pub # AGGIUNTO import per pubsub
+    from duplicate_filter import DuplicateFilter
+    from punches_schema import ensure_punches_unique_key
     logging.info("Importazioni di librerie completate con successo")
 except Exception as e:
     logging.error("Errore durante l'importazione delle librerie: %s", str(e))
@@ -39,9 +44,16 @@ def main():
         interface = MeshtasticInterface(port=None, config={'mysql': {'host': 'localhost', 'port': '3306', 'user': 'user', 'password': 'pass', 'database': 'db'}})
         logging.info("Istanza di MeshtasticInterface creata con successo")
         # Mantieni il processo in esecuzione per ricevere messaggi
-        import time
-        while True:
-            time.sleep(1)
+        last_stats_log = time.monotonic()
+        try:
+            while True:
+                time.sleep(1)
+                if time.monotonic() - last_stats_log >= 300:
+                    logging.info(f"Filtro duplicati: {interface.punch_filter.get_stats()}")
+                    last_stats_log = time.monotonic()
+        except KeyboardInterrupt:
+            logging.info("Interruzione richiesta, svuoto la coda DB...")
+            interface.db_writer.stop()
     except Exception as e:
         logging.error("Errore nel blocco main: %s", str(e))
         logging.error("Traceback completo: %s", traceback.format_exc())
@@ -93,6 +105,29 @@ class MeshtasticInterface:
         except Exception as e:
             logging.error(f"Errore durante la configurazione del pool MySQL: {str(e)}")
             raise
+        # INSERT IGNORE del writer scarta i duplicati solo se la chiave univoca esiste
+        ensure_punches_unique_key(self.mysql_pool)
+
+        # Filtro duplicati per le punzonature ritrasmesse, ricostruito dal DB all'avvio
+        dedup_cfg = config.get('dedup', {})
+        self.punch_filter = DuplicateFilter(
+            max_entries=int(dedup_cfg.get('max_entries', 50000)),
+            name="punches (pkey, record_id)"
+        )
+        self.punch_filter.load_from_db(self.mysql_pool, ('pkey', 'record_id'))
+
+        # Writer in background: il callback radio si limita ad accodare le righe
+        writer_cfg = config.get('db_writer', {})
+        self.db_writer = BatchedDBWriter(
+            self.mysql_pool,
+            max_queue_size=int(writer_cfg.get('max_queue_size', 2000)),
+            batch_size=int(writer_cfg.get('batch_size', 200)),
+            flush_interval=float(writer_cfg.get('flush_interval', 0.5)),
+            enqueue_timeout=float(writer_cfg.get('enqueue_timeout', 0.05)),
+            # Una punzonatura non salvata deve poter passare al prossimo retry della mesh
+            on_row_failed=self.punch_filter.discard,
+        )
+        self.db_writer.start()
 
         # Registriamo il callback per i pacchetti ricevuti usando pubsub
         # self.iface.onReceiveTxPacket(self._on_receive) # VECCHIO MODO
@@ -106,8 +141,11 @@ class MeshtasticInterface:
 
     def _on_receive(self, packet, interface): # La firma dovrebbe essere compatibile
         """
-        Packet handler: prende payload formattato con ';', salva sempre il messaggio
-        in messages, e se è punches anche in punches.
+        Packet handler: prende payload formattato con ';', accoda il messaggio per
+        messages, e se è punches anche per punches. Una punzonatura duplicata
+        (ritrasmissione già vista dal DuplicateFilter) è scartata da entrambe le
+        tabelle. Gira nel thread di pubsub del lettore radio, quindi non tocca
+        MySQL: la scrittura è del BatchedDBWriter.
         """
         payload = packet.get('payload', '')
         parts = payload.split(';')
@@ -117,10 +155,7 @@ class MeshtasticInterface:
         msg_type = parts[0]
         # Timestamp per inserimento in messages
         ts_msg = datetime.utcnow()
-        # Prepara valori per messages: f1, f2, f3 dopo il tipo
-        # _, f1, f2, f3 = parts[:4] # Vecchio parsing generico
 
-        # Nuovo parsing basato su msg_type
         f1, f2, f3 = None, None, None # Default
         if len(parts) > 1: f1 = parts[1]
         if len(parts) > 2: f2 = parts[2]
@@ -160,88 +195,276 @@ class MeshtasticInterface:
             except Exception as e:
                 logging.error(f"Errore nel parsing del messaggio di telemetria {payload}: {e}")
 
-        # Inserimento in messages per tutti i tipi
-        cnx = None  # Inizializza cnx a None
-        try:
-            cnx = self.mysql_pool.get_connection()
-            cursor = cnx.cursor()
-            insert_msgs = (
-                "INSERT INTO messages"
-                " (timestamp, node_eui, field1, field2, field3, raw)"
-                " VALUES (%s, %s, %s, %s, %s, %s)"
-            )
-            cursor.execute(insert_msgs, (
-                ts_msg,
-                node_eui_from_packet,
-                f1, f2, f3, # Questi sono i campi generici dal payload
-                payload
-            ))
-            logging.info(f"Inserito messaggio in DB: timestamp={ts_msg}, node_eui={node_eui_from_packet}, field1={f1}, field2={f2}, field3={f3}, raw={payload}")
-
-            # Se è punches (diverso da telemetria), inserisci anche in punches
-            if msg_type == PUNCHES_TYPE and msg_type != TELEMETRY_MESSAGE_TYPE: # Assicurati che non sia un messaggio di telemetria
-                # Il parsing per punches rimane lo stesso, ma assicurati che parts abbia abbastanza elementi
-                # Questo parsing era già presente, lo manteniamo per i messaggi di tipo PUNCHES_TYPE
-                current_parts_for_punch = payload.split(';') # Riparsiamo per pulizia
-                if len(current_parts_for_punch) >= 8 : # Deve avere almeno 8 campi per i punch
-                    _, ts_str, name, pkey, rec_id, control, card_number, punch_time = current_parts_for_punch[:8]
-                else:
-                    # Logga un errore o gestisci il caso di messaggio punch malformato
-                    logging.warning(f"Messaggio PUNCHES malformato o con campi insufficienti: {payload}")
-                    # Potresti voler saltare l'inserimento o inserire NULL dove possibile
-                    # Per ora, saltiamo se malformato per evitare errori SQL
-                    # Questo return esce solo dalla parte di inserimento punch
-                    # return # Commentato per permettere il commit dell'insert in messages
-
-            # Se è punches, inserisci anche in punches (CODICE ORIGINALE, DA RIVEDERE CON IL NUOVO PARSING)
-            # Questo blocco va integrato meglio con il parsing sopra
-            if msg_type == PUNCHES_TYPE: # Questo if è ridondante se già gestito sopra
-                # Assumiamo che parts sia già stato popolato correttamente per PUNCHES_TYPE
-                # e che il controllo sulla lunghezza sia già stato fatto.
-                # La logica di parsing per PUNCHES_TYPE deve essere chiara e distinta.
-                # Per ora, commento il blocco originale per evitare confusione con il nuovo parsing.
-                # while len(parts) < 8:
-                #    parts.append(None)
-                # _, ts_str, name, pkey, rec_id, control, card_number, punch_time = parts[:8]
-                
-                # Ricontrolliamo la lunghezza di 'parts' specificamente per PUNCHES_TYPE
-                # Questo è un refactoring del blocco precedente per chiarezza
-                punch_parts = payload.split(';')
-                if punch_parts[0] == PUNCHES_TYPE and len(punch_parts) >= 8:
-                    _, ts_str, name, pkey_punch, rec_id, control, card_number, punch_time = punch_parts[:8]
+        # Riga per messages (tutti i tipi)
+        message_row = (ts_msg, node_eui_from_packet, f1, f2, f3, payload)
+
+        # Se è punches, prepara anche la riga per punches
+        punch_row = None
+        punch_key = None
+        if msg_type == PUNCHES_TYPE:
+            if len(parts) >= 8:
+                _, ts_str, name, pkey, rec_id, control, card_number, punch_time = parts[:8]
+                # Scarta le ritrasmissioni prima di qualsiasi accesso al DB
+                punch_key = DuplicateFilter.make_key(pkey, rec_id)
+                if self.punch_filter.check_and_add(punch_key):
+                    logging.info(f"Punzonatura duplicata scartata (pkey={pkey}, record_id={rec_id})")
+                    return
                 try:
                     ts_p = datetime.fromisoformat(ts_str)
                 except Exception:
                     ts_p = datetime.utcnow()
+                punch_row = (ts_p, name, pkey, rec_id, control, card_number, punch_time, payload)
+            else:
+                # Messaggio punch malformato: salviamo solo in messages per evitare errori SQL
+                logging.warning(f"Messaggio PUNCHES malformato o con campi insufficienti: {payload}")
 
-                # Non c'è bisogno di prendere una nuova connessione se usi la stessa
-                insert_punch = (
-                    "INSERT INTO punches"
-                    " (timestamp, name, pkey, record_id, control, card_number, punch_time, raw)"
-                    " VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-                )
-                cursor.execute(insert_punch, (
-                    ts_p,
-                    name,
-                    pkey,
-                    rec_id,
-                    control,
-                    card_number,
-                    punch_time,
-                    payload
-                ))
-            
-            cnx.commit() # Commit alla fine dopo tutte le operazioni
-            cursor.close()
-
-        except mysql.connector.Error as err:
-            logging.error(f"Errore MySQL in _on_receive: {err}")
-        except Exception as e:
-            logging.error(f"Errore generico in _on_receive: {e}")
+        # La chiave resta riservata nel filtro finché la riga è in coda; se la
+        # scrittura fallisce definitivamente il writer la rilascia (on_row_failed)
+        if not self.db_writer.enqueue(message_row, punch_row, punch_key) and punch_key:
+            # Riga scartata dalla coda: permetti al prossimo retry di passare
+            self.punch_filter.discard(punch_key)
+
+
+class BatchedDBWriter:
+    """
+    Writer MySQL in background per messages/punches.
+
+    Il callback radio accoda le righe in una coda limitata; un thread dedicato
+    le svuota a blocchi e le scrive con executemany in un'unica transazione
+    (group commit). Se la coda è piena il chiamante attende al massimo
+    `enqueue_timeout` secondi (backpressure) e poi la riga viene scartata.
+
+    Un blocco fallito non viene perso: con errori di connessione viene
+    trattenuto e riprovato con backoff esponenziale; con errori sui dati
+    viene riprovato una volta e poi scritto riga per riga, così si perde solo
+    la riga che non entra. `on_row_failed(key)` viene chiamato con la chiave
+    di ogni riga scartata definitivamente (errore sui dati o chiusura).
+    """
+
+    INSERT_MESSAGES = (
+        "INSERT INTO messages"
+        " (timestamp, node_eui, field1, field2, field3, raw)"
+        " VALUES (%s, %s, %s, %s, %s, %s)"
+    )
+    # IGNORE: un duplicato (control, card_number, punch_time) sfuggito al filtro
+    # in memoria (riavvio, uscita dalla LRU) non deve far fallire il blocco
+    INSERT_PUNCHES = (
+        "INSERT IGNORE INTO punches"
+        " (timestamp, name, pkey, record_id, control, card_number, punch_time, raw)"
+        " VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
+    )
+
+    # Errori che riguardano la connessione e non le righe: si riprova l'intero blocco
+    CONNECTION_ERRORS = (mysql.connector.errors.InterfaceError,
+                         mysql.connector.errors.OperationalError,
+                         mysql.connector.errors.PoolError)
+
+    def __init__(self, mysql_pool, max_queue_size=2000, batch_size=200,
+                 flush_interval=0.5, enqueue_timeout=0.05, stats_interval=60,
+                 min_backoff=1.0, max_backoff=60.0, on_row_failed=None):
+        self.mysql_pool = mysql_pool
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enqueue_timeout = enqueue_timeout
+        self.stats_interval = stats_interval
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.on_row_failed = on_row_failed
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pending = []
+        self._attempts = 0
+        self._backoff = 0.0
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'backpressure_waits': 0,
+            'messages_written': 0,
+            'punches_written': 0,
+            'batches': 0,
+            'write_errors': 0,
+            'retries': 0,
+            'row_by_row': 0,
+            'rows_failed': 0,
+            'max_queue_depth': 0,
+            'last_batch_size': 0,
+            'last_batch_ms': 0.0,
+        }
+
+    def start(self):
+        """Avvia il thread di scrittura"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name="BatchedDBWriter", daemon=True)
+        self._thread.start()
+        logging.info(f"BatchedDBWriter avviato (coda max {self._queue.maxsize}, batch {self.batch_size})")
+
+    def stop(self, timeout=5.0):
+        """Ferma il thread dopo aver scritto le righe ancora in coda"""
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+        logging.info(f"BatchedDBWriter fermato. Statistiche: {self.get_stats()}")
+
+    def enqueue(self, message_row, punch_row=None, key=None):
+        """
+        Accoda una riga messages (ed eventualmente punches con la sua chiave
+        di deduplica). Ritorna False se scartata.
+        """
+        item = (message_row, punch_row, key)
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['backpressure_waits'] += 1
+            try:
+                self._queue.put(item, timeout=self.enqueue_timeout)
+            except queue.Full:
+                with self._stats_lock:
+                    self._stats['dropped'] += 1
+                logging.warning(f"Coda DB piena ({self._queue.maxsize}), messaggio scartato: {message_row[-1]}")
+                return False
+
+        depth = self._queue.qsize()
+        with self._stats_lock:
+            self._stats['enqueued'] += 1
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+        return True
+
+    def _drain(self, timeout):
+        """Attende il primo elemento e raccoglie fino a batch_size elementi"""
+        try:
+            batch = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        last_stats_log = time.monotonic()
+        while True:
+            stopping = self._stop_event.is_set()
+            if not self._pending:
+                self._pending = self._drain(0 if stopping else self.flush_interval)
+                self._attempts = 0
+            if self._pending:
+                self._process_pending(stopping)
+            elif stopping:
+                return
+            if self.stats_interval and time.monotonic() - last_stats_log >= self.stats_interval:
+                logging.info(f"BatchedDBWriter statistiche: {self.get_stats()}")
+                last_stats_log = time.monotonic()
+
+    def _process_pending(self, stopping):
+        batch = self._pending
+        error = self._write_batch(batch)
+        if error is None:
+            self._pending = []
+            self._backoff = 0.0
+            return
+        with self._stats_lock:
+            self._stats['write_errors'] += 1
+        if not isinstance(error, self.CONNECTION_ERRORS):
+            self._attempts += 1
+            if self._attempts >= 2 or stopping:
+                # Errore sui dati anche al secondo tentativo (o in chiusura): riga per riga
+                self._write_rows(batch)
+                self._pending = []
+                self._backoff = 0.0
+                return
+        if stopping:
+            logging.error(f"BatchedDBWriter in chiusura: {len(batch)} righe non scritte ({error})")
+            for item in batch:
+                self._row_failed(item)
+            self._pending = []
+            return
+        self._backoff = min(self.max_backoff, self._backoff * 2) if self._backoff else self.min_backoff
+        with self._stats_lock:
+            self._stats['retries'] += 1
+        logging.error(f"Errore MySQL nel BatchedDBWriter ({len(batch)} righe, nuovo tentativo tra {self._backoff:.1f}s): {error}")
+        self._stop_event.wait(self._backoff)
+
+    def _execute(self, batch):
+        """Scrive le righe in un'unica transazione; solleva l'eccezione MySQL"""
+        message_rows = [item[0] for item in batch]
+        punch_rows = [item[1] for item in batch if item[1] is not None]
+        cnx = self.mysql_pool.get_connection()
+        try:
+            cursor = cnx.cursor()
+            try:
+                cursor.executemany(self.INSERT_MESSAGES, message_rows)
+                if punch_rows:
+                    cursor.executemany(self.INSERT_PUNCHES, punch_rows)
+                cnx.commit()
+            except Exception:
+                try:
+                    cnx.rollback()
+                except Exception:
+                    pass
+                raise
+            finally:
+                cursor.close()
         finally:
-            if cnx and cnx.is_connected(): # Assicurati che la connessione esista e sia aperta prima di chiuderla
+            if cnx.is_connected():
                 cnx.close()
-                logging.debug("Connessione MySQL restituita al pool.")
+        with self._stats_lock:
+            self._stats['messages_written'] += len(message_rows)
+            self._stats['punches_written'] += len(punch_rows)
+        return len(message_rows), len(punch_rows)
+
+    def _write_batch(self, batch):
+        """Scrive un blocco di righe in un'unica transazione. Ritorna l'eccezione o None."""
+        started = time.monotonic()
+        try:
+            messages, punches = self._execute(batch)
+        except Exception as e:
+            return e
+        elapsed_ms = (time.monotonic() - started) * 1000
+        with self._stats_lock:
+            self._stats['batches'] += 1
+            self._stats['last_batch_size'] = len(batch)
+            self._stats['last_batch_ms'] = round(elapsed_ms, 2)
+        logging.debug(f"Batch scritto: {messages} messages, {punches} punches in {elapsed_ms:.1f} ms")
+        return None
+
+    def _write_rows(self, batch):
+        """Fallback riga per riga: scarta solo le righe che falliscono"""
+        with self._stats_lock:
+            self._stats['row_by_row'] += 1
+        failed = 0
+        for item in batch:
+            try:
+                self._execute([item])
+            except Exception as e:
+                failed += 1
+                logging.error(f"Riga scartata dal BatchedDBWriter: {e} – {item[0][-1]}")
+                self._row_failed(item)
+        logging.warning(f"Blocco scritto riga per riga: {len(batch) - failed}/{len(batch)} righe salvate")
+
+    def _row_failed(self, item):
+        with self._stats_lock:
+            self._stats['rows_failed'] += 1
+        key = item[2]
+        if key is not None and self.on_row_failed:
+            self.on_row_failed(key)
+
+    def get_stats(self):
+        """Restituisce le statistiche del writer"""
+        with self._stats_lock:
+            stats = self._stats.copy()
+        stats['queue_depth'] = self._queue.qsize()
+        stats['queue_max_size'] = self._queue.maxsize
+        stats['pending_retry'] = len(self._pending)
+        stats['backoff'] = self._backoff
+        return stats
 
 # Note: Assicurati di aver creato le tabelle SQL:
 #
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+# punches_schema.py
+"""
+Chiave univoca della tabella punches, condivisa dagli script che vi scrivono
+con INSERT IGNORE (simple_meshtastic_listener, meshtastic_interface,
+external_data_sync): senza la chiave INSERT IGNORE non scarta i duplicati.
+"""
+
+import logging
+
+import mysql.connector
+
+# Chiave univoca usata per la deduplica delle punzonature (INSERT IGNORE)
+PUNCHES_UNIQUE_KEY = 'uq_punches_control_card_time'
+
+
+def ensure_punches_unique_key(pool):
+    """Crea, se manca, la chiave univoca (control, card_number, punch_time) su punches"""
+    cnx = None
+    try:
+        cnx = pool.get_connection()
+        cursor = cnx.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.STATISTICS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'punches' AND INDEX_NAME = %s",
+            (PUNCHES_UNIQUE_KEY,)
+        )
+        if cursor.fetchone()[0] == 0:
+            logging.info(f"Creazione chiave univoca {PUNCHES_UNIQUE_KEY} su punches...")
+            cursor.execute(
+                f"ALTER TABLE punches ADD UNIQUE KEY {PUNCHES_UNIQUE_KEY} (control, card_number, punch_time)"
+            )
+            logging.info(f"Chiave univoca {PUNCHES_UNIQUE_KEY} creata")
+        cursor.close()
+    except mysql.connector.Error as err:
+        # Tipicamente fallisce se la tabella contiene già duplicati: senza la chiave
+        # INSERT IGNORE non scarta nulla, quindi va segnalato chiaramente.
+        logging.warning(f"Impossibile creare la chiave univoca {PUNCHES_UNIQUE_KEY} su punches: {err}")
+        logging.warning("Rimuovere i duplicati esistenti e riavviare per attivare la deduplica delle punzonature")
+    finally:
+        if cnx and cnx.is_connected():
+            cnx.close()
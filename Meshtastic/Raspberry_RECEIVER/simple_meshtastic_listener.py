@@ -28,6 +28,9 @@ except ImportError as e:
     logging.error("Installa la libreria necessaria con: sudo pip3 install mysql-connector-python --break-system-packages")
     sys.exit(1)
 
+from duplicate_filter import DuplicateFilter
+from punches_schema import ensure_punches_unique_key
+
 # Configurazione del database (da adattare in base al tuo setup)
 DB_CONFIG = {
     'host': 'localhost',
@@ -58,11 +61,26 @@ def setup_db_pool():
         logging.error(f"Errore durante la configurazione del pool MySQL: {str(e)}")
         sys.exit(1)
 
+# Pool condiviso, creato alla prima scrittura
+db_pool = None
+
+# Filtro duplicati in memoria sulla stessa chiave, consultato prima di qualsiasi query
+punch_filter = DuplicateFilter(name="punches (control, card_number, punch_time)")
+
+def get_db_pool():
+    """Restituisce il pool di connessioni, creandolo una sola volta"""
+    global db_pool
+    if db_pool is None:
+        db_pool = setup_db_pool()
+    return db_pool
+
+
 def save_to_db(message_data, punch_data=None, hops=None, rssi=None, snr=None):
-    """Salva il messaggio nel database, e se è una punzonatura anche nella tabella punches, aggiorna anche la tabella nodes"""
+    """Salva il messaggio nel database, e se è una punzonatura anche nella tabella punches, aggiorna anche la tabella nodes.
+    Ritorna True se il salvataggio è andato a buon fine."""
+    cnx = None
     try:
-        db_pool = setup_db_pool() if 'db_pool' not in globals() else globals()['db_pool']
-        cnx = db_pool.get_connection()
+        cnx = get_db_pool().get_connection()
         cursor = cnx.cursor()
         
         # Salva nella tabella messaggi con i campi aggiuntivi per hops, rssi e snr
@@ -78,61 +96,45 @@ def save_to_db(message_data, punch_data=None, hops=None, rssi=None, snr=None):
         cursor.execute(insert_query_messaggi, extended_message_data)
         logging.info(f"Messaggio salvato nel DB (messaggi): {extended_message_data}")
         
-        # Aggiorna la tabella nodes con l'ultimo segnale ricevuto dal nodo
+        # Aggiorna la tabella nodes con l'ultimo segnale ricevuto dal nodo (upsert sulla chiave id)
         node_id = message_data[1]  # id_nodo
         node_name = message_data[4]  # nome_radio_control
         node_pkey = message_data[5]  # pkey
         last_signal_date = message_data[0]  # data_ora come timestamp completo
         
-        # Controlla se il nodo esiste già nella tabella nodes
-        check_node_query = "SELECT COUNT(*) FROM nodes WHERE id = %s"
-        cursor.execute(check_node_query, (node_id,))
-        node_exists = cursor.fetchone()[0] > 0
-        
-        if node_exists:
-            # Aggiorna il record esistente
-            update_node_query = (
-                "UPDATE nodes SET name = %s, pkey = %s, last_signal = %s WHERE id = %s"
-            )
-            cursor.execute(update_node_query, (node_name, node_pkey, last_signal_date, node_id))
-            logging.info(f"Nodo aggiornato nel DB (nodes): id={node_id}, name={node_name}, last_signal={last_signal_date}")
-        else:
-            # Inserisci un nuovo record
-            insert_node_query = (
-                "INSERT INTO nodes (id, name, pkey, last_signal) VALUES (%s, %s, %s, %s)"
-            )
-            cursor.execute(insert_node_query, (node_id, node_name, node_pkey, last_signal_date))
-            logging.info(f"Nodo inserito nel DB (nodes): id={node_id}, name={node_name}, last_signal={last_signal_date}")
+        upsert_node_query = (
+            "INSERT INTO nodes (id, name, pkey, last_signal) VALUES (%s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE name = VALUES(name), pkey = VALUES(pkey), last_signal = VALUES(last_signal)"
+        )
+        cursor.execute(upsert_node_query, (node_id, node_name, node_pkey, last_signal_date))
+        logging.info(f"Nodo aggiornato nel DB (nodes): id={node_id}, name={node_name}, last_signal={last_signal_date}")
         
-        # Se è una punzonatura (tipo_messaggio = '1'), salva anche nella tabella punches solo se non esiste già
+        # Se è una punzonatura (tipo_messaggio = '1'), salva anche nella tabella punches.
+        # I duplicati (control, card_number, punch_time) sono scartati dalla chiave univoca.
         if punch_data:
-            # Estrai i valori per il controllo di duplicati (control, card_number, punch_time)
             control = punch_data[4]  # control
             card_number = punch_data[5]  # card_number
             punch_time = punch_data[6]  # punch_time
             
-            # Controlla se esiste già un record con gli stessi valori
-            check_query = (
-                "SELECT COUNT(*) FROM punches WHERE control = %s AND card_number = %s AND punch_time = %s"
+            insert_query_punches = (
+                "INSERT IGNORE INTO punches (timestamp, name, pkey, record_id, control, card_number, punch_time, raw) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
             )
-            cursor.execute(check_query, (control, card_number, punch_time))
-            result = cursor.fetchone()
-            
-            if result[0] > 0:
-                logging.info(f"Punzonatura già esistente nel DB (punches), non salvata: control={control}, card_number={card_number}, punch_time={punch_time}")
-            else:
-                insert_query_punches = (
-                    "INSERT INTO punches (timestamp, name, pkey, record_id, control, card_number, punch_time, raw) "
-                    "VALUES (%s, %s, %s, %s, %s, %s, %s, %s)"
-                )
-                cursor.execute(insert_query_punches, punch_data)
+            cursor.execute(insert_query_punches, punch_data)
+            if cursor.rowcount > 0:
                 logging.info(f"Punzonatura salvata nel DB (punches): {punch_data}")
+            else:
+                logging.info(f"Punzonatura già esistente nel DB (punches), non salvata: control={control}, card_number={card_number}, punch_time={punch_time}")
         
         cnx.commit()
         cursor.close()
-        cnx.close()
+        return True
     except Exception as e:
         logging.error(f"Errore durante il salvataggio nel DB: {str(e)}")
+        return False
+    finally:
+        if cnx and cnx.is_connected():
+            cnx.close()
 
 def on_receive(packet, interface):
     """Gestore per i pacchetti ricevuti, mostra tutti i messaggi inclusi JSON e salva solo quelli con tipo_messaggio nel DB"""
@@ -217,7 +219,15 @@ def on_receive(packet, interface):
                     parts[7] if len(parts) > 7 else "",  # punch_time
                     raw_message  # raw
                 )
-            save_to_db(message_data, punch_data, hops, rssi, snr)
+            punch_key = None
+            if punch_data:
+                # Scarta le ritrasmissioni della mesh prima di qualsiasi query
+                punch_key = DuplicateFilter.make_key(punch_data[4], punch_data[5], punch_data[6])
+                if punch_filter.check_and_add(punch_key):
+                    logging.info(f"[{timestamp}] Punzonatura duplicata scartata: control={punch_data[4]}, card_number={punch_data[5]}, punch_time={punch_data[6]}")
+                    return
+            if not save_to_db(message_data, punch_data, hops, rssi, snr) and punch_key:
+                punch_filter.discard(punch_key)
         else:
             logging.info(f"[{timestamp}] Messaggio non salvato nel DB, manca tipo_messaggio: {raw_message}")
     except Exception as e:
@@ -246,6 +256,10 @@ def main():
             
             logging.info(f"Porta Meshtastic rilevata: {port}")
         
+        # Prepara il pool e la chiave univoca per la deduplica delle punzonature
+        ensure_punches_unique_key(get_db_pool())
+        punch_filter.load_from_db(get_db_pool(), ('control', 'card_number', 'punch_time'))
+        
         # Connetti al dispositivo
         logging.info(f"Connessione alla porta: {port}")
         iface = serial_interface.SerialInterface(devPath=port)
@@ -256,10 +270,14 @@ def main():
         pub.subscribe(on_receive, "meshtastic.receive")
         logging.info("Sottoscrizione completata. In attesa di messaggi...")
         
-        # Mantieni lo script in esecuzione
+        # Mantieni lo script in esecuzione, riportando ogni tanto l'efficacia del filtro duplicati
         import time
+        last_stats_log = time.monotonic()
         while True:
             time.sleep(1)
+            if time.monotonic() - last_stats_log >= 300:
+                logging.info(f"Filtro duplicati: {punch_filter.get_stats()}")
+                last_stats_log = time.monotonic()
     except Exception as e:
         logging.error(f"Errore durante l'esecuzione dello script: {str(e)}")
         logging.info("Se la porta è occupata, prova a liberarla con: sudo fuser -k <porta>")
@@ -1,8 +1,20 @@
 #!/usr/bin/env python3
 """
-callhome.py v3.1 - completo
+callhome.py v3.2 - completo
 Invia periodicamente un POST JSON compresso a callhome.php con keepalive e metriche di sistema.
 Include gestione errori avanzata, configurazione esterna con versioning, rotating logs, dry-run, backoff, asyncio/AIOHTTP.
+
+keepalive_mode = delta (richiede il supporto in callhome.php):
+- fotografia completa ('mode': 'full') ogni full_every invii, al primo invio
+  e quando il server risponde 'resync': true;
+- in mezzo solo le metriche cambiate oltre una soglia o che attraversano una
+  soglia di allarme ('mode': 'delta', riferite a 'base_seq', l'ultimo invio confermato);
+- con il collegamento in errore i campioni si accumulano (max_batch) e partono
+  insieme in un unico POST ('mode': 'batch', 'samples': [...]);
+- 'timestamp' in secondi epoch e client_version solo con le fotografie complete;
+- gzip solo se il JSON supera gzip_min_bytes e la compressione conviene.
+Con keepalive_mode = full il payload è quello della v3.1.
+In entrambi i modi nel log compare ogni ora il traffico in byte/ora.
 """
 import asyncio
 import time
@@ -15,10 +27,12 @@ from datetime import datetime
 from pathlib import Path
 import configparser
 import random
-import psutil
+from collections import deque
 import aiomysql
 import aiohttp
 
+from system_metrics import get_sampler
+
 # Configurazione logging con rotazione
 logger = logging.getLogger("callhome")
 logger.setLevel(logging.INFO)
@@ -52,10 +66,37 @@ DEFAULT_CONFIG = {
         'poll_interval': '20',
         'cred_check_interval': '3600',
         'max_retries': '5',
-        'dry_run': 'False'
+        'dry_run': 'False',
+        'keepalive_mode': 'full',
+        'full_every': '15',
+        'max_batch': '30',
+        'gzip_min_bytes': '512'
     }
 }
 
+CLIENT_VERSION = '3.2'
+
+# Variazione minima perché una metrica entri in un delta; None = solo nelle fotografie complete
+DELTA_THRESHOLDS = {
+    'cpu_percent': 10.0,
+    'memory_percent': 2.0,
+    'memory_available_mb': 20.0,
+    'disk_percent': 1.0,
+    'disk_free_gb': 0.1,
+    'load_avg_1m': 0.5,
+    'process_count': 5,
+    'temperature': 2.0,
+    'uptime_hours': None,
+}
+
+# Soglie di allarme: attraversarle (in entrambi i versi) invia sempre la metrica
+ALERT_LEVELS = {
+    'cpu_percent': 90.0,
+    'memory_percent': 90.0,
+    'disk_percent': 90.0,
+    'temperature': 80.0,
+}
+
 
 def load_config():
     """Carica o crea config con versioning"""
@@ -85,32 +126,12 @@ def load_config():
 
 
 def collect_system_metrics():
-    """Raccoglie metriche di sistema"""
-    metrics = {}
-    try:
-        metrics['cpu_percent'] = psutil.cpu_percent(interval=0.5)
-        vm = psutil.virtual_memory()
-        metrics['memory_percent'] = vm.percent
-        metrics['memory_available_mb'] = round(vm.available / (1024*1024),2)
-        du = psutil.disk_usage('/')
-        metrics['disk_percent'] = du.percent
-        metrics['disk_free_gb'] = round(du.free/(1024*1024*1024),2)
-        # uptime
-        uptime_s = time.time() - psutil.boot_time()
-        metrics['uptime_hours'] = round(uptime_s/3600,2)
-        # load avg su Linux
-        if hasattr(psutil, 'getloadavg'):
-            la1, la5, la15 = psutil.getloadavg()
-            metrics['load_avg_1m'] = round(la1,2)
-        metrics['process_count'] = len(psutil.pids())
-        # temperatura
-        temps = psutil.sensors_temperatures() if hasattr(psutil, 'sensors_temperatures') else {}
-        for entries in temps.values():
-            if entries:
-                metrics['temperature'] = round(entries[0].current,1)
-                break
-    except Exception as e:
-        logger.warning("Errore metriche sistema: %s", e)
+    """
+    Metriche di sistema dall'ultimo campione in background di system_metrics:
+    nessuna attesa dentro il loop asyncio.
+    """
+    metrics = get_sampler().snapshot()
+    metrics.pop('sampled_at', None)
     return metrics
 
 
@@ -136,61 +157,249 @@ async def get_credentials(pool):
     return creds.get('nome'), creds.get('pkey')
 
 
-async def send_keepalive(session, url, name, pkey, dry_run=False):
-     metrics = collect_system_metrics()
-     payload = {
-         'name': name, 'pkey': pkey, 'action': 'keepalive',
-         'timestamp': datetime.utcnow().isoformat()+'Z',
-         'system_status': metrics, 'client_version': '3.1'
-     }
-     raw = json.dumps(payload, separators=(',',':')).encode('utf-8')
-     gz = gzip.compress(raw)
-     headers = {'Content-Encoding':'gzip','Content-Type':'application/json'}
-     if dry_run:
-         logger.info("DRY RUN - payload: %s", payload)
-         return True
-     try:
+class ByteMeter:
+    """Byte inviati nell'ultima ora (payload HTTP, esclusi header e TLS)"""
+
+    def __init__(self, report_interval=3600):
+        self.report_interval = report_interval
+        self._events = deque()
+        self._last_report = time.monotonic()
+        self.totals = {'posts': 0, 'wire_bytes': 0, 'raw_bytes': 0}
+
+    def record(self, wire_bytes, raw_bytes):
+        now = time.monotonic()
+        self._events.append((now, wire_bytes, raw_bytes))
+        self.totals['posts'] += 1
+        self.totals['wire_bytes'] += wire_bytes
+        self.totals['raw_bytes'] += raw_bytes
+        self._trim(now)
+
+    def _trim(self, now):
+        while self._events and now - self._events[0][0] > 3600:
+            self._events.popleft()
+
+    def last_hour(self):
+        self._trim(time.monotonic())
+        return {
+            'posts': len(self._events),
+            'wire_bytes': sum(e[1] for e in self._events),
+            'raw_bytes': sum(e[2] for e in self._events),
+        }
+
+    def maybe_report(self):
+        if time.monotonic() - self._last_report < self.report_interval:
+            return
+        self._last_report = time.monotonic()
+        hour = self.last_hour()
+        logger.info("Traffico keepalive ultima ora: %d invii, %d byte/ora inviati (%d byte JSON)",
+                    hour['posts'], hour['wire_bytes'], hour['raw_bytes'])
+
+
+def _crossed_alert(key, old, new):
+    level = ALERT_LEVELS.get(key)
+    if level is None or old is None or new is None:
+        return False
+    return (old > level) != (new > level)
+
+
+class KeepaliveEncoder:
+    """
+    Stato del protocollo delta: campioni in attesa, ultima fotografia
+    confermata dal server (base) e numero di sequenza.
+    """
+
+    def __init__(self, full_every=15, max_batch=30):
+        self.full_every = full_every
+        self.pending = deque(maxlen=max_batch)
+        self.seq = 0
+        self.base = None
+        self.base_seq = None
+        self.deltas_since_full = 0
+        self.force_full = True
+        self._in_flight = None
+
+    def add_sample(self, metrics, timestamp=None):
+        self.seq += 1
+        # Epoch in secondi: metà dei byte della data ISO
+        timestamp = int(timestamp if timestamp is not None else time.time())
+        self.pending.append((self.seq, timestamp, dict(metrics)))
+
+    def _delta(self, reference, metrics):
+        changed = {}
+        for key, value in metrics.items():
+            old = reference.get(key)
+            if key not in reference:
+                changed[key] = value
+            elif _crossed_alert(key, old, value):
+                changed[key] = value
+            elif (old is None) != (value is None):
+                # Sensore comparso o sparito (es. temperature None)
+                changed[key] = value
+            elif key in DELTA_THRESHOLDS:
+                threshold = DELTA_THRESHOLDS[key]
+                if threshold is not None and old is not None and value is not None \
+                        and abs(value - old) >= threshold:
+                    changed[key] = value
+            elif value != old:
+                changed[key] = value
+        return changed
+
+    def build(self, name, pkey):
+        """Payload per i campioni in attesa (None se non ce ne sono)"""
+        if not self.pending:
+            return None
+        reference = dict(self.base) if self.base is not None else None
+        deltas = self.deltas_since_full
+        entries = []
+        full_at = None
+        for seq, timestamp, metrics in self.pending:
+            full = (reference is None or self.force_full and not entries
+                    or deltas >= self.full_every
+                    or set(metrics) != set(reference))
+            if full:
+                reference = dict(metrics)
+                deltas = 0
+                full_at = len(entries)
+                entries.append({'seq': seq, 'timestamp': timestamp, 'mode': 'full', 'system_status': metrics})
+            else:
+                changed = self._delta(reference, metrics)
+                reference.update(changed)
+                deltas += 1
+                entries.append({'seq': seq, 'timestamp': timestamp, 'mode': 'delta', 'system_status': changed})
+        self._in_flight = (self.pending[-1][0], len(self.pending), reference, deltas, full_at is not None)
+        payload = {'name': name, 'pkey': pkey, 'action': 'keepalive'}
+        if full_at is not None:
+            payload['client_version'] = CLIENT_VERSION
+        if entries[0]['mode'] == 'delta':
+            payload['base_seq'] = self.base_seq
+        if len(entries) == 1:
+            payload.update(entries[0])
+        else:
+            payload.update({'mode': 'batch', 'timestamp': entries[-1]['timestamp'], 'samples': entries})
+        return payload
+
+    def ack(self, success, response=None):
+        """Esito dell'ultimo build: su successo la base avanza e i campioni inviati escono dalla coda"""
+        in_flight, self._in_flight = self._in_flight, None
+        resync = bool(response and response.get('resync'))
+        if resync:
+            # Il server ha perso la base (riavvio, campioni mancanti): prossimo invio completo,
+            # anche se ha rifiutato questo delta
+            self.force_full = True
+        if not success or in_flight is None:
+            return
+        last_seq, count, reference, deltas, had_full = in_flight
+        for _ in range(min(count, len(self.pending))):
+            if self.pending[0][0] > last_seq:
+                break
+            self.pending.popleft()
+        self.base, self.base_seq, self.deltas_since_full = reference, last_seq, deltas
+        if had_full and not resync:
+            self.force_full = False
+
+
+async def post_keepalive(session, url, payload, meter=None, gzip_min_bytes=0, dry_run=False):
+    """
+    Invia un payload a callhome.php. Restituisce (successo, risposta JSON).
+    gzip viene usato solo se il JSON è lungo almeno gzip_min_bytes e si riduce davvero;
+    con gzip_min_bytes=None sempre, come nel protocollo v3.1.
+    """
+    raw = json.dumps(payload, separators=(',',':')).encode('utf-8')
+    body = raw
+    headers = {'Content-Type':'application/json'}
+    if gzip_min_bytes is None:
+        body = gzip.compress(raw)
+        headers['Content-Encoding'] = 'gzip'
+    elif len(raw) >= gzip_min_bytes:
+        gz = gzip.compress(raw)
+        if len(gz) < len(raw):
+            body = gz
+            headers['Content-Encoding'] = 'gzip'
+    if dry_run:
+        logger.info("DRY RUN - payload (%d byte): %s", len(body), payload)
+        return True, {}
+    if meter:
+        meter.record(len(body), len(raw))
+    try:
         # Log payload raw in caso di debug
         logger.debug("Invio payload: %s", payload)
-        async with session.post(url, data=gz, headers=headers, timeout=15) as resp:
+        async with session.post(url, data=body, headers=headers, timeout=15) as resp:
             text = await resp.text()
             if resp.status == 200:
                 data = json.loads(text)
                 if data.get('status')=='success':
-                   logger.info("Keepalive OK: %s", data.get('message',''))
-                   return True
+                    logger.info("Keepalive OK: %s", data.get('message',''))
+                    return True, data
                 logger.warning("Server risponde OK ma status!='success': %s – payload era %s", data, payload)
-                return False
-             # qui c’è stato un errore HTTP
+                return False, data
+            # qui c’è stato un errore HTTP
             logger.error("HTTP %d: %s – payload inviato: %s", resp.status, text, payload)
-     except Exception as e:
+    except Exception as e:
         logger.error("Errore richiesta HTTP: %s – payload inviato: %s", e, payload)
-     return False
+    return False, None
+
+
+async def send_keepalive(session, url, name, pkey, dry_run=False, meter=None):
+    """Keepalive completo (protocollo v3.1, sempre compresso)"""
+    metrics = collect_system_metrics()
+    payload = {
+        'name': name, 'pkey': pkey, 'action': 'keepalive',
+        'timestamp': datetime.utcnow().isoformat()+'Z',
+        'system_status': metrics, 'client_version': '3.1'
+    }
+    success, _ = await post_keepalive(session, url, payload, meter, None, dry_run)
+    return success
 
 
-async def main():
-    cfg = load_config()
+async def main(cfg=None, identity_provider=None):
+    """
+    Loop dei keepalive. edge_runtime passa la configurazione già letta e una
+    coroutine che restituisce (nome, pkey) dalla cache condivisa: in quel caso
+    non viene creato il pool aiomysql.
+    """
+    cfg = cfg or load_config()
     ch = cfg['CALLHOME']
     url = ch.get('url')
     poll = ch.getint('poll_interval')
     cred_interval = ch.getint('cred_check_interval')
     dry_run = ch.getboolean('dry_run')
     failure_count = 0
+    meter = ByteMeter()
+    encoder = None
+    if ch.get('keepalive_mode', 'full') == 'delta':
+        encoder = KeepaliveEncoder(ch.getint('full_every', 15), ch.getint('max_batch', 30))
+        gzip_min_bytes = ch.getint('gzip_min_bytes', 512)
+        logger.info("Keepalive in modalità delta (completo ogni %d invii)", encoder.full_every)
+    next_send = 0
 
-    pool = await create_db_pool(cfg)
+    pool = None if identity_provider else await create_db_pool(cfg)
     async with aiohttp.ClientSession() as session:
         name = None; pkey = None; last_cred = 0
         while True:
             now = time.time()
             # aggiorna credenziali
             if not name or (now-last_cred)>=cred_interval:
-                name, pkey = await get_credentials(pool)
+                if identity_provider:
+                    name, pkey = await identity_provider()
+                else:
+                    name, pkey = await get_credentials(pool)
                 last_cred = now
                 if not name or not pkey:
                     logger.warning("Credenziali mancanti, aspetto %ds", poll)
                     await asyncio.sleep(poll)
                     continue
-            success = await send_keepalive(session, url, name, pkey, dry_run)
+            if encoder:
+                # Un campione a ogni poll; durante il backoff si accumulano e partono insieme
+                encoder.add_sample(collect_system_metrics())
+                if now < next_send:
+                    await asyncio.sleep(poll)
+                    continue
+                payload = encoder.build(name, pkey)
+                success, data = await post_keepalive(session, url, payload, meter, gzip_min_bytes, dry_run)
+                encoder.ack(success, data)
+            else:
+                success = await send_keepalive(session, url, name, pkey, dry_run, meter)
+            meter.maybe_report()
             # backoff su errori
             if success:
                 failure_count=0; interval=poll
@@ -198,6 +407,9 @@ async def main():
                 failure_count+=1
                 interval = min(poll*(2**failure_count), poll*10)
                 logger.info("Prossimo tentativo in %ds (failure_count=%d)", interval, failure_count)
+            if encoder:
+                next_send = now + interval
+                interval = poll
             await asyncio.sleep(interval)
 
 if __name__=='__main__':
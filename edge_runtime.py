@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+edge_runtime.py - runtime unico (opzionale) per un RADIOCONTROL.
+
+Esegue nello stesso processo, come task asyncio, i servizi che normalmente
+girano come script separati:
+- lettore SportIdent (read_serial.main_loop, in un thread: la seriale è bloccante);
+- servizio Meshtastic (meshtastic_service, app FastAPI servita da uvicorn);
+- keepalive verso il server (callhome.main);
+- invio online dei record (send_data_internet, opzionale: read_serial
+  invia già online e ritenta i record non inviati).
+
+Risorse condivise:
+- un solo interprete Python e lo stesso config.ini per tutti i servizi;
+- un pool MySQL per lettore e invio online, al posto di una connessione per query;
+- identità del dispositivo (nome, pkey) letta una volta e aggiornata ogni IDENTITY_TTL;
+- le punzonature passano dal lettore alla coda di trasmissione della radio
+  direttamente in memoria, senza HTTP né socket.
+
+Gli script restano utilizzabili singolarmente; questo runtime si abilita
+installando edge_runtime.service al posto dei servizi separati.
+
+Configurazione (sezione [RUNTIME] di config.ini, tutte facoltative):
+    MESH_SERVICE = true            ; avvia meshtastic_service
+    MESH_SERVICE_DIR = Meshtastic/Raspberry_RADIOCONTROL
+    CALLHOME = true
+    UPLINK = false                 ; avvia send_data_internet
+    DB_POOL_SIZE = 4
+    IDENTITY_TTL = 3600
+
+Uso: python3 edge_runtime.py [--create-service]
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import pooling
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# meshtastic_service e callhome leggono config.ini e scrivono i log relativi alla directory corrente
+os.chdir(BASE_DIR)
+
+import read_serial  # noqa: E402
+
+
+class SharedConnectionPool:
+    """
+    Pool MySQL condiviso tra i thread dei servizi. Il pool di mysql.connector
+    non attende una connessione libera: qui si riprova per `wait` secondi e
+    poi si apre una connessione diretta, così un picco non fa perdere query.
+    """
+    def __init__(self, db_config, size=4, wait=2.0):
+        self.db_config = db_config
+        self.wait = wait
+        self._pool = pooling.MySQLConnectionPool(pool_name="edge_pool", pool_size=size, **db_config)
+        self._stats = {'pooled': 0, 'overflow': 0}
+
+    def get_connection(self):
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                conn = self._pool.get_connection()
+                self._stats['pooled'] += 1
+                return conn
+            except pooling.PoolError:
+                if time.monotonic() >= deadline:
+                    break
+                time.sleep(0.05)
+        self._stats['overflow'] += 1
+        logging.warning("[runtime] Pool MySQL esaurito, connessione diretta")
+        return mysql.connector.connect(**self.db_config)
+
+    def get_stats(self):
+        return dict(self._stats)
+
+
+class IdentityCache:
+    """(nome, pkey) dalla tabella costanti, riletti al massimo ogni `ttl` secondi"""
+
+    def __init__(self, pool, ttl=3600):
+        self.pool = pool
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._value = (None, None)
+        self._loaded_at = float('-inf')
+
+    def _load(self):
+        conn = self.pool.get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT nome, valore FROM costanti WHERE nome IN ('nome','pkey')")
+            rows = cur.fetchall()
+            cur.close()
+        finally:
+            conn.close()
+        values = {r[0]: r[1] for r in rows}
+        return values.get('nome'), values.get('pkey')
+
+    def get(self):
+        with self._lock:
+            name, pkey = self._value
+            # Senza identità valida si riprova a ogni chiamata (es. dispositivo non ancora registrato)
+            if name and pkey and time.monotonic() - self._loaded_at < self.ttl:
+                return self._value
+            try:
+                self._value = self._load()
+                self._loaded_at = time.monotonic()
+            except Exception as e:
+                logging.error("[runtime] Errore lettura identità dispositivo: %s", e)
+            return self._value
+
+    async def get_async(self):
+        return await asyncio.to_thread(self.get)
+
+
+class InProcessMeshTransport:
+    """
+    Sostituisce MeshIPCClient di read_serial quando il servizio mesh è nello
+    stesso processo: il payload va direttamente nella coda di trasmissione.
+    Chiamato dai thread del lettore, attende la conferma come il socket IPC.
+    Non solleva mai MeshIPCUnavailable: nel runtime read_serial non ripiega su HTTP.
+    """
+    def __init__(self, loop, service, timeout=15.0):
+        self.loop = loop
+        self.service = service
+        self.timeout = timeout
+
+    def send(self, payload):
+        coro = self.service.send_and_wait(payload, self.service.payload_msg_type(payload))
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            # Smette solo di attendere: il payload già accodato viene comunque trasmesso
+            future.cancel()
+            raise RuntimeError("ERR 504 Timeout invio sulla mesh")
+        except self.service.HTTPException as e:
+            raise RuntimeError(f"ERR {e.status_code} {e.detail}")
+
+    def close(self):
+        pass
+
+
+def _import_mesh_service(config):
+    """Importa meshtastic_service (la porta radio viene cercata all'import)"""
+    service_dir = config.get('RUNTIME', 'MESH_SERVICE_DIR', fallback='Meshtastic/Raspberry_RADIOCONTROL')
+    service_dir = os.path.join(BASE_DIR, service_dir)
+    if service_dir not in sys.path:
+        sys.path.insert(0, service_dir)
+    try:
+        import meshtastic_service
+    except Exception as e:
+        logging.error("[runtime] Servizio Meshtastic non disponibile: %s", e)
+        return None
+    return meshtastic_service
+
+
+async def run(config):
+    section = config['RUNTIME'] if config.has_section('RUNTIME') else config['DEFAULT']
+    db_config = {
+        'user': config['DATABASE']['USER'],
+        'password': config['DATABASE']['PASSWORD'],
+        'host': config['DATABASE']['HOST'],
+        'database': config['DATABASE']['DATABASE']
+    }
+    pool = SharedConnectionPool(db_config, size=section.getint('DB_POOL_SIZE', 4))
+    identity = IdentityCache(pool, ttl=section.getfloat('IDENTITY_TTL', 3600))
+    read_serial.connection_provider = pool.get_connection
+    read_serial.identity_provider = identity.get
+
+    loop = asyncio.get_running_loop()
+    tasks = {}
+    server = None
+
+    def stop():
+        logging.info("[runtime] Arresto dei servizi")
+        read_serial.shutdown_event.set()
+        if server is not None:
+            server.should_exit = True
+        for name, task in tasks.items():
+            if name not in ('reader', 'mesh'):
+                task.cancel()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+
+    if section.getboolean('MESH_SERVICE', True):
+        service = _import_mesh_service(config)
+        if service is not None:
+            import uvicorn
+            service.identity_provider = identity.get
+            server = uvicorn.Server(uvicorn.Config(service.app, host="0.0.0.0",
+                                                   port=service.HTTP_PORT, log_level="info"))
+            tasks['mesh'] = asyncio.create_task(server.serve())
+            read_serial.mesh_ipc = InProcessMeshTransport(
+                loop, service, config.getfloat('MESHTASTIC', 'IPC_TIMEOUT', fallback=15))
+
+    if section.getboolean('CALLHOME', True):
+        import callhome
+        tasks['callhome'] = asyncio.create_task(
+            callhome.main(callhome.load_config(), identity_provider=identity.get_async))
+
+    if section.getboolean('UPLINK', False):
+        import send_data_internet
+        send_data_internet.connection_provider = pool.get_connection
+        send_data_internet.identity_provider = identity.get
+        # Loop infinito con sleep bloccante: thread daemon, termina con il processo
+        threading.Thread(target=send_data_internet.main_service_loop, name="uplink", daemon=True).start()
+
+    def reader():
+        read_serial.setup_gpio()
+        try:
+            read_serial.activate_indicator()
+            read_serial.main_loop(config)
+        finally:
+            read_serial.cleanup_gpio()
+
+    def report(name, task):
+        if not task.cancelled() and task.exception():
+            logging.error("[runtime] Servizio %s terminato con errore: %s", name, task.exception())
+
+    for name, task in tasks.items():
+        task.add_done_callback(lambda t, name=name: report(name, t))
+    tasks['reader'] = asyncio.create_task(asyncio.to_thread(reader))
+    logging.info("[runtime] Servizi avviati: %s", ", ".join(tasks))
+
+    # Il lettore è il servizio principale: gli altri possono fermarsi senza fermarlo
+    try:
+        await tasks['reader']
+    finally:
+        stop()
+    await asyncio.gather(*tasks.values(), return_exceptions=True)
+    logging.info("[runtime] Terminato. Pool MySQL: %s", pool.get_stats())
+
+
+def create_service_file():
+    script_path = os.path.abspath(__file__)
+    service_content = f"""[Unit]
+Description=RADIOCONTROL edge runtime (lettore, mesh, callhome)
+After=network.target mysql.service
+
+[Service]
+User=pi
+WorkingDirectory={os.path.dirname(script_path)}
+ExecStart=/usr/bin/python3 {script_path}
+Restart=always
+RestartSec=10
+Environment=PYTHONUNBUFFERED=1
+
+[Install]
+WantedBy=multi-user.target
+"""
+    service_path = os.path.join(os.path.dirname(script_path), 'edge_runtime.service')
+    with open(service_path, 'w') as f:
+        f.write(service_content)
+    print(f"File di servizio creato in {service_path}")
+    print("Disabilita i servizi separati (sportident, meshtastic, callhome) prima di installarlo:")
+    print(f"  sudo cp {service_path} /etc/systemd/system/")
+    print("  sudo systemctl daemon-reload")
+    print("  sudo systemctl enable --now edge_runtime.service")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--create-service":
+        create_service_file()
+        sys.exit(0)
+
+    config = read_serial.load_config()
+    read_serial.setup_logging(config)
+    try:
+        asyncio.run(run(config))
+    except Exception as e:
+        logging.critical("[runtime] Errore fatale: %s", e, exc_info=True)
+        sys.exit(1)
@@ -14,7 +14,8 @@ import configparser
 import serial
 import threading
 import sys
-import psutil
+import socket
+import struct
 from logging.handlers import RotatingFileHandler
 from datetime import datetime, timedelta
 from concurrent.futures import ThreadPoolExecutor
@@ -23,6 +24,9 @@ import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from construct import *
+from system_metrics import get_sampler
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'core'))
+from time_sync_manager import ClockModel
 import RPi.GPIO as GPIO
 
 # Costante per tipo messaggio punches
@@ -35,6 +39,13 @@ session = None
 shutdown_event = threading.Event()
 config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'config.ini')
 log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+clock_state_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'clock_state.json')
+clock_correction = None
+mesh_ipc = None
+# Impostati da edge_runtime quando il lettore gira nel processo unico:
+# pool di connessioni e identità del dispositivo condivisi con gli altri servizi
+connection_provider = None
+identity_provider = None
 
 # PIN PER LED E BUZZER
 # Definisci i pin (BCM numbering)
@@ -331,20 +342,23 @@ def extract_frame(buffer: bytearray):
     return frame, newbuf
 
 
-def decode_sportident(raw: bytes):
+def decode_sportident(raw: bytes, received_at=None):
     if not (raw.startswith(b"\x02") and raw.endswith(b"\x03")):
         logging.error("Frame non completo (mancano STX/ETX): %s", raw.hex())
         return None
     try:
+        # Istante di ricezione corretto con il modello dell'orologio (vedi ClockCorrection)
+        received_at = received_at or corrected_now()
         clean_frame = remove_dle(raw)
         p = SiPacket.parse(clean_frame)
         secs = convert_extended_time(p.Td, p.ThTl, p.Tsubsec)
-        base = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+        base = received_at.replace(hour=0, minute=0, second=0, microsecond=0)
         dt = base + timedelta(seconds=secs)
         return {
             'control': p.Cn_low,
             'card_number': p.SiNr,
             'punch_time': dt,
+            'received_at': received_at,
             'raw_punch_data': raw.hex()
         }
     except Exception as e:
@@ -352,11 +366,59 @@ def decode_sportident(raw: bytes):
         return None
 
 
+# --------------------------
+# CORREZIONE OROLOGIO
+# --------------------------
+class ClockCorrection:
+    """
+    Applica agli istanti locali il ClockModel pubblicato da TimeSyncManager
+    (meshtastic_service, modalità slew): offset, deriva e slew non ancora
+    completato. Il file viene riletto solo quando cambia.
+    """
+    def __init__(self, path, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._mtime = None
+        self._model = None
+
+    def _reload(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self._model = None
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            self._model = ClockModel.load(self.path)
+            self._mtime = mtime
+        except (OSError, ValueError) as e:
+            logging.warning("Stato orologio non leggibile (%s): %s", self.path, e)
+
+    def offset_at(self, timestamp):
+        self._reload()
+        return self._model.offset_at(timestamp) if self._model else 0.0
+
+    def timestamp(self):
+        now = self.clock()
+        return now + self.offset_at(now)
+
+    def now(self):
+        return datetime.fromtimestamp(self.timestamp())
+
+
+def corrected_now():
+    """datetime.now() corretto con lo stato di TimeSyncManager, se disponibile"""
+    return clock_correction.now() if clock_correction else datetime.now()
+
+
 # --------------------------
 # FUNZIONI DATABASE
 # --------------------------
 def get_db_connection(db_config):
     try:
+        if connection_provider:
+            return connection_provider()
         return mysql.connector.connect(**db_config)
     except mysql.connector.Error as e:
         logging.error("DB conn error: %s", e)
@@ -379,7 +441,7 @@ def insert_into_db(parsed, db_config):
         parsed['card_number'],
         parsed['punch_time'].strftime('%Y-%m-%d %H:%M:%S.%f'),
         parsed['raw_punch_data'],
-        datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        parsed.get('received_at', datetime.now()).strftime('%Y-%m-%d %H:%M:%S')
     )
     try:
         with threading.Lock():
@@ -444,6 +506,8 @@ def mark_record_as_sent(record_id, db_config):
 
 
 def get_device_identifiers(db_config):
+    if identity_provider:
+        return identity_provider()
     conn = get_db_connection(db_config)
     if not conn:
         return None, None
@@ -542,6 +606,85 @@ def send_record_online(record, config, session, db_config):
 
     return True
 
+class MeshIPCUnavailable(Exception):
+    """Il frame non è arrivato a meshtastic_service (socket assente, rifiutato o chiuso)"""
+
+
+class MeshIPCClient:
+    """
+    Client del socket Unix di meshtastic_service: una connessione persistente,
+    frame 'lunghezza (4 byte big-endian) + payload', risposta 'OK' oppure
+    'ERR <codice> <dettaglio>' quando il messaggio è stato (o non è stato)
+    passato alla radio. Thread-safe: gli invii vengono serializzati.
+    """
+    def __init__(self, path, timeout=15.0):
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        self._sock = sock
+
+    def _recv_exactly(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self._sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("connessione IPC chiusa da meshtastic_service")
+            data += chunk
+        return data
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+            self._sock = None
+
+    def _exchange(self, frame):
+        """Invia il frame e legge la risposta; MeshIPCUnavailable se il frame non è partito"""
+        try:
+            if self._sock is None:
+                self._connect()
+            self._sock.sendall(frame)
+        except OSError as e:
+            self.close()
+            raise MeshIPCUnavailable(str(e)) from e
+        try:
+            header = self._recv_exactly(4)
+            return self._recv_exactly(struct.unpack('>I', header)[0]).decode('utf-8')
+        except OSError:
+            self.close()
+            raise
+
+    def send(self, payload):
+        """
+        Invia un payload e attende la conferma. MeshIPCUnavailable: il frame non ha
+        raggiunto il servizio. Qualsiasi altro errore: il frame è stato consegnato
+        e il messaggio potrebbe essere già in coda alla radio.
+        """
+        data = payload.encode('utf-8')
+        frame = struct.pack('>I', len(data)) + data
+        with self._lock:
+            reused = self._sock is not None
+            try:
+                reply = self._exchange(frame)
+            except (MeshIPCUnavailable, ConnectionError) as e:
+                if not reused:
+                    raise
+                # Connessione persistente chiusa dal servizio (es. riavvio) prima di
+                # leggere il frame: un nuovo tentativo su una connessione nuova
+                logging.info("Connessione IPC mesh persa (%s), riconnessione", e)
+                reply = self._exchange(frame)
+        if reply != 'OK':
+            raise RuntimeError(reply)
+
+
 def send_record_mesh(record, config, _unused, db_config):
     """Invia un record alla mesh tramite l’endpoint /send_raw in formato ';'-separato."""
     name, pkey = get_device_identifiers(db_config)
@@ -552,7 +695,7 @@ def send_record_mesh(record, config, _unused, db_config):
     port = config['MESHTASTIC']['HTTP_PORT']
     url = f"http://{host}:{port}/send_raw"       # 🡐 usa send_raw, non send_payload
 
-    timestamp = time.time()
+    timestamp = clock_correction.timestamp() if clock_correction else time.time()
     punch_time = record['punch_time']
     if isinstance(punch_time, datetime):
         punch_time = punch_time.isoformat()
@@ -569,6 +712,20 @@ def send_record_mesh(record, config, _unused, db_config):
     ]
     payload = ";".join(parts)
 
+    if mesh_ipc:
+        try:
+            mesh_ipc.send(payload)
+            logging.info(f"✅ [MESH IPC] Record {record['id']} inviato: {payload}")
+            return True
+        except MeshIPCUnavailable as e:
+            # Servizio senza socket o in riavvio: il frame non è partito, si prova via HTTP
+            logging.warning(f"⚠️ [MESH IPC] Servizio non raggiungibile per il record {record['id']}: {e}, uso HTTP")
+        except Exception as e:
+            # Frame consegnato: il messaggio può essere già in coda alla radio (es. ERR 504),
+            # niente reinvio immediato via HTTP; il record resta a retry_unsent_records
+            logging.warning(f"⚠️ [MESH IPC] Record {record['id']} non confermato: {e}")
+            return False
+
     try:
         resp = requests.post(
             url,
@@ -597,23 +754,20 @@ def process_record(record_id, config, session, db_config):
 # --------------------------
 def check_system_health():
     try:
-        cpu_percent = psutil.cpu_percent(interval=1)
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('/')
-        temp = None
-        if os.path.exists('/sys/class/thermal/thermal_zone0/temp'):
-            with open('/sys/class/thermal/thermal_zone0/temp', 'r') as f:
-                temp = float(f.read()) / 1000.0
+        # Ultimo campione del thread di system_metrics: nessuna attesa
+        metrics = get_sampler().snapshot()
+        cpu_percent = metrics.get('cpu_percent')
+        temp = metrics.get('temperature')
 
         health_data = {
             'cpu_percent': cpu_percent,
-            'memory_percent': memory.percent,
-            'disk_percent': disk.percent,
+            'memory_percent': metrics.get('memory_percent'),
+            'disk_percent': metrics.get('disk_percent'),
             'temperature': temp
         }
         if temp and temp > 80:
             logging.warning("Temperatura CPU elevata: %.1f°C", temp)
-        if cpu_percent > 90:
+        if cpu_percent and cpu_percent > 90:
             logging.warning("Utilizzo CPU elevato: %.1f%%", cpu_percent)
         return health_data
     except Exception as e:
@@ -680,7 +834,7 @@ def optimize_raspberry_pi(config):
 # --------------------------
 def main_loop(config, config_file_path=config_path):
     # rendiamo esecutore accessibili globalmente
-    global executor
+    global executor, clock_correction, mesh_ipc
 
     # Carica e aggiorna dinamicamente il config.ini
     parser = configparser.ConfigParser()
@@ -729,6 +883,17 @@ def main_loop(config, config_file_path=config_path):
     except Exception as e:
         logging.warning(f"Errore ottimizzazione Raspberry Pi: {e}")
 
+    # Correzione dell'orologio pubblicata da TimeSyncManager (modalità slew)
+    if config.has_section('TIME_SYNC') and config['TIME_SYNC'].getboolean('CORRECT_PUNCHES', True):
+        clock_correction = ClockCorrection(config['TIME_SYNC'].get('CLOCK_STATE_FILE', clock_state_path))
+        logging.info("Correzione orologio attiva (%s)", clock_correction.path)
+
+    # Invio alla mesh via socket Unix di meshtastic_service, con HTTP come riserva
+    ipc_socket = config['MESHTASTIC'].get('IPC_SOCKET', '') if config.has_section('MESHTASTIC') else ''
+    if ipc_socket and mesh_ipc is None:
+        mesh_ipc = MeshIPCClient(ipc_socket, float(config['MESHTASTIC'].get('IPC_TIMEOUT', '15')))
+        logging.info("Invio mesh via socket IPC %s", ipc_socket)
+
     # ThreadPool per elaborazioni asincrone
     max_workers = int(config['EXECUTION'].get('MAX_WORKERS', '3'))
     executor = ThreadPoolExecutor(max_workers=max_workers)
@@ -818,6 +983,9 @@ def main_loop(config, config_file_path=config_path):
         except Exception as e:
             logging.error(f"Error closing HTTP session: {e}")
 
+    if mesh_ipc:
+        mesh_ipc.close()
+
     logging.info("Programma terminato")
 
 def _log_db_error(error_type, description, config):
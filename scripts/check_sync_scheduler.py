@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Verifica di SyncBroadcastScheduler con reader simulati.
+
+Un receiver trasmette i TIME_SYNC secondo lo scheduler; dopo ogni sync i
+reader inviano una raffica di richieste riportando offset ed errore. Un
+reader stabile con un offset costante che non corregge non deve riportare
+l'intervallo al minimo; un reader con offset instabili sì.
+
+Uso: python3 scripts/check_sync_scheduler.py [--hours 6] [--offset 1.5] [--seed 1]
+"""
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'core'))
+
+from time_sync_manager import SyncBroadcastScheduler  # noqa: E402
+
+
+def simulate(offsets, hours: float = 6.0, error: float = 0.2, burst: int = 3, seed: int = 1):
+    """offsets(rng) -> offset riportato dal reader a ogni richiesta. Restituisce le statistiche dello scheduler"""
+    rng = random.Random(seed)
+    scheduler = SyncBroadcastScheduler(min_interval=30, max_interval=1800, rng=random.Random(seed))
+    scheduler.start(0.0)
+    now = 0.0
+    while now < hours * 3600:
+        if scheduler.poll(now):
+            for i in range(burst):
+                scheduler.reader_report('reader-sim', offsets(rng), now + 2 * (i + 1), error)
+        now += 1.0
+    return scheduler.stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verifica SyncBroadcastScheduler')
+    parser.add_argument('--hours', type=float, default=6.0, help='Durata simulata (ore)')
+    parser.add_argument('--offset', type=float, default=1.5, help='Offset costante non corretto del reader (s)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # Tetto dei sync in `hours` con l'intervallo che raddoppia da 30s a 1800s e non viene mai azzerato
+    expected = 6 + int(args.hours * 3600 / 1800)
+    stable = simulate(lambda rng: args.offset + rng.gauss(0, 0.02), args.hours, seed=args.seed)
+    unstable = simulate(lambda rng: rng.uniform(-3, 3), args.hours, seed=args.seed)
+    print(f"Reader stabile (offset {args.offset:+.1f}s non corretto): {stable}")
+    print(f"Reader instabile: {unstable}")
+
+    failures = []
+    if stable['resets'] or stable['broadcasts'] > expected:
+        failures.append(f"reader stabile: attesi 0 reset e al più {expected} sync")
+    if not unstable['resets']:
+        failures.append("reader instabile: atteso almeno un reset")
+    for failure in failures:
+        print(f"ERRORE {failure}")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
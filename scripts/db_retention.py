@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Retention database MySQL per OriBruniRadioControls
+Aggrega e cancella a piccoli batch le righe vecchie di meshtastic_log e messaggi,
+poi esegue OPTIMIZE TABLE. Pensato per girare da cron in orario notturno.
+"""
+
+import sys
+import time
+import logging
+import argparse
+import configparser
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+import mysql.connector
+
+# Tabelle gestite: colonna temporale e giorni di retention di default
+RETENTION_TABLES = {
+    'meshtastic_log': {'time_column': 'event_time', 'days': 30},
+    'messaggi': {'time_column': 'data_ora', 'days': 60},
+}
+
+# Aggregato orario di messaggi (per nodo e tipo) conservato dopo la cancellazione
+CREATE_MESSAGGI_HOURLY = """
+CREATE TABLE IF NOT EXISTS messaggi_hourly (
+    id_nodo VARCHAR(64) NOT NULL,
+    bucket DATETIME NOT NULL,
+    tipo_messaggio VARCHAR(16) NOT NULL,
+    messages INT NOT NULL,
+    avg_rssi FLOAT,
+    avg_snr FLOAT,
+    avg_hops FLOAT,
+    PRIMARY KEY (id_nodo, bucket, tipo_messaggio)
+)
+"""
+
+CREATE_RETENTION_STATE = """
+CREATE TABLE IF NOT EXISTS retention_state (
+    table_name VARCHAR(64) PRIMARY KEY,
+    watermark DATETIME NOT NULL
+)
+"""
+
+ROLLUP_MESSAGGI = """
+INSERT INTO messaggi_hourly (id_nodo, bucket, tipo_messaggio, messages, avg_rssi, avg_snr, avg_hops)
+SELECT COALESCE(id_nodo, ''), DATE_FORMAT(data_ora, '%%Y-%%m-%%d %%H:00:00') AS bucket,
+       COALESCE(tipo_messaggio, ''), COUNT(*), AVG(RSSI), AVG(SNR), AVG(Hops)
+FROM messaggi
+WHERE data_ora >= %s AND data_ora < %s
+GROUP BY 1, 2, 3
+ON DUPLICATE KEY UPDATE
+    avg_rssi = (avg_rssi * messages + VALUES(avg_rssi) * VALUES(messages)) / (messages + VALUES(messages)),
+    avg_snr = (avg_snr * messages + VALUES(avg_snr) * VALUES(messages)) / (messages + VALUES(messages)),
+    avg_hops = (avg_hops * messages + VALUES(avg_hops) * VALUES(messages)) / (messages + VALUES(messages)),
+    messages = messages + VALUES(messages)
+"""
+
+
+class MySQLRetention:
+    """Retention, rollup e ottimizzazione delle tabelle di log MySQL"""
+
+    def __init__(self, db_config: Dict[str, Any], batch_size: int = 1000, pause: float = 0.1):
+        self.db_config = db_config
+        self.batch_size = batch_size
+        self.pause = pause
+        self.logger = logging.getLogger('MySQLRetention')
+        self.cnx = None
+
+    def connect(self):
+        self.cnx = mysql.connector.connect(**self.db_config, charset='utf8mb4', autocommit=False)
+        return self.cnx
+
+    def close(self):
+        if self.cnx and self.cnx.is_connected():
+            self.cnx.close()
+
+    def table_exists(self, table: str) -> bool:
+        cursor = self.cnx.cursor()
+        cursor.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s",
+            (table,)
+        )
+        exists = cursor.fetchone()[0] > 0
+        cursor.close()
+        return exists
+
+    def _get_watermark(self, table: str) -> Optional[datetime]:
+        cursor = self.cnx.cursor()
+        cursor.execute("SELECT watermark FROM retention_state WHERE table_name = %s", (table,))
+        row = cursor.fetchone()
+        cursor.close()
+        return row[0] if row else None
+
+    def rollup_messaggi(self, cutoff: datetime) -> datetime:
+        """
+        Aggrega per ora le righe di messaggi fino a cutoff (arrotondato all'ora).
+        Il watermark salvato nella stessa transazione evita di contare due volte
+        un intervallo se il processo viene interrotto. Restituisce il watermark.
+        """
+        cursor = self.cnx.cursor()
+        cursor.execute(CREATE_MESSAGGI_HOURLY)
+        cursor.execute(CREATE_RETENTION_STATE)
+        end = cutoff.replace(minute=0, second=0, microsecond=0)
+        start = self._get_watermark('messaggi') or datetime(1970, 1, 1)
+        if end > start:
+            cursor.execute(ROLLUP_MESSAGGI, (start, end))
+            aggregated = cursor.rowcount
+            cursor.execute(
+                "REPLACE INTO retention_state (table_name, watermark) VALUES (%s, %s)",
+                ('messaggi', end)
+            )
+            self.cnx.commit()
+            self.logger.info(f"Rollup messaggi [{start} - {end}): {aggregated} righe aggregate")
+        cursor.close()
+        return max(start, end)
+
+    def delete_older_than(self, table: str, time_column: str, cutoff: datetime) -> int:
+        """Cancella a batch (ognuno nella sua transazione) le righe con time_column < cutoff"""
+        deleted = 0
+        cursor = self.cnx.cursor()
+        query = f"DELETE FROM {table} WHERE {time_column} < %s ORDER BY {time_column} LIMIT %s"
+        while True:
+            cursor.execute(query, (cutoff, self.batch_size))
+            self.cnx.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < self.batch_size:
+                break
+            # Lascia respirare i servizi che scrivono sulla stessa tabella
+            time.sleep(self.pause)
+        cursor.close()
+        self.logger.info(f"{table}: cancellate {deleted} righe precedenti a {cutoff}")
+        return deleted
+
+    def optimize(self, table: str):
+        cursor = self.cnx.cursor()
+        cursor.execute(f"OPTIMIZE TABLE {table}")
+        cursor.fetchall()
+        cursor.close()
+        self.logger.info(f"{table}: OPTIMIZE TABLE completato")
+
+    def run(self, retention_days: Dict[str, float], optimize: bool = False) -> Dict[str, int]:
+        results = {}
+        now = datetime.now()
+        for table, settings in RETENTION_TABLES.items():
+            if not self.table_exists(table):
+                self.logger.debug(f"Tabella {table} assente, saltata")
+                continue
+            cutoff = now - timedelta(days=retention_days.get(table, settings['days']))
+            if table == 'messaggi':
+                # Si cancella solo ciò che è già stato aggregato
+                cutoff = min(cutoff, self.rollup_messaggi(cutoff))
+            results[table] = self.delete_older_than(table, settings['time_column'], cutoff)
+            if optimize and results[table]:
+                self.optimize(table)
+        return results
+
+
+def load_db_config(config_path: Path) -> Dict[str, Any]:
+    """Legge i parametri MySQL da [DATABASE] (lettori) o [mysql] (ricevitori)"""
+    config = configparser.ConfigParser()
+    config.read(config_path)
+    section = 'DATABASE' if config.has_section('DATABASE') else 'mysql'
+    if not config.has_section(section):
+        raise RuntimeError(f"Nessuna sezione [DATABASE] o [mysql] in {config_path}")
+    db = config[section]
+    return {
+        'host': db.get('host', 'localhost'),
+        'port': db.getint('port', 3306),
+        'user': db.get('user'),
+        'password': db.get('password', '').strip(),
+        'database': db.get('database', 'OriBruniRadioControls'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Retention tabelle di log MySQL OriBruni RadioControls')
+    parser.add_argument('--config', default=str(Path(__file__).resolve().parent.parent / 'config.ini'),
+                        help='File config.ini con i parametri del database')
+    parser.add_argument('--meshtastic-log-days', type=float, default=RETENTION_TABLES['meshtastic_log']['days'])
+    parser.add_argument('--messaggi-days', type=float, default=RETENTION_TABLES['messaggi']['days'])
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--optimize', action='store_true', help='Esegue OPTIMIZE TABLE dopo la pulizia')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    retention = MySQLRetention(load_db_config(Path(args.config)), batch_size=args.batch_size)
+    try:
+        retention.connect()
+        results = retention.run(
+            {'meshtastic_log': args.meshtastic_log_days, 'messaggi': args.messaggi_days},
+            optimize=args.optimize
+        )
+        logging.info(f"Retention completata: {results}")
+    except Exception as e:
+        logging.error(f"Errore retention database: {e}")
+        sys.exit(1)
+    finally:
+        retention.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -734,6 +734,9 @@ fi
 # Backup giornaliero alle 02:00
 0 2 * * * {self.base_path}/backup.sh >> {self.logs_path}/backup.log 2>&1
 
+# Retention tabelle di log MySQL ogni notte alle 03:30
+30 3 * * * python3 {self.base_path}/scripts/db_retention.py --optimize >> {self.logs_path}/retention.log 2>&1
+
 # Pulizia log vecchi ogni domenica alle 03:00
 0 3 * * 0 find {self.logs_path} -name "*.log" -mtime +7 -delete
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Simulazione della modalità slew di TimeSyncManager.
+
+Un reader con orologio simulato (offset iniziale e deriva dell'oscillatore)
+scambia i messaggi di time sync con un receiver esatto; ogni 5 minuti
+stampa l'errore dell'orologio e quello delle punzonature corrette con il
+ClockModel. Nessuna modifica all'orologio di sistema.
+
+Uso: python3 scripts/simulate_clock_slew.py [--offset -3] [--rate 20e-6] [--hours 6] [--delay 1.5]
+"""
+
+import argparse
+import os
+import sys
+from typing import List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'core'))
+
+from time_sync_manager import SLEW_RATE, TimeSyncManager  # noqa: E402
+
+
+class SimulatedClock:
+    """
+    Orologio simulato per i test della modalità slew: parte con un offset,
+    deriva di `rate` (es. 20e-6 = 20 ppm) e applica gli slew a SLEW_RATE.
+    """
+
+    def __init__(self, start: float = 1_700_000_000.0, offset: float = 0.0, rate: float = 0.0):
+        self.true_time = start
+        self._start = start
+        self.offset = offset
+        self.rate = rate
+        self._slews: List[Tuple[float, float]] = []  # (istante vero di avvio, ampiezza)
+
+    def advance(self, seconds: float):
+        self.true_time += seconds
+
+    def slew(self, amount: float) -> bool:
+        # Come adjtime: un nuovo slew sostituisce la parte non ancora applicata
+        self._slews = [(t, self._applied(t, a, self.true_time)) for t, a in self._slews]
+        self._slews.append((self.true_time, amount))
+        return True
+
+    def step(self, new_timestamp: float) -> bool:
+        self.offset += new_timestamp - self()
+        return True
+
+    @staticmethod
+    def _applied(started: float, amount: float, at: float) -> float:
+        done = min(abs(amount), SLEW_RATE * (at - started))
+        return done if amount > 0 else -done
+
+    def __call__(self) -> float:
+        slewed = sum(self._applied(t, a, self.true_time) for t, a in self._slews)
+        return self.true_time + self.offset + self.rate * (self.true_time - self._start) + slewed
+
+
+def simulate_slew(offset: float = -3.0, rate: float = 20e-6, hours: float = 6.0, delay: float = 1.5):
+    """Reader con orologio simulato e receiver esatto: errore delle punzonature corrette nel tempo"""
+    reference = SimulatedClock()
+    reader_clock = SimulatedClock(offset=offset, rate=rate)
+    receiver = TimeSyncManager("receiver-sim", "receiver", clock=lambda: reference.true_time)
+    reader = TimeSyncManager("reader-sim", "reader", clock=reader_clock, clock_mode='slew',
+                             slew_callback=reader_clock.slew, min_request_interval=0)
+    reader._update_system_time = reader_clock.step
+
+    outbox: List[Tuple[str, str]] = []
+    receiver.send_message_callback = lambda p: outbox.append(('reader', p)) or True
+    reader.send_message_callback = lambda p: outbox.append(('receiver', p)) or True
+
+    def advance(seconds: float):
+        reference.advance(seconds)
+        reader_clock.advance(seconds)
+
+    for step in range(int(hours * 3600 / 300)):
+        receiver.send_time_sync()
+        while outbox:
+            target, payload = outbox.pop(0)
+            advance(delay)  # transito LoRa
+            (reader if target == 'reader' else receiver).process_time_sync_message(payload)
+        advance(300)
+        error = reader.correct_timestamp() - reference.true_time
+        raw_error = reader_clock() - reference.true_time
+        print(f"t={step * 5:4d} min  orologio {raw_error:+7.3f}s  punzonatura corretta {error:+7.3f}s")
+    return reader.get_time_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulazione slew TimeSyncManager')
+    parser.add_argument('--offset', type=float, default=-3.0, help='Offset iniziale del reader (s)')
+    parser.add_argument('--rate', type=float, default=20e-6, help='Deriva del reader (es. 20e-6 = 20 ppm)')
+    parser.add_argument('--hours', type=float, default=6.0, help='Durata simulata (ore)')
+    parser.add_argument('--delay', type=float, default=1.5, help='Transito LoRa di ogni messaggio (s)')
+    args = parser.parse_args()
+
+    print(f"Simulazione slew (offset {args.offset:+.1f}s, deriva {args.rate * 1e6:.0f} ppm):")
+    status = simulate_slew(args.offset, args.rate, args.hours, args.delay)
+    print(f"Stato reader simulato: {status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -32,8 +32,14 @@ db_config = {
 # URL del servizio remoto
 REMOTE_URL = "https://orienteering.services/radiocontrol/receive_data.php"
 
+# Impostati da edge_runtime quando il servizio gira nel processo unico
+connection_provider = None
+identity_provider = None
+
 def get_db_connection():
     try:
+        if connection_provider:
+            return connection_provider()
         return mysql.connector.connect(**db_config)
     except mysql.connector.Error as err:
         logging.error("Errore di connessione al DB: %s", err)
@@ -44,6 +50,8 @@ def get_device_identifiers():
     Recupera i valori 'nome' e 'pkey' dalla tabella costanti.
     Restituisce (nome, pkey) oppure (None, None) in caso di errore.
     """
+    if identity_provider:
+        return identity_provider()
     conn = get_db_connection()
     if not conn:
         return None, None
@@ -4,11 +4,17 @@ Time Sync Manager per OriBruniRadioControls
 Gestisce la sincronizzazione temporale tra RICEVITORI e LETTORI via Meshtastic
 """
 
+import os
 import time
 import threading
 import logging
+import ctypes
+import ctypes.util
+import random
+import statistics
+from collections import deque
 from datetime import datetime, timedelta
-from typing import Optional, Dict, Any, Callable
+from typing import Optional, Dict, Any, Callable, List, Tuple
 from dataclasses import dataclass
 from enum import IntEnum
 import json
@@ -18,6 +24,8 @@ class MessageType(IntEnum):
     TELEMETRY = 0
     PUNCHES = 1
     TIME_SYNC = 2  # Nuovo tipo per sincronizzazione temporale
+    TIME_SYNC_REQUEST = 3   # Richiesta del reader (scambio a quattro timestamp)
+    TIME_SYNC_RESPONSE = 4  # Risposta del receiver con t1, t2, t3
 
 @dataclass
 class TimeSyncMessage:
@@ -36,23 +44,378 @@ class TimeStatus:
     sync_count: int = 0
     sync_source: Optional[str] = None
     is_synced: bool = False
+    offset_error: Optional[float] = None  # Errore massimo stimato dell'offset in secondi
+    round_trip: Optional[float] = None  # Ritardo di andata e ritorno del campione migliore
+    confidence: float = 0.0  # Affidabilità della stima (0-1)
+
+@dataclass
+class OffsetSample:
+    """Campione di offset: delay è None per i messaggi TIME_SYNC a una via"""
+    received_at: float
+    offset: float
+    delay: Optional[float] = None
+
+@dataclass
+class OffsetEstimate:
+    """Stima filtrata dell'offset dell'orologio locale rispetto ai receiver"""
+    offset: float
+    delay: Optional[float]
+    error_bound: float
+    jitter: float
+    confidence: float
+    samples: int
+
+class OffsetEstimator:
+    """
+    Filtro dei campioni di offset su una finestra scorrevole.
+
+    Con lo scambio a quattro timestamp (t1 invio richiesta, t2 ricezione
+    sul receiver, t3 invio risposta, t4 ricezione risposta):
+        offset = ((t2 - t1) + (t3 - t4)) / 2
+        delay  = (t4 - t1) - (t3 - t2)
+    Come il clock filter di NTP si usa il campione con il ritardo minore:
+    l'errore dell'offset è al massimo delay / 2. I soli TIME_SYNC a una via
+    (receiver non aggiornati) usano la mediana, con un errore stimato fisso.
+    """
+
+    # Errore attribuito a un campione a una via (transito LoRa sconosciuto)
+    ONE_WAY_ERROR = 2.0
+
+    def __init__(self, window: int = 8, max_age: float = 3600.0, target_accuracy: float = 0.5,
+                 min_samples: int = 3):
+        self.window = window
+        self.max_age = max_age
+        self.target_accuracy = target_accuracy
+        self.min_samples = min_samples
+        self._samples: List[OffsetSample] = []
+
+    def add(self, offset: float, delay: Optional[float], received_at: float):
+        self._samples.append(OffsetSample(received_at, offset, delay))
+        if len(self._samples) > self.window:
+            self._samples.pop(0)
+
+    def shift(self, correction: float):
+        """Riporta i campioni al nuovo orologio dopo una correzione di `correction` secondi"""
+        for sample in self._samples:
+            sample.offset -= correction
+
+    def clear(self):
+        self._samples.clear()
+
+    def __len__(self):
+        return len(self._samples)
+
+    def estimate(self, now: float) -> Optional[OffsetEstimate]:
+        self._samples = [s for s in self._samples if now - s.received_at <= self.max_age]
+        if not self._samples:
+            return None
+        two_way = [s for s in self._samples if s.delay is not None]
+        samples = two_way or self._samples
+        offsets = sorted(s.offset for s in samples)
+        median = offsets[len(offsets) // 2]
+        jitter = sorted(abs(o - median) for o in offsets)[len(offsets) // 2]
+        if two_way:
+            # A parità di ritardo vince il campione più recente
+            best = min(two_way, key=lambda s: (s.delay, -s.received_at))
+            offset, delay = best.offset, best.delay
+            error_bound = max(delay, 0.0) / 2
+        else:
+            offset, delay = median, None
+            error_bound = self.ONE_WAY_ERROR
+        confidence = min(1.0, len(samples) / self.min_samples) * \
+            self.target_accuracy / (self.target_accuracy + error_bound + jitter)
+        return OffsetEstimate(offset, delay, error_bound, jitter, round(confidence, 3), len(samples))
+
+# Velocità di slew del kernel Linux con adjtime / ADJ_OFFSET_SINGLESHOT: 500 ppm
+SLEW_RATE = 0.0005
+
+class ClockModel:
+    """
+    Modello in-process dell'orologio locale rispetto ai receiver:
+        offset(t) = offset + rate * (t - reference) + slew residuo
+    L'offset è quello che resterà a slew completato; lo slew residuo è la
+    parte di una correzione graduale che il kernel non ha ancora applicato.
+    correct(t) restituisce l'istante t corretto (es. per le punzonature).
+
+    Il modello può essere salvato su file (save/load) per i processi che
+    non ricevono i messaggi di time sync, come read_serial.py.
+    """
+
+    def __init__(self, window: int = 8, max_rate: float = SLEW_RATE, min_span: float = 60.0):
+        self.window = window
+        self.max_rate = max_rate
+        self.min_span = min_span
+        self._points: List[Tuple[float, float]] = []
+        self.offset = 0.0
+        self.rate = 0.0
+        self.reference = 0.0
+        self.slew_start = 0.0
+        self.slew_amount = 0.0
+
+    def update(self, offset: float, at: float):
+        """Aggiunge una stima filtrata dell'offset (al netto dello slew residuo)"""
+        self._points.append((at, offset))
+        if len(self._points) > self.window:
+            self._points.pop(0)
+        self.reference, self.offset = at, offset
+        span = self._points[-1][0] - self._points[0][0]
+        if len(self._points) >= 2 and span >= self.min_span:
+            # Deriva dell'oscillatore: pendenza ai minimi quadrati, limitata a max_rate
+            mean_t = sum(t for t, _ in self._points) / len(self._points)
+            mean_o = sum(o for _, o in self._points) / len(self._points)
+            var = sum((t - mean_t) ** 2 for t, _ in self._points)
+            if var > 0:
+                cov = sum((t - mean_t) * (o - mean_o) for t, o in self._points)
+                self.rate = max(-self.max_rate, min(self.max_rate, cov / var))
+
+    def remaining_slew(self, at: float) -> float:
+        if not self.slew_amount:
+            return 0.0
+        applied = SLEW_RATE * max(0.0, at - self.slew_start)
+        if applied >= abs(self.slew_amount):
+            return 0.0
+        return self.slew_amount - (applied if self.slew_amount > 0 else -applied)
+
+    def offset_at(self, at: float) -> float:
+        return self.offset + self.rate * (at - self.reference) + self.remaining_slew(at)
+
+    def correct(self, timestamp: float) -> float:
+        return timestamp + self.offset_at(timestamp)
+
+    def start_slew(self, amount: float, at: float):
+        """Registra uno slew di `amount` secondi avviato all'istante `at`"""
+        self.slew_amount = self.remaining_slew(at) + amount
+        self.slew_start = at
+        self._points = [(t, o - amount) for t, o in self._points]
+        self.offset -= amount
+
+    def stepped(self, amount: float):
+        """Registra un salto dell'orologio di `amount` secondi"""
+        self._points = [(t + amount, o - amount) for t, o in self._points]
+        self.reference += amount
+        self.offset -= amount
+        self.slew_start += amount
+
+    def to_dict(self) -> Dict[str, float]:
+        return {
+            'offset': self.offset,
+            'rate': self.rate,
+            'reference': self.reference,
+            'slew_start': self.slew_start,
+            'slew_amount': self.slew_amount,
+            'slew_rate': SLEW_RATE,
+        }
+
+    def save(self, path: str):
+        """Scrittura atomica (file temporaneo + rename) dello stato del modello"""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.to_dict(), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'ClockModel':
+        model = cls()
+        with open(path) as f:
+            state = json.load(f)
+        for key in ('offset', 'rate', 'reference', 'slew_start', 'slew_amount'):
+            setattr(model, key, float(state.get(key, 0.0)))
+        return model
+
+class _Timex(ctypes.Structure):
+    """struct timex di Linux (sys/timex.h)"""
+    _fields_ = [
+        ('modes', ctypes.c_uint), ('offset', ctypes.c_long), ('freq', ctypes.c_long),
+        ('maxerror', ctypes.c_long), ('esterror', ctypes.c_long), ('status', ctypes.c_int),
+        ('constant', ctypes.c_long), ('precision', ctypes.c_long), ('tolerance', ctypes.c_long),
+        ('time_sec', ctypes.c_long), ('time_usec', ctypes.c_long), ('tick', ctypes.c_long),
+        ('ppsfreq', ctypes.c_long), ('jitter', ctypes.c_long), ('shift', ctypes.c_int),
+        ('stabil', ctypes.c_long), ('jitcnt', ctypes.c_long), ('calcnt', ctypes.c_long),
+        ('errcnt', ctypes.c_long), ('stbcnt', ctypes.c_long), ('tai', ctypes.c_int),
+        ('_padding', ctypes.c_int * 11),
+    ]
+
+# Modalità adjtime(): correzione unica applicata gradualmente dal kernel
+ADJ_OFFSET_SINGLESHOT = 0x8001
+
+def slew_system_clock(offset: float) -> bool:
+    """
+    Avvia uno slew graduale dell'orologio di sistema di `offset` secondi con
+    adjtimex(ADJ_OFFSET_SINGLESHOT). Richiede CAP_SYS_TIME (root).
+    """
+    libc_name = ctypes.util.find_library('c')
+    if not libc_name:
+        logging.warning("libc non trovata, slew dell'orologio non disponibile")
+        return False
+    libc = ctypes.CDLL(libc_name, use_errno=True)
+    timex = _Timex(modes=ADJ_OFFSET_SINGLESHOT, offset=int(round(offset * 1_000_000)))
+    if libc.adjtimex(ctypes.byref(timex)) < 0:
+        logging.error(f"adjtimex fallita: {os.strerror(ctypes.get_errno())}")
+        return False
+    return True
+
+class SyncBroadcastScheduler:
+    """
+    Pianificazione adattiva dei TIME_SYNC dei receiver (algoritmo Trickle).
+
+    L'intervallo parte da min_interval e raddoppia a ogni periodo fino a
+    max_interval finché i reader sono stabili; torna a min_interval quando
+    compare un nuovo reader, quando la varianza degli offset riportati
+    supera unstable_jitter o quando un reader riporta un offset oltre
+    unstable_offset e oltre il proprio errore + unstable_margin che non è
+    ancora costante. Un offset costante che il reader non corregge (es.
+    sotto la soglia di step) non migliora con sync più frequenti e non
+    riduce l'intervallo. In ogni periodo il sync parte in un istante casuale della
+    seconda metà, ed è soppresso se nel frattempo sono stati sentiti almeno
+    `redundancy` sync di altri receiver entro max_suppress_hops hop: un
+    sync arrivato da lontano non copre i reader vicini.
+    """
+
+    def __init__(self, min_interval: float = 30.0, max_interval: float = 1800.0, redundancy: int = 1,
+                 max_suppress_hops: int = 1, unstable_offset: float = 1.0, unstable_jitter: float = 0.5,
+                 unstable_margin: float = 0.5, report_window: int = 5, rng: Optional[random.Random] = None):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.redundancy = redundancy
+        self.max_suppress_hops = max_suppress_hops
+        self.unstable_offset = unstable_offset
+        self.unstable_jitter = unstable_jitter
+        self.unstable_margin = unstable_margin
+        self.report_window = report_window
+        self._random = rng or random.Random()
+        self._reports: Dict[str, deque] = {}
+        self.interval = min_interval
+        self.interval_start = 0.0
+        self.fire_at = 0.0
+        self._fired = False
+        self._heard = 0
+        self.stats = {'broadcasts': 0, 'suppressed': 0, 'resets': 0}
+
+    def start(self, now: float):
+        self.interval = self.min_interval
+        self._start_interval(now)
+
+    def _start_interval(self, now: float):
+        self.interval_start = now
+        self.fire_at = now + self._random.uniform(self.interval / 2, self.interval)
+        self._fired = False
+        self._heard = 0
+
+    def reset(self, now: float, reason: str = ''):
+        """Torna all'intervallo minimo (dopo un'incoerenza)"""
+        if self.interval > self.min_interval:
+            self.stats['resets'] += 1
+            logging.getLogger('SyncBroadcastScheduler').info(
+                f"Sync ravvicinati: {reason} (intervallo {self.interval:.0f}s -> {self.min_interval:.0f}s)"
+            )
+            self.interval = self.min_interval
+            self._start_interval(now)
+
+    def heard_sync(self, hops: Optional[int]):
+        """TIME_SYNC di un altro receiver: conta per la soppressione solo se vicino"""
+        if hops is None or hops <= self.max_suppress_hops:
+            self._heard += 1
+
+    def reader_report(self, reader: str, offset: Optional[float], now: float,
+                      error: Optional[float] = None):
+        """Offset (± error) riportato da un reader nella sua richiesta di sync"""
+        reports = self._reports.get(reader)
+        if reports is None:
+            self._reports[reader] = deque(maxlen=self.report_window)
+            self.reset(now, f"nuovo reader {reader}")
+            reports = self._reports[reader]
+        if offset is None:
+            return
+        reports.append(offset)
+        if len(reports) >= 3:
+            if statistics.pstdev(reports) > self.unstable_jitter:
+                self.reset(now, f"offset instabile di {reader}")
+            # Altrimenti l'offset è costante: anche se grande, sync più frequenti non servono
+            return
+        threshold = self.unstable_offset
+        if error is not None:
+            threshold = max(threshold, error + self.unstable_margin)
+        if abs(offset) > threshold:
+            self.reset(now, f"offset {offset:+.2f}s di {reader}")
+
+    def poll(self, now: float) -> bool:
+        """True se è il momento di inviare un TIME_SYNC"""
+        if now >= self.interval_start + self.interval:
+            self.interval = min(self.interval * 2, self.max_interval)
+            self._start_interval(now)
+        if self._fired or now < self.fire_at:
+            return False
+        self._fired = True
+        if self._heard >= self.redundancy:
+            self.stats['suppressed'] += 1
+            return False
+        self.stats['broadcasts'] += 1
+        return True
+
+    def next_wakeup(self, now: float) -> float:
+        """Secondi fino al prossimo evento (invio o fine periodo)"""
+        events = [self.interval_start + self.interval]
+        if not self._fired:
+            events.append(self.fire_at)
+        return max(0.0, min(events) - now)
 
 class TimeSyncManager:
     """Gestisce la sincronizzazione temporale nel sistema mesh"""
     
     def __init__(self, device_name: str, device_type: str, 
-                 sync_interval: int = 300, max_drift: float = 15.0):
+                 sync_interval: int = 300, max_drift: float = 15.0,
+                 sample_window: int = 8, min_samples: int = 3,
+                 request_timeout: float = 120.0, min_request_interval: float = 30.0,
+                 clock_mode: str = 'step', max_slew: float = 10.0,
+                 clock_state_file: Optional[str] = None,
+                 clock: Callable[[], float] = time.time,
+                 slew_callback: Optional[Callable[[float], bool]] = None,
+                 min_sync_interval: float = 30.0, max_sync_interval: Optional[float] = None,
+                 max_suppress_hops: int = 1):
         """
         Args:
             device_name: Nome del dispositivo
             device_type: 'receiver' o 'reader'
-            sync_interval: Intervallo invio sync in secondi (solo per receiver)
+            sync_interval: Intervallo tipico di invio sync in secondi (solo per receiver)
             max_drift: Massima differenza temporale accettabile in secondi
+            sample_window: Campioni di offset considerati dal filtro (solo per reader)
+            min_samples: Campioni necessari prima di correggere l'orologio
+            request_timeout: Secondi dopo i quali una richiesta senza risposta viene scartata
+            min_request_interval: Secondi minimi tra due raffiche di richieste
+            clock_mode: 'step' (date -s oltre max_drift) o 'slew' (modello in-process
+                e correzione graduale con adjtimex)
+            max_slew: In modalità slew, offset oltre il quale si salta comunque (es. all'avvio)
+            clock_state_file: File JSON dove pubblicare il ClockModel per gli altri processi
+            clock: Sorgente del tempo (sostituibile con un orologio simulato nei test)
+            slew_callback: Funzione che avvia lo slew (default slew_system_clock)
+            min_sync_interval: Intervallo minimo tra i sync, usato all'avvio e dopo correzioni
+            max_sync_interval: Intervallo massimo con reader stabili (default 6 * sync_interval)
+            max_suppress_hops: Hop entro cui il sync di un altro receiver sopprime il proprio
         """
         self.device_name = device_name
         self.device_type = device_type.lower()
         self.sync_interval = sync_interval
         self.max_drift = max_drift
+        self.request_timeout = request_timeout
+        self.min_request_interval = min_request_interval
+        self.estimator = OffsetEstimator(window=sample_window, min_samples=min_samples)
+        self.clock_mode = clock_mode
+        self.max_slew = max_slew
+        self.clock_state_file = clock_state_file
+        self.clock = clock
+        self.slew_callback = slew_callback or slew_system_clock
+        self.clock_model = ClockModel(window=sample_window)
+        self.max_sync_interval = max_sync_interval or sync_interval * 6
+        self.scheduler = SyncBroadcastScheduler(
+            min_interval=min_sync_interval, max_interval=self.max_sync_interval,
+            max_suppress_hops=max_suppress_hops, unstable_offset=min(1.0, max_drift)
+        )
+        # Richieste in attesa di risposta: sequence -> t1
+        self._pending_requests: Dict[int, float] = {}
+        self._last_request_burst = 0.0
+        self._burst_remaining = 0
         
         # Stato interno
         self.time_status = TimeStatus()
@@ -73,7 +436,11 @@ class TimeSyncManager:
             'messages_sent': 0,
             'messages_received': 0,
             'time_updates': 0,
-            'sync_errors': 0
+            'sync_errors': 0,
+            'requests_sent': 0,
+            'responses_sent': 0,
+            'responses_received': 0,
+            'slews': 0
         }
     
     def start(self):
@@ -91,7 +458,10 @@ class TimeSyncManager:
                 name=f'TimeSync-{self.device_name}'
             )
             self._sync_thread.start()
-            self.logger.info(f"Time sync manager avviato (receiver mode, interval: {self.sync_interval}s)")
+            self.logger.info(
+                f"Time sync manager avviato (receiver mode, intervallo "
+                f"{self.scheduler.min_interval:.0f}-{self.scheduler.max_interval:.0f}s)"
+            )
         else:
             self.logger.info("Time sync manager avviato (reader mode, solo ricezione)")
     
@@ -103,8 +473,19 @@ class TimeSyncManager:
         self.logger.info("Time sync manager fermato")
     
     def _sync_loop(self):
-        """Loop principale per invio messaggi di sync (solo receiver)"""
-        while not self._stop_event.wait(self.sync_interval):
+        """Loop principale per invio messaggi di sync (solo receiver), con intervallo adattivo"""
+        with self._lock:
+            self.scheduler.start(self.clock())
+        while True:
+            with self._lock:
+                wait = self.scheduler.next_wakeup(self.clock())
+            # Risveglio almeno ogni secondo: un reset può anticipare il prossimo invio
+            if self._stop_event.wait(min(max(wait, 0.05), 1.0)):
+                break
+            with self._lock:
+                due = self.scheduler.poll(self.clock())
+            if not due:
+                continue
             try:
                 self.send_time_sync()
             except Exception as e:
@@ -121,7 +502,7 @@ class TimeSyncManager:
             self.sequence_number += 1
             
             sync_message = TimeSyncMessage(
-                timestamp=time.time(),
+                timestamp=self.clock(),
                 sender_name=self.device_name,
                 sender_type=self.device_type,
                 sequence_number=self.sequence_number,
@@ -151,17 +532,77 @@ class TimeSyncManager:
                 self.stats['sync_errors'] += 1
                 return False
     
-    def process_time_sync_message(self, payload: str) -> bool:
-        """Processa un messaggio di sincronizzazione ricevuto"""
+    def _send_payload(self, parts: List[str]) -> bool:
+        if not self.send_message_callback:
+            self.logger.warning("Callback invio messaggio non configurato")
+            return False
         try:
-            parts = payload.split(';')
-            if len(parts) < 6:
-                self.logger.warning(f"Messaggio time sync malformato: {payload}")
+            return bool(self.send_message_callback(";".join(parts)))
+        except Exception as e:
+            self.logger.error(f"Errore invio messaggio time sync: {e}")
+            self.stats['sync_errors'] += 1
+            return False
+
+    def send_time_request(self, target: str = '') -> bool:
+        """
+        Invia una richiesta di sincronizzazione (reader). Risponde il receiver
+        `target`, o qualunque receiver se vuoto.
+        Formato: 3;t1;nome;tipo_dispositivo;sequence;target
+        """
+        with self._lock:
+            now = self.clock()
+            # Scarta le richieste rimaste senza risposta
+            self._pending_requests = {
+                seq: t1 for seq, t1 in self._pending_requests.items() if now - t1 <= self.request_timeout
+            }
+            self.sequence_number += 1
+            sequence = self.sequence_number
+            t1 = self.clock()
+            self._pending_requests[sequence] = t1
+        # In coda l'offset stimato e il suo errore: i receiver adattano la frequenza dei sync
+        with self._lock:
+            offset = self.time_status.time_drift if len(self.estimator) else None
+            error = self.time_status.offset_error
+        success = self._send_payload([
+            str(MessageType.TIME_SYNC_REQUEST.value), repr(t1),
+            self.device_name, self.device_type, str(sequence), target,
+            '' if offset is None else f"{offset:.3f}", '' if error is None else f"{error:.3f}"
+        ])
+        if success:
+            self.stats['requests_sent'] += 1
+        else:
+            with self._lock:
+                self._pending_requests.pop(sequence, None)
+        return success
+
+    def _start_request_burst(self, target: str = '') -> bool:
+        """Avvia una raffica di richieste (fino a min_samples), non più spesso di min_request_interval"""
+        with self._lock:
+            now = self.clock()
+            if now - self._last_request_burst < self.min_request_interval:
                 return False
-            
+            self._last_request_burst = now
+            self._burst_remaining = self.estimator.min_samples - 1
+        return self.send_time_request(target)
+
+    def process_time_sync_message(self, payload: str, hops: Optional[int] = None) -> bool:
+        """
+        Processa un messaggio di sincronizzazione ricevuto (TIME_SYNC, richiesta o risposta).
+        hops: hop percorsi dal pacchetto (hopStart - hopLimit), se noti
+        """
+        received_at = self.clock()
+        try:
+            parts = payload.split(';')
             msg_type = int(parts[0])
+            if msg_type == MessageType.TIME_SYNC_REQUEST.value:
+                return self._process_time_request(parts, received_at)
+            if msg_type == MessageType.TIME_SYNC_RESPONSE.value:
+                return self._process_time_response(parts, received_at)
             if msg_type != MessageType.TIME_SYNC.value:
                 return False  # Non è un messaggio di time sync
+            if len(parts) < 6:
+                self.logger.warning(f"Messaggio time sync malformato: {payload}")
+                return False
             
             sync_message = TimeSyncMessage(
                 timestamp=float(parts[1]),
@@ -177,48 +618,31 @@ class TimeSyncManager:
             
             self.stats['messages_received'] += 1
             
-            # Calcola drift temporale
-            current_time = time.time()
-            time_drift = sync_message.timestamp - current_time
+            # Offset a una via: include il transito LoRa, quindi è solo un campione rumoroso
+            time_drift = sync_message.timestamp - received_at
             
             self.logger.debug(
                 f"Time sync ricevuto da {sync_message.sender_name}: "
-                f"drift={time_drift:.2f}s, seq={sync_message.sequence_number}"
+                f"drift a una via={time_drift:.2f}s, seq={sync_message.sequence_number}"
             )
             
-            # Aggiorna stato
-            with self._lock:
-                self.time_status.last_sync = current_time
-                self.time_status.time_drift = time_drift
-                self.time_status.sync_count += 1
-                self.time_status.sync_source = sync_message.sender_name
-                
-                # Determina se è necessario aggiornare l'orologio
-                needs_update = abs(time_drift) > self.max_drift
-                
-                if needs_update:
-                    self.logger.warning(
-                        f"Drift temporale elevato: {time_drift:.2f}s da {sync_message.sender_name}"
-                    )
-                    
-                    # Solo i reader aggiornano il proprio orologio
-                    if self.device_type == 'reader':
-                        success = self._update_system_time(sync_message.timestamp)
-                        if success:
-                            self.time_status.is_synced = True
-                            self.stats['time_updates'] += 1
-                            
-                            # Callback per notificare l'aggiornamento
-                            if self.on_time_updated:
-                                self.on_time_updated(time_drift, sync_message.timestamp)
-                        else:
-                            self.time_status.is_synced = False
-                    else:
-                        # I receiver non aggiornano il proprio orologio
-                        self.time_status.is_synced = True
-                else:
+            if self.device_type == 'reader':
+                with self._lock:
+                    self.time_status.sync_source = sync_message.sender_name
+                    self.estimator.add(time_drift - self.clock_model.remaining_slew(received_at),
+                                       None, received_at)
+                # Misura l'offset con lo scambio a quattro timestamp verso chi ha inviato il sync
+                self._start_request_burst(sync_message.sender_name)
+                self._evaluate_offset(sync_message.sender_name)
+            else:
+                # I receiver non aggiornano il proprio orologio; un sync vicino sopprime il proprio
+                with self._lock:
+                    self.scheduler.heard_sync(hops)
+                    self.time_status.last_sync = received_at
+                    self.time_status.time_drift = time_drift
+                    self.time_status.sync_count += 1
+                    self.time_status.sync_source = sync_message.sender_name
                     self.time_status.is_synced = True
-                    self.logger.debug(f"Orologio sincronizzato (drift: {time_drift:.2f}s)")
             
             return True
             
@@ -226,6 +650,165 @@ class TimeSyncManager:
             self.logger.error(f"Errore processamento time sync: {e}")
             self.stats['sync_errors'] += 1
             return False
+
+    def _process_time_request(self, parts: List[str], received_at: float) -> bool:
+        """Receiver: risponde con 4;t1;t2;t3;nome;tipo_dispositivo;sequence;richiedente"""
+        if len(parts) < 6:
+            self.logger.warning(f"Richiesta time sync malformata: {';'.join(parts)}")
+            return False
+        t1, requester, sequence, target = parts[1], parts[2], parts[4], parts[5]
+        if self.device_type != 'receiver' or requester == self.device_name:
+            return True
+        # Anche le richieste rivolte ad altri receiver dicono quanto è stabile il reader
+        reported = parts[6] if len(parts) > 6 else ''
+        error = parts[7] if len(parts) > 7 else ''
+        with self._lock:
+            self.scheduler.reader_report(requester, float(reported) if reported else None, received_at,
+                                         float(error) if error else None)
+        if target and target != self.device_name:
+            return True
+        self.stats['messages_received'] += 1
+        t3 = self.clock()
+        success = self._send_payload([
+            str(MessageType.TIME_SYNC_RESPONSE.value), t1, repr(received_at), repr(t3),
+            self.device_name, self.device_type, sequence, requester
+        ])
+        if success:
+            self.stats['responses_sent'] += 1
+        return success
+
+    def _process_time_response(self, parts: List[str], t4: float) -> bool:
+        """Reader: calcola offset e ritardo dai quattro timestamp e aggiorna la stima"""
+        if len(parts) < 8:
+            self.logger.warning(f"Risposta time sync malformata: {';'.join(parts)}")
+            return False
+        if self.device_type != 'reader' or parts[7] != self.device_name:
+            return True
+        t1, t2, t3 = float(parts[1]), float(parts[2]), float(parts[3])
+        responder, sequence = parts[4], int(parts[6])
+        with self._lock:
+            sent_at = self._pending_requests.get(sequence)
+            if sent_at is None or abs(sent_at - t1) > 1e-6 or t4 - t1 > self.request_timeout:
+                self.logger.debug(f"Risposta time sync non attesa: seq={sequence} da {responder}")
+                return True
+            self.stats['responses_received'] += 1
+            offset = ((t2 - t1) + (t3 - t4)) / 2
+            delay = (t4 - t1) - (t3 - t2)
+            # I campioni sono al netto dello slew ancora in corso
+            self.estimator.add(offset - self.clock_model.remaining_slew(t4), delay, t4)
+            self.time_status.sync_source = responder
+            send_next = self._burst_remaining > 0
+            if send_next:
+                self._burst_remaining -= 1
+        self.logger.debug(
+            f"Risposta time sync da {responder}: offset={offset:.3f}s, delay={delay:.3f}s, seq={sequence}"
+        )
+        self._evaluate_offset(responder)
+        if send_next:
+            self.send_time_request(responder)
+        return True
+
+    def _evaluate_offset(self, source: str):
+        """Aggiorna lo stato con la stima filtrata e corregge l'orologio solo se affidabile"""
+        now = self.clock()
+        with self._lock:
+            estimate = self.estimator.estimate(now)
+            if estimate is None:
+                return
+            self.time_status.last_sync = now
+            self.time_status.time_drift = estimate.offset
+            self.time_status.offset_error = estimate.error_bound
+            self.time_status.round_trip = estimate.delay
+            self.time_status.confidence = estimate.confidence
+            self.time_status.sync_count += 1
+
+            # Un campione isolato non basta: servono min_samples campioni e un offset
+            # oltre l'incertezza della misura (l'offset vero è entro ± error_bound)
+            enough = estimate.samples >= self.estimator.min_samples
+            significant = abs(estimate.offset) > estimate.error_bound + 2 * estimate.jitter
+            if enough:
+                self.clock_model.update(estimate.offset, now)
+            if self.clock_mode == 'slew':
+                self._correct_by_slew(estimate, source, now, enough and significant)
+            else:
+                self._correct_by_step(estimate, source, enough and significant)
+            self._publish_clock_model()
+
+    def _correct_by_step(self, estimate: OffsetEstimate, source: str, reliable: bool):
+        """Modalità step: salta l'orologio solo oltre max_drift"""
+        if abs(estimate.offset) <= self.max_drift:
+            self.time_status.is_synced = True
+            self.logger.debug(
+                f"Orologio sincronizzato (offset: {estimate.offset:.3f}s "
+                f"± {estimate.error_bound:.3f}s, confidenza {estimate.confidence})"
+            )
+            return
+        if not reliable:
+            self.time_status.is_synced = False
+            self.logger.info(
+                f"Offset {estimate.offset:.2f}s da {source} non ancora affidabile "
+                f"({estimate.samples} campioni, ± {estimate.error_bound:.2f}s)"
+            )
+            return
+        self.logger.warning(
+            f"Drift temporale elevato: {estimate.offset:.2f}s da {source} "
+            f"(± {estimate.error_bound:.2f}s, confidenza {estimate.confidence})"
+        )
+        self._step_clock(estimate.offset)
+
+    def _correct_by_slew(self, estimate: OffsetEstimate, source: str, now: float, reliable: bool):
+        """
+        Modalità slew: le punzonature vengono corrette subito con il ClockModel,
+        l'orologio di sistema viene avvicinato gradualmente con adjtimex.
+        """
+        self.time_status.is_synced = abs(estimate.offset) <= self.max_drift
+        if not reliable or self.clock_model.remaining_slew(now):
+            # Offset dentro l'incertezza, o slew precedente ancora in corso
+            return
+        if abs(estimate.offset) > self.max_slew:
+            # Offset troppo grande da recuperare gradualmente (es. avvio senza RTC)
+            self.logger.warning(f"Offset {estimate.offset:.2f}s da {source} oltre max_slew, salto dell'orologio")
+            self._step_clock(estimate.offset)
+            return
+        if self.slew_callback(estimate.offset):
+            self.clock_model.start_slew(estimate.offset, now)
+            self.estimator.shift(estimate.offset)
+            self.stats['slews'] += 1
+            self.time_status.is_synced = True
+            self.logger.info(
+                f"Slew dell'orologio avviato: {estimate.offset:+.3f}s da {source} "
+                f"(circa {abs(estimate.offset) / SLEW_RATE:.0f}s per completarlo)"
+            )
+            if self.on_time_updated:
+                self.on_time_updated(estimate.offset, now + estimate.offset)
+
+    def _step_clock(self, offset: float):
+        new_timestamp = self.clock() + offset
+        success = self._update_system_time(new_timestamp)
+        if success:
+            # I campioni raccolti vanno riferiti al nuovo orologio
+            self.estimator.shift(offset)
+            self.clock_model.stepped(offset)
+            self.time_status.time_drift = 0.0
+            self.time_status.is_synced = True
+            self.stats['time_updates'] += 1
+            if self.on_time_updated:
+                self.on_time_updated(offset, new_timestamp)
+        else:
+            self.time_status.is_synced = False
+
+    def _publish_clock_model(self):
+        if not self.clock_state_file:
+            return
+        try:
+            self.clock_model.save(self.clock_state_file)
+        except OSError as e:
+            self.logger.error(f"Errore scrittura stato orologio {self.clock_state_file}: {e}")
+
+    def correct_timestamp(self, timestamp: Optional[float] = None) -> float:
+        """Istante locale corretto con il modello dell'orologio (default: adesso)"""
+        with self._lock:
+            return self.clock_model.correct(self.clock() if timestamp is None else timestamp)
     
     def _update_system_time(self, new_timestamp: float) -> bool:
         """Aggiorna l'orologio di sistema (solo su Linux/Raspberry Pi)"""
@@ -270,16 +853,25 @@ class TimeSyncManager:
                 'time_drift': self.time_status.time_drift,
                 'sync_count': self.time_status.sync_count,
                 'sync_source': self.time_status.sync_source,
+                'offset_error': self.time_status.offset_error,
+                'round_trip': self.time_status.round_trip,
+                'confidence': self.time_status.confidence,
+                'samples': len(self.estimator),
+                'clock_mode': self.clock_mode,
+                'clock_rate_ppm': round(self.clock_model.rate * 1e6, 2),
+                'remaining_slew': self.clock_model.remaining_slew(self.clock()),
+                'sync_interval': self.scheduler.interval,
+                'scheduler': dict(self.scheduler.stats),
                 'max_drift': self.max_drift,
                 'stats': self.stats.copy(),
-                'current_time': time.time()
+                'current_time': self.clock()
             }
             
             # Aggiungi informazioni sulla sincronizzazione
             if self.time_status.last_sync:
-                time_since_sync = time.time() - self.time_status.last_sync
+                time_since_sync = self.clock() - self.time_status.last_sync
                 status['time_since_last_sync'] = time_since_sync
-                status['sync_age_warning'] = time_since_sync > (self.sync_interval * 2)
+                status['sync_age_warning'] = time_since_sync > (self.max_sync_interval * 2)
             
             return status
     
@@ -289,9 +881,10 @@ class TimeSyncManager:
             self.logger.warning("Force sync disponibile solo per reader")
             return False
         
-        # Invia un messaggio speciale di richiesta sync
-        # I receiver dovrebbero rispondere con un time sync
-        return self.send_time_sync()
+        # Raffica di richieste a quattro timestamp: rispondono i receiver in ascolto
+        with self._lock:
+            self._last_request_burst = 0.0
+        return self._start_request_burst()
     
     def health_check(self) -> Dict[str, Any]:
         """Esegue un health check del time sync manager"""
@@ -308,7 +901,7 @@ class TimeSyncManager:
             health['status'] = 'warning'
             health['issues'].append('Orologio non sincronizzato')
         
-        if status.get('time_since_last_sync', 0) > (self.sync_interval * 3):
+        if status.get('time_since_last_sync', 0) > (self.max_sync_interval * 3):
             health['status'] = 'warning'
             health['issues'].append('Nessuna sincronizzazione recente')
         
@@ -357,8 +950,11 @@ class TimeSyncIntegration:
             text = raw.get('payload') or raw.get('text') or str(pkt)
             
             # Prova a processare come time sync
-            if isinstance(text, str) and text.startswith('2;'):  # MessageType.TIME_SYNC
-                time_sync_manager.process_time_sync_message(text)
+            # MessageType.TIME_SYNC, TIME_SYNC_REQUEST, TIME_SYNC_RESPONSE
+            if isinstance(text, str) and text[:2] in ('2;', '3;', '4;'):
+                hop_start, hop_limit = pkt.get('hopStart'), pkt.get('hopLimit')
+                hops = hop_start - hop_limit if isinstance(hop_start, int) and isinstance(hop_limit, int) else None
+                time_sync_manager.process_time_sync_message(text, hops=hops)
         
         # Sostituisci il callback
         if hasattr(meshtastic_service, 'mesh') and meshtastic_service.mesh:
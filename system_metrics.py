@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+system_metrics.py - campionatore delle metriche di sistema condiviso.
+
+Un thread in background legge /proc e /sys ogni `interval` secondi e tiene
+in memoria l'ultima fotografia: chi la chiede (callhome, read_serial, display
+OLED) riceve subito una copia, senza bloccare.
+
+- CPU: differenza dei contatori di /proc/stat tra due campioni, invece di
+  psutil.cpu_percent(interval=...) che dorme per misurare;
+- memoria da /proc/meminfo, disco con statvfs, uptime da /proc/uptime,
+  carico da os.getloadavg, temperatura da /sys/class/thermal;
+- conteggio processi (scansione di /proc) solo ogni `slow_every` campioni.
+
+Su sistemi senza /proc (sviluppo su Windows/macOS) si usa psutil, se installato,
+sempre in modalità non bloccante.
+"""
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+PROC_STAT = '/proc/stat'
+PROC_MEMINFO = '/proc/meminfo'
+PROC_UPTIME = '/proc/uptime'
+THERMAL_ZONE = '/sys/class/thermal/thermal_zone0/temp'
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _read_cpu_times(path: str = PROC_STAT):
+    """(totale, inattivo) in jiffies dalla riga 'cpu' aggregata"""
+    with open(path) as f:
+        fields = f.readline().split()[1:]
+    values = [int(v) for v in fields]
+    # user nice system idle iowait irq softirq steal (guest è già incluso in user)
+    total = sum(values[:8])
+    idle = values[3] + (values[4] if len(values) > 4 else 0)
+    return total, idle
+
+
+def _read_meminfo(path: str = PROC_MEMINFO) -> Dict[str, int]:
+    wanted = {'MemTotal', 'MemAvailable'}
+    values = {}
+    with open(path) as f:
+        for line in f:
+            key, _, rest = line.partition(':')
+            if key in wanted:
+                values[key] = int(rest.split()[0]) * 1024
+                if len(values) == len(wanted):
+                    break
+    return values
+
+
+def _count_processes(proc: str = '/proc') -> int:
+    return sum(1 for entry in os.scandir(proc) if entry.name.isdigit())
+
+
+class SystemMetricsSampler:
+    """Campionatore in background con fotografia in cache"""
+
+    def __init__(self, interval: float = 5.0, slow_every: int = 12, disk_path: str = '/'):
+        self.interval = interval
+        self.slow_every = slow_every
+        self.disk_path = disk_path
+        self._lock = threading.Lock()
+        # Serializza i campioni: il thread e snapshot() non devono alternarsi su _prev_cpu
+        self._sample_lock = threading.Lock()
+        self._snapshot: Dict[str, Any] = {}
+        self._prev_cpu = None
+        self._samples = 0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._use_proc = os.path.exists(PROC_STAT)
+        self._stats = {'samples': 0, 'errors': 0, 'last_sample_ms': 0.0}
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop_event.clear()
+        self.sample()
+        self._thread = threading.Thread(target=self._run, name="SystemMetrics", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def _cpu_percent(self) -> Optional[float]:
+        if not self._use_proc:
+            return psutil.cpu_percent(interval=None) if psutil else None
+        current = _read_cpu_times()
+        previous, self._prev_cpu = self._prev_cpu, current
+        if previous is None:
+            # Primo campione: media dall'avvio del sistema
+            total, idle = current
+        else:
+            total, idle = current[0] - previous[0], current[1] - previous[1]
+        if total <= 0:
+            return None
+        return round(100.0 * (total - idle) / total, 1)
+
+    def _memory(self, metrics: Dict[str, Any]):
+        if self._use_proc:
+            info = _read_meminfo()
+            total, available = info.get('MemTotal'), info.get('MemAvailable')
+        elif psutil:
+            vm = psutil.virtual_memory()
+            total, available = vm.total, vm.available
+        else:
+            return
+        if total and available is not None:
+            metrics['memory_percent'] = round(100.0 * (total - available) / total, 1)
+            metrics['memory_available_mb'] = round(available / (1024 * 1024), 2)
+
+    def _disk(self, metrics: Dict[str, Any]):
+        st = os.statvfs(self.disk_path)
+        total = st.f_blocks * st.f_frsize
+        free = st.f_bavail * st.f_frsize
+        used = total - st.f_bfree * st.f_frsize
+        if total:
+            # Come psutil: percentuale sullo spazio disponibile ai processi non root
+            metrics['disk_percent'] = round(100.0 * used / (used + free), 1)
+        metrics['disk_free_gb'] = round(free / (1024 ** 3), 2)
+
+    def _uptime_hours(self) -> Optional[float]:
+        if self._use_proc:
+            with open(PROC_UPTIME) as f:
+                return round(float(f.read().split()[0]) / 3600, 2)
+        if psutil:
+            return round((time.time() - psutil.boot_time()) / 3600, 2)
+        return None
+
+    @staticmethod
+    def _temperature() -> Optional[float]:
+        try:
+            with open(THERMAL_ZONE) as f:
+                return round(int(f.read()) / 1000.0, 1)
+        except (OSError, ValueError):
+            return None
+
+    def sample(self) -> Dict[str, Any]:
+        """Legge un nuovo campione (chiamato dal thread; economico, non dorme)"""
+        with self._sample_lock:
+            return self._sample()
+
+    def _sample(self) -> Dict[str, Any]:
+        started = time.monotonic()
+        metrics: Dict[str, Any] = {}
+        try:
+            metrics['cpu_percent'] = self._cpu_percent()
+            self._memory(metrics)
+            if hasattr(os, 'statvfs'):
+                self._disk(metrics)
+            metrics['uptime_hours'] = self._uptime_hours()
+            if hasattr(os, 'getloadavg'):
+                metrics['load_avg_1m'] = round(os.getloadavg()[0], 2)
+            with self._lock:
+                previous = self._snapshot
+            if self._samples % self.slow_every == 0 or 'process_count' not in previous:
+                if self._use_proc:
+                    metrics['process_count'] = _count_processes()
+                elif psutil:
+                    metrics['process_count'] = len(psutil.pids())
+            else:
+                metrics['process_count'] = previous['process_count']
+            # Sempre presente (None senza sensore): i consumatori vedono uno schema stabile
+            metrics['temperature'] = self._temperature()
+        except Exception as e:
+            self._stats['errors'] += 1
+            logging.warning("Errore campionamento metriche di sistema: %s", e)
+        self._samples += 1
+        metrics['sampled_at'] = time.time()
+        with self._lock:
+            self._snapshot = metrics
+            self._stats['samples'] += 1
+            self._stats['last_sample_ms'] = round((time.monotonic() - started) * 1000, 2)
+        return dict(metrics)
+
+    def snapshot(self, max_age: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Ultima fotografia (copia). Se il campionatore non è avviato, o la
+        fotografia è più vecchia di max_age secondi, ne legge una al momento.
+        """
+        with self._lock:
+            snapshot = dict(self._snapshot)
+        if not snapshot or (max_age is not None and time.time() - snapshot['sampled_at'] > max_age):
+            snapshot = self.sample()
+        return snapshot
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval'] = self.interval
+        stats['source'] = 'proc' if self._use_proc else ('psutil' if psutil else 'none')
+        return stats
+
+
+_shared_sampler: Optional[SystemMetricsSampler] = None
+_shared_lock = threading.Lock()
+
+
+def get_sampler(interval: float = 5.0) -> SystemMetricsSampler:
+    """Campionatore unico per processo, avviato al primo uso (anche da edge_runtime)"""
+    global _shared_sampler
+    with _shared_lock:
+        if _shared_sampler is None:
+            _shared_sampler = SystemMetricsSampler(interval=interval)
+            _shared_sampler.start()
+        return _shared_sampler
+
+
+if __name__ == '__main__':
+    sampler = get_sampler(interval=1.0)
+    for _ in range(3):
+        time.sleep(1.0)
+        print(sampler.snapshot())
+    print(sampler.get_stats())